@@ -0,0 +1,347 @@
+// map stream
+// Loads the figure from /map/figure (built and compressed once per version on the server, see figures.py) and
+// then listens to the server sent events of /map/events (see streaming.py) and applies them to the plotly map.
+// The 'snapshot' event replaces the whole state, 'delta' events only have the sensors and gateways that changed
+// (and the heatmap cells, when they changed).
+// The traces are rebuilt in the browser in the same way as Mapper.build_figure does it on the server and
+// updated with Plotly.restyle, at most once per animation frame.
+// Events with 'lod' set only have a version: there are too many devices to send them all, so the devices (or
+// clusters of devices) of the viewport are fetched from /map/view (see spatial.py), on every new version and
+// every time the map is moved or zoomed.
+
+(function () {
+    // field positions of the compact sensor and gateway lists, see encode_sensor / encode_gateway
+    var S_EUI = 0, S_NAME = 1, S_KNOWN = 2, S_LAT = 3, S_LON = 4, S_KNOWN_LAT = 5, S_KNOWN_LON = 6,
+        S_ESTIMATED = 7, S_GATEWAYS = 8, S_FOREIGN = 9;
+    var G_EUI = 0, G_NAME = 1, G_LAT = 2, G_LON = 3;
+    // fields of a cluster, see SpatialIndex.query
+    var C_LAT = 0, C_LON = 1, C_COUNT = 2, C_KNOWN = 3, C_UNKNOWN = 4, C_FOREIGN = 5;
+    // mapbox draws the world 512 pixels wide at zoom 0, and at most one viewport request per second
+    var TILE_SIZE = 512, VIEW_INTERVAL = 1000;
+
+    var sensors = {};
+    var gateways = {};
+    // heatmap cells [lats, lons, strengths], see encode_coverage, null when they did not change since the render
+    var coverage = null;
+    var version = -1;
+    var renderPending = false;
+    // viewport mode (lod), with the clusters of the last /map/view answer
+    var lod = false;
+    var clusters = [];
+    var viewPending = false, viewAgain = false, lastView = 0;
+    // the traces are only there after the figure of /map/figure is drawn
+    var figureLoaded = false;
+
+    function graph() {
+        return document.querySelector("#live-map .js-plotly-plot");
+    }
+
+    // index of the trace with this name and mode, and of the heatmap layer
+    function traceIndices(gd) {
+        var indices = {points: {}, lines: {}, coverage: undefined, clusters: undefined};
+        gd.data.forEach(function (trace, i) {
+            if (trace.type === "densitymapbox") {
+                indices.coverage = i;
+            } else if (trace.name === "Cluster") {
+                indices.clusters = i;
+            } else if (trace.mode === "lines") {
+                indices.lines[trace.name] = i;
+            } else {
+                indices.points[trace.name] = i;
+            }
+        });
+        return indices;
+    }
+
+    function buildTraces() {
+        var points = {}, lines = {};
+
+        function trace(table, name) {
+            if (!table[name]) {
+                table[name] = {lat: [], lon: [], text: []};
+            }
+            return table[name];
+        }
+
+        function addPoint(type, lat, lon, text) {
+            var t = trace(points, type);
+            t.lat.push(lat);
+            t.lon.push(lon);
+            t.text.push(text);
+        }
+
+        function addLine(type, lat1, lon1, lat2, lon2, text) {
+            var t = trace(lines, type);
+            t.lat.push(lat1, lat2, null);
+            t.lon.push(lon1, lon2, null);
+            t.text.push(text, text, null);
+        }
+
+        Object.keys(sensors).forEach(function (eui) {
+            var s = sensors[eui];
+            var linkType;
+            if (s[S_KNOWN]) {
+                addPoint("Sensor", s[S_LAT], s[S_LON], s[S_NAME]);
+                addPoint("Actual Position Sensors", s[S_KNOWN_LAT], s[S_KNOWN_LON], s[S_NAME]);
+                linkType = "Signal (known sensor)";
+                if (s[S_ESTIMATED]) {
+                    addLine("Actual Position Sensors", s[S_LAT], s[S_LON], s[S_KNOWN_LAT], s[S_KNOWN_LON], s[S_NAME]);
+                }
+            } else if (s[S_FOREIGN]) {
+                addPoint("Foreign Device", s[S_LAT], s[S_LON], s[S_NAME]);
+                linkType = "Signal (foreign device)";
+            } else {
+                addPoint("Unknown Sensor", s[S_LAT], s[S_LON], s[S_NAME]);
+                linkType = "Signal (unknown sensor)";
+            }
+            s[S_GATEWAYS].forEach(function (gatewayEui) {
+                var g = gateways[gatewayEui];
+                if (g) {
+                    addLine(linkType, s[S_LAT], s[S_LON], g[G_LAT], g[G_LON], s[S_NAME] + " to " + g[G_NAME]);
+                }
+            });
+        });
+        Object.keys(gateways).forEach(function (eui) {
+            var g = gateways[eui];
+            addPoint("Gateway", g[G_LAT], g[G_LON], g[G_NAME]);
+        });
+        return {points: points, lines: lines};
+    }
+
+    // same as cluster_size and cluster_text in mapper.py
+    function clusterSize(count) {
+        return 6 + 3 * Math.log2(count);
+    }
+
+    function clusterText(c) {
+        return c[C_COUNT] + " devices (" + c[C_KNOWN] + " sensors, " + c[C_UNKNOWN] + " unknown, " +
+            c[C_FOREIGN] + " foreign)";
+    }
+
+    function render() {
+        renderPending = false;
+        var gd = graph();
+        if (!gd || !figureLoaded || !window.Plotly) {
+            // the graph is not drawn yet, try again a bit later
+            scheduleRender(200);
+            return;
+        }
+        if (!gd.loraRelayout) {
+            // moving or zooming the map needs the devices of the new viewport
+            gd.loraRelayout = true;
+            gd.on("plotly_relayout", function () {
+                if (lod) {
+                    requestView();
+                }
+            });
+        }
+
+        var indices = traceIndices(gd);
+        var traces = buildTraces();
+        var update = {lat: [], lon: [], text: []};
+        var order = [];
+
+        function add(index, t) {
+            if (index === undefined) {
+                return;
+            }
+            t = t || {lat: [], lon: [], text: []};
+            order.push(index);
+            update.lat.push(t.lat);
+            update.lon.push(t.lon);
+            update.text.push(t.text);
+        }
+
+        Object.keys(indices.lines).forEach(function (name) {
+            add(indices.lines[name], traces.lines[name]);
+        });
+        Object.keys(indices.points).forEach(function (name) {
+            add(indices.points[name], traces.points[name]);
+        });
+
+        window.Plotly.restyle(gd, update, order);
+
+        if (indices.clusters !== undefined) {
+            window.Plotly.restyle(gd, {
+                lat: [clusters.map(function (c) { return c[C_LAT]; })],
+                lon: [clusters.map(function (c) { return c[C_LON]; })],
+                text: [clusters.map(clusterText)],
+                "marker.size": [clusters.map(function (c) { return clusterSize(c[C_COUNT]); })]
+            }, [indices.clusters]);
+        }
+
+        // the heatmap has z instead of text, and is only updated when it changed
+        if (coverage && indices.coverage !== undefined) {
+            window.Plotly.restyle(gd, {lat: [coverage[0]], lon: [coverage[1]], z: [coverage[2]]},
+                [indices.coverage]);
+            coverage = null;
+        }
+    }
+
+    function scheduleRender(delay) {
+        if (renderPending) {
+            return;
+        }
+        renderPending = true;
+        if (delay) {
+            setTimeout(render, delay);
+        } else {
+            window.requestAnimationFrame(render);
+        }
+    }
+
+    // the area the map shows, from its center, zoom and size in pixels (web mercator)
+    function viewport(gd) {
+        var mapbox = gd._fullLayout.mapbox;
+        var world = TILE_SIZE * Math.pow(2, mapbox.zoom);
+        var lat = mapbox.center.lat * Math.PI / 180;
+        var y = (1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2;
+        var halfX = gd.clientWidth / 2 / world, halfY = gd.clientHeight / 2 / world;
+
+        function latOf(y) {
+            return Math.atan(Math.sinh(Math.PI * (1 - 2 * y))) * 180 / Math.PI;
+        }
+
+        return {
+            zoom: mapbox.zoom,
+            south: latOf(y + halfY),
+            west: mapbox.center.lon - halfX * 360,
+            north: latOf(y - halfY),
+            east: mapbox.center.lon + halfX * 360
+        };
+    }
+
+    function requestView() {
+        var gd = graph();
+        var wait = lastView + VIEW_INTERVAL - Date.now();
+        if (viewPending || wait > 0 || !gd || !gd._fullLayout || !gd._fullLayout.mapbox) {
+            // one request at a time, the last one asked for is done after it
+            if (!viewAgain) {
+                viewAgain = true;
+                setTimeout(function () {
+                    viewAgain = false;
+                    requestView();
+                }, Math.max(wait, 200));
+            }
+            return;
+        }
+        viewPending = true;
+        lastView = Date.now();
+        var v = viewport(gd);
+        var url = document.getElementById("map-events").getAttribute("data-view-url") + "?" +
+            ["zoom", "south", "west", "north", "east"].map(function (name) {
+                return name + "=" + v[name].toFixed(6);
+            }).join("&");
+        fetch(url).then(function (response) {
+            return response.json();
+        }).then(function (data) {
+            if (!lod) {
+                return;
+            }
+            sensors = {};
+            gateways = {};
+            data.sensors.forEach(function (s) { sensors[s[S_EUI]] = s; });
+            data.gateways.forEach(function (g) { gateways[g[G_EUI]] = g; });
+            clusters = data.clusters;
+            scheduleRender();
+        }).catch(function () {
+            // the next version or move tries again
+        }).then(function () {
+            viewPending = false;
+        });
+    }
+
+    function onVersion(data) {
+        // too many devices, the event only has the version (and the heatmap when it changed)
+        lod = true;
+        if (data.coverage) {
+            coverage = data.coverage;
+        }
+        version = data.version;
+        requestView();
+        scheduleRender();
+    }
+
+    function onSnapshot(event) {
+        var data = JSON.parse(event.data);
+        if (data.lod) {
+            onVersion(data);
+            return;
+        }
+        lod = false;
+        clusters = [];
+        sensors = {};
+        gateways = {};
+        data.sensors.forEach(function (s) { sensors[s[S_EUI]] = s; });
+        data.gateways.forEach(function (g) { gateways[g[G_EUI]] = g; });
+        coverage = data.coverage;
+        version = data.version;
+        scheduleRender();
+    }
+
+    function onDelta(event) {
+        var data = JSON.parse(event.data);
+        if (data.base !== version) {
+            // we missed something, the reconnect will send a new snapshot
+            source.close();
+            connect();
+            return;
+        }
+        if (data.lod) {
+            onVersion(data);
+            return;
+        }
+        if (lod) {
+            // back to all devices, we only have the ones of the viewport, the reconnect sends them all
+            source.close();
+            connect();
+            return;
+        }
+        data.sensors.forEach(function (s) { sensors[s[S_EUI]] = s; });
+        data.gateways.forEach(function (g) { gateways[g[G_EUI]] = g; });
+        data.removed_sensors.forEach(function (eui) { delete sensors[eui]; });
+        data.removed_gateways.forEach(function (eui) { delete gateways[eui]; });
+        if (data.coverage) {
+            coverage = data.coverage;
+        }
+        version = data.version;
+        scheduleRender();
+    }
+
+    var source = null;
+
+    function connect() {
+        var element = document.getElementById("map-events");
+        if (!element) {
+            // dash has not rendered the layout yet
+            setTimeout(connect, 200);
+            return;
+        }
+        source = new EventSource(element.getAttribute("data-url"));
+        source.addEventListener("snapshot", onSnapshot);
+        source.addEventListener("delta", onDelta);
+    }
+
+    function loadFigure() {
+        var element = document.getElementById("map-events");
+        var gd = graph();
+        if (!element || !gd || !window.Plotly) {
+            // dash has not rendered the layout yet
+            setTimeout(loadFigure, 200);
+            return;
+        }
+        // the browser cache revalidates with the etag, an unchanged figure is a 304
+        fetch(element.getAttribute("data-figure-url")).then(function (response) {
+            return response.json();
+        }).then(function (figure) {
+            return window.Plotly.react(gd, figure.data, figure.layout);
+        }).then(function () {
+            figureLoaded = true;
+            connect();
+        }).catch(function () {
+            setTimeout(loadFigure, 1000);
+        });
+    }
+
+    window.addEventListener("load", loadFigure);
+})();
@@ -0,0 +1,325 @@
+# benchmark
+# Measures the hot paths of the project on synthetic traffic:
+#     decode        frames/s from raw json to what the parser gets: json.loads dicts vs batched Packet records
+#     parser        packets/s through main.handle_message
+#     localization  time per solve of Sensor.multilateration and of the batched Localizer
+#     map           wall time and json size of Mapper.build_figure, and of /map/view zoomed out and in
+# The synthetic network is made from the real catalogs in data/. When more sensors or gateways are asked for
+# than the catalogs have, extra ones are made by moving copies of the real ones a bit (with new euis).
+# Packets follow the documented packet format, with rssi from the path loss model plus noise. Every sensor of the
+# catalog transmits in turn, by default PACKETS_PER_SENSOR times (at least 20000 packets), and the results have
+# the number of sensors and gateways that were heard, so large networks are really measured at their size.
+#
+#     python benchmark.py --sensors 300 --gateways 7 --packets 20000
+#     python benchmark.py --sensors 50000 --gateways 500 --suite parser localization
+#
+# Every run appends one json line (git commit, parameters and results) to --out, so runs can be compared.
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+import main
+import packets as packet_decoding
+import signals
+from figures import FigureEntry
+from localization import Localizer
+from mapper import Mapper
+from registry import Registry
+from spatial import viewport_around
+
+SUITES = ("decode", "parser", "localization", "map")
+# the default number of packets is this many per sensor (and at least 20000)
+PACKETS_PER_SENSOR = 4
+
+
+def random_eui(rng):
+    return "%016x" % rng.getrandbits(64)
+
+
+def scale_catalog(data, count, lat_column, lon_column, eui_column, rng, spread=0.005):
+    """"
+        Returns a catalog with count rows, the real rows first and then jittered copies with new euis
+    """
+    data = data.copy()
+    if count <= len(data):
+        return data.iloc[:count].reset_index(drop=True)
+
+    located = data.dropna(subset=[lat_column, lon_column])
+    extra = located.sample(n=count - len(data), replace=True, random_state=rng.randrange(2 ** 31)).copy()
+    extra[lat_column] = extra[lat_column] + [rng.uniform(-spread, spread) for _ in range(len(extra))]
+    extra[lon_column] = extra[lon_column] + [rng.uniform(-spread, spread) for _ in range(len(extra))]
+    extra[eui_column] = [random_eui(rng) for _ in range(len(extra))]
+    return pd.concat([data, extra], ignore_index=True)
+
+
+def make_network(nr_of_sensors, nr_of_gateways, seed=0, sensor_path='data/sensor_locations.csv',
+                 gateway_path='data/gateway_locations.csv'):
+    rng = random.Random(seed)
+    sensor_data = scale_catalog(pd.read_csv(sensor_path), nr_of_sensors, 'St_Y', 'St_X', 'Sensor_Eui', rng)
+    gateway_data = scale_catalog(pd.read_csv(gateway_path), nr_of_gateways, 'latitude', 'longitude', 'eui', rng,
+                                 spread=0.02)
+    return sensor_data, gateway_data
+
+
+def colon_eui(eui):
+    return ":".join(eui[i:i + 2] for i in range(0, len(eui), 2))
+
+
+def make_packets(registry, nr_of_packets, gateways_per_packet=4, foreign_fraction=0.0, seed=0, noise=4.0):
+    """"
+        Synthetic packets in the websocket format, every uplink is received by a few of the nearest gateways.
+        The sensors take turns in a random order, so every sensor transmits before one transmits again.
+    """
+    rng = random.Random(seed)
+    sensors = list(registry.sensor_catalog.values())
+    gateways = list(registry.gateway_catalog.values())
+    gateway_lat = np.array([g.lat for g in gateways])
+    gateway_lon = np.array([g.lon for g in gateways])
+    campus = (52.2394, 6.8566)
+
+    packets = []
+    start = time.time()
+    order = []
+    while len(packets) < nr_of_packets:
+        if not order:
+            order = sensors[:]
+            rng.shuffle(order)
+        record = order.pop()
+        lat, lon = (record.lat, record.lon) if record.known else campus
+        foreign = rng.random() < foreign_fraction
+
+        # the nearest gateways hear the uplink
+        d = np.hypot((gateway_lat - lat) * 111000, (gateway_lon - lon) * 68000)
+        nearest = np.argsort(d)[:min(gateways_per_packet * 2, len(gateways))]
+        heard = rng.sample(list(nearest), min(gateways_per_packet, len(nearest)))
+
+        uplink_time = start + len(packets) * 0.01
+        addr = record.eui[-8:]
+        # one data rate per uplink, every gateway hears the same transmission
+        datr = 'SF%dBW125' % rng.choice((7, 7, 7, 8, 9, 10, 12))
+        for j in heard:
+            rssi = signals.transmition_power - 10 * 3.0 * np.log10(max(d[j], 1.0)) + rng.gauss(0, noise)
+            msg = {
+                'tmst': rng.getrandbits(32),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(uplink_time)) + '.%06dZ' % (
+                    (uplink_time % 1) * 1e6),
+                'chan': 1, 'rfch': 1, 'freq': 868.1, 'stat': 1, 'modu': 'LORA',
+                'datr': datr, 'codr': '4/5',
+                'lsnr': round(rng.uniform(-15, 12), 1), 'rssi': int(round(rssi)), 'size': 17,
+                'gateway': colon_eui(gateways[j].eui), 'device_addr': addr,
+            }
+            if not foreign:
+                msg['device_eui'] = record.eui
+                msg['device_name'] = 'bench-' + record.eui[-6:]
+            packets.append(msg)
+    return packets[:nr_of_packets]
+
+
+@contextlib.contextmanager
+def quiet():
+    # the lora loggers warn on some events (unknown gateways, ...), keep that out of the measurement and its output
+    level = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logging.disable(level)
+
+
+def bench_decode(packets, batch_size=100, repeats=3):
+    frames = [json.dumps(msg) for msg in packets]
+    batches = [frames[i:i + batch_size] for i in range(0, len(frames), batch_size)]
+
+    # the old path: json.loads of every frame into a dict
+    dict_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for frame in frames:
+            json.loads(frame)
+        dict_times.append(time.perf_counter() - start)
+
+    # the new path: one decode per batch into Packet records
+    packet_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for batch in batches:
+            packet_decoding.decode_frames(batch)
+        packet_times.append(time.perf_counter() - start)
+
+    dict_seconds = statistics.median(dict_times)
+    packet_seconds = statistics.median(packet_times)
+    return {
+        "frames": len(frames),
+        "orjson": packet_decoding.orjson is not None,
+        "dict_frames_per_second": len(frames) / dict_seconds if dict_seconds else None,
+        "packet_frames_per_second": len(frames) / packet_seconds if packet_seconds else None,
+    }
+
+
+def bench_parser(registry, packets):
+    with quiet():
+        start = time.perf_counter()
+        for msg in packets:
+            main.handle_message(registry, msg, muting=True)
+        elapsed = time.perf_counter() - start
+    return {
+        "packets": len(packets),
+        "seconds": elapsed,
+        "packets_per_second": len(packets) / elapsed if elapsed else None,
+    }
+
+
+def network_size(registry, nr_of_packets):
+    # what the parser made of the traffic: the other suites work on the sensors and gateways that were heard
+    return {
+        "packets": nr_of_packets,
+        "catalog_sensors": len(registry.sensor_catalog),
+        "catalog_gateways": len(registry.gateway_catalog),
+        "sensors": len(registry.sensors),
+        "gateways": len(registry.gateways),
+        "foreign_devices": len(registry.foreign),
+    }
+
+
+def bench_localization(registry, repeats=3, max_single=2000):
+    sensors = [s for s in registry.sensors if len(s.avg_signals) >= 3]
+    if not sensors:
+        return {"sensors": 0}
+
+    # one sensor at a time, like the old per packet path
+    single = sensors[:max_single]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for sensor in single:
+            sensor.multilateration(sensor.avg_signals)
+        times.append((time.perf_counter() - start) / len(single))
+
+    # all sensors in one batch
+    batch_times = []
+    localizer = Localizer(interval=0)
+    for _ in range(repeats):
+        for sensor in sensors:
+            sensor.needs_localization = True
+        start = time.perf_counter()
+        localizer.run(sensors)
+        batch_times.append(time.perf_counter() - start)
+
+    return {
+        "sensors": len(sensors),
+        "single_solve_us": statistics.median(times) * 1e6,
+        "batch_seconds": statistics.median(batch_times),
+        "batch_solve_us": statistics.median(batch_times) / len(sensors) * 1e6,
+    }
+
+
+def bench_map(registry, repeats=3):
+    mapper = Mapper()
+    start = time.perf_counter()
+    snapshot = mapper.store.publish(registry.sensors, registry.gateways, coverage=registry.coverage)
+    publish = time.perf_counter() - start
+    times = []
+    fig = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fig = mapper.build_figure(snapshot)
+        times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    payload = fig.to_json()
+    serialize = time.perf_counter() - start
+    entry = FigureEntry(snapshot.version, payload.encode("utf-8"))
+    results = {
+        "snapshot_seconds": publish,
+        "build_seconds": statistics.median(times),
+        "serialize_seconds": serialize,
+        "payload_bytes": entry.size(),
+        "gzip_bytes": entry.size("gzip"),
+        "traces": len(fig.data),
+    }
+
+    # /map/view of a zoomed out and a zoomed in browser (clusters only when there are more than max_points)
+    for name, zoom in (("view_out", 11), ("view_in", 17)):
+        viewport = viewport_around(*mapper.location_center, zoom)
+        mapper.views.entries.clear()
+        start = time.perf_counter()
+        view = mapper.views.get(snapshot, viewport)
+        results[name + "_seconds"] = time.perf_counter() - start
+        results[name + "_bytes"] = view.size()
+        results[name + "_gzip_bytes"] = view.size("gzip")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    sensor_data, gateway_data = make_network(args.sensors, args.gateways, args.seed)
+    registry = Registry(sensor_data, gateway_data)
+    nr_of_packets = args.packets or max(20000, PACKETS_PER_SENSOR * args.sensors)
+    packets = make_packets(registry, nr_of_packets, args.gateways_per_packet, args.foreign, args.seed)
+
+    results = {}
+    if "decode" in args.suite:
+        results["decode"] = bench_decode(packets, repeats=args.repeats)
+
+    # the parser fills the registry, the other suites need that state. It gets decoded packets like in main.py
+    packets = [packet_decoding.Packet.from_dict(msg) for msg in packets]
+    parser_results = bench_parser(registry, packets)
+    results["network"] = network_size(registry, nr_of_packets)
+    if "parser" in args.suite:
+        results["parser"] = parser_results
+    if "localization" in args.suite:
+        results["localization"] = bench_localization(registry, args.repeats)
+    if "map" in args.suite:
+        results["map"] = bench_map(registry, args.repeats)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the parser, localization and map rendering")
+    parser.add_argument("--sensors", type=int, default=300)
+    parser.add_argument("--gateways", type=int, default=7)
+    parser.add_argument("--packets", type=int,
+                        help="number of packets (default %d per sensor, at least 20000)" % PACKETS_PER_SENSOR)
+    parser.add_argument("--gateways-per-packet", type=int, default=4)
+    parser.add_argument("--foreign", type=float, default=0.0, help="fraction of packets without device eui")
+    parser.add_argument("--suite", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.jsonl", help="json lines file the results are added to")
+    args = parser.parse_args()
+
+    results = run(args)
+    entry = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "results": results,
+    }
+    with open(args.out, "a") as file:
+        file.write(json.dumps(entry) + "\n")
+
+    print(json.dumps(results, indent=2))
+    print("[Benchmark]: results added to", os.path.abspath(args.out))
+
+
+if __name__ == "__main__":
+    main_cli()
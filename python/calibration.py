@@ -0,0 +1,108 @@
+# calibration
+# Fits the path loss model per gateway and per spreading factor in a background thread, instead of one model for
+# everything in the packet path. Gateways differ a lot (a gateway on a roof hears much further than one at street
+# level), and so do spreading factors.
+# The parser only updates the global path_loss (the fallback for everything, it has to be right from the first
+# packets on) and adds (gateway, sf, rssi, true distance) of known sensors to path_loss_models.observations.
+# Every interval seconds the CalibrationWorker takes all new observations and updates one recursive least squares
+# estimator (signals.PathLossEstimator) per key:
+#     (gateway, sf)      this gateway at this spreading factor
+#     (gateway, None)    this gateway, all spreading factors
+#     (None, sf)         all gateways at this spreading factor
+# A model is only published when it has enough observations, an n that makes sense and a small uncertainty. The
+# new table replaces the old one in one assignment (ModelTable.publish), the signals look up their model in it.
+
+import threading
+import time
+
+from metrics import metrics
+from signals import PathLossEstimator, path_loss, path_loss_models
+import logs
+
+log = logs.get_logger("calibration")
+
+
+class CalibrationWorker:
+    def __init__(self, table=path_loss_models, interval=30.0, min_observations=50, max_std=0.5, n_range=(1.5, 8.0),
+                 forgetting=0.9995):
+        self.table = table
+        self.interval = interval
+        self.min_observations = min_observations
+        # largest standard deviation of n we still trust
+        self.max_std = max_std
+        self.n_range = n_range
+        self.forgetting = forgetting
+        # (gateway, sf) -> PathLossEstimator, the global path_loss is updated by the parser
+        self.estimators = {}
+        self.thread = None
+        self.running = False
+        self.nr_of_observations = 0
+        self.nr_of_refits = 0
+
+        metrics.gauge("lora_calibration_models", "Path loss models in the published table",
+                      lambda: len(self.table.models))
+        metrics.gauge("lora_calibration_backlog", "Observations waiting for the calibration worker",
+                      lambda: len(self.table.observations))
+        self.refit_seconds = metrics.histogram("lora_calibration_refit_seconds", "Time of one calibration refit")
+
+    def estimator(self, key):
+        estimator = self.estimators.get(key)
+        if estimator is None:
+            # the power is fitted too, every gateway has its own antenna and cable losses
+            estimator = self.estimators[key] = PathLossEstimator(forgetting=self.forgetting, fit_power=True)
+        return estimator
+
+    def refit(self):
+        """"
+            Updates the estimators with all new observations and publishes the models that can be trusted,
+            returns the number of observations used
+        """
+        start = time.perf_counter()
+        observations = self.table.observations
+        count = 0
+        while observations:
+            gateway, sf, rssi, distance, timestamp = observations.popleft()
+            for key in ((gateway, sf), (gateway, None), (None, sf)):
+                self.estimator(key).update(rssi, distance, timestamp)
+            count += 1
+        if count == 0:
+            return 0
+
+        # models that are not good enough (yet) keep their last published version
+        models = dict(self.table.models)
+        for key, estimator in self.estimators.items():
+            if self.trusted(estimator):
+                models[key] = (estimator.power, estimator.n)
+        self.table.publish(models)
+
+        self.nr_of_observations += count
+        self.nr_of_refits += 1
+        elapsed = time.perf_counter() - start
+        self.refit_seconds.observe(elapsed)
+        log.info("Refit %d models with %d observations in %.3f s (global n %.3f)", len(models), count, elapsed,
+                 path_loss.n)
+        return count
+
+    def trusted(self, estimator):
+        return (estimator.nr_of_updates >= self.min_observations
+                and self.n_range[0] <= estimator.n <= self.n_range[1]
+                and estimator.confidence() <= self.max_std)
+
+    def start(self):
+        # from now on the parser queues the observations for the models per gateway and sf
+        self.table.background = True
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.table.background = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            try:
+                self.refit()
+            except Exception as e:
+                log.error("Calibration failed: %s", e)
@@ -0,0 +1,106 @@
+# capture files
+# A capture is the raw websocket feed written to disk, so we can replay it later (see replay.py).
+# The file starts with a small header and then has one record per frame:
+#     receive time (float64, seconds since epoch) | length (uint32) | raw frame (utf-8 bytes)
+# Records are only ever appended, so a capture can be extended by recording again into the same file and a
+# capture that was cut off (crash, ctrl-c) can still be read up to the last complete record.
+
+import os
+import struct
+import time
+
+MAGIC = b"LORACAP1"
+RECORD = struct.Struct("<dI")
+
+
+class CaptureWriter:
+    def __init__(self, path, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.nr_of_frames = 0
+
+        # only a new (empty) file gets the header, records are only appended to a file that is a capture
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new_file:
+            with open(path, "rb") as file:
+                if file.read(len(MAGIC)) != MAGIC:
+                    raise ValueError("%s is not a capture file" % path)
+        self.file = open(path, "ab")
+        if new_file:
+            self.file.write(MAGIC)
+
+    def write(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(frame, str):
+            frame = frame.encode("utf-8")
+        self.file.write(RECORD.pack(timestamp, len(frame)))
+        self.file.write(frame)
+
+        self.nr_of_frames += 1
+        if self.nr_of_frames % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_capture(path, offset=None, count=None):
+    """"
+        Yields (timestamp, frame) for every frame in the capture, frames are returned as str.
+        With offset and count only count frames from that position (see capture_chunks).
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        if offset is not None:
+            file.seek(offset)
+
+        while count is None or count > 0:
+            if count is not None:
+                count -= 1
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, length = RECORD.unpack(header)
+            frame = file.read(length)
+            if len(frame) < length:
+                # the last record was not written completely
+                return
+            yield timestamp, frame.decode("utf-8")
+
+
+def capture_chunks(path, chunk_size):
+    """"
+        (offset, count) of every chunk_size frames of the capture, for read_capture. Only the record headers are
+        read, the frames are skipped.
+    """
+    chunks = []
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        size = os.fstat(file.fileno()).st_size
+        offset, count = file.tell(), 0
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            _, length = RECORD.unpack(header)
+            end = file.tell() + length
+            if end > size:
+                # the last record was not written completely
+                break
+            file.seek(end)
+            count += 1
+            if count == chunk_size:
+                chunks.append((offset, count))
+                offset, count = end, 0
+    if count:
+        chunks.append((offset, count))
+    return chunks
@@ -0,0 +1,87 @@
+# figure cache
+# The map figure only depends on the state snapshot, so for every snapshot version we build the figure once,
+# turn it into json once and compress it once. Every browser showing the map gets the same bytes.
+# Only the last few versions are kept, older ones are dropped first.
+
+from collections import OrderedDict
+import gzip
+import threading
+import time
+
+from metrics import metrics, SIZE_BUCKETS
+import logs
+
+log = logs.get_logger("mapper")
+build_seconds = metrics.histogram("lora_map_build_seconds", "Time to build, serialize and compress the map figure")
+figure_bytes = metrics.histogram("lora_map_figure_bytes", "Size of the map figure json", SIZE_BUCKETS)
+
+# brotli is optional, without it we only serve gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class FigureEntry:
+    def __init__(self, version, json_bytes):
+        self.version = version
+        self.etag = '"map-%d"' % version
+        self.bodies = {"identity": json_bytes, "gzip": gzip.compress(json_bytes, compresslevel=6)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(json_bytes, quality=5)
+
+    def body(self, encoding):
+        return self.bodies[encoding]
+
+    def size(self, encoding="identity"):
+        return len(self.bodies[encoding])
+
+
+class FigureCache:
+    def __init__(self, build_figure, maxsize=4):
+        # build_figure(snapshot) -> plotly figure
+        self.build_figure = build_figure
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, snapshot):
+        entry = self.entries.get(snapshot.version)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        # only one thread builds, the other viewers wait and then get the same entry
+        with self.lock:
+            entry = self.entries.get(snapshot.version)
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+            self.misses += 1
+            start = time.perf_counter()
+            figure = self.build_figure(snapshot)
+            entry = FigureEntry(snapshot.version, figure.to_json().encode("utf-8"))
+            elapsed = time.perf_counter() - start
+            build_seconds.observe(elapsed)
+            figure_bytes.observe(entry.size())
+            log.debug("Built figure version %d in %.3f s (%d bytes, %d gzip)", snapshot.version, elapsed,
+                      entry.size(), entry.size("gzip"))
+            self.entries[snapshot.version] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return entry
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+def pick_encoding(accept_encoding, available):
+    # the best compression the browser accepts
+    accepted = {part.split(";")[0].strip() for part in (accept_encoding or "").split(",")}
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in available:
+            return encoding
+    return "identity"
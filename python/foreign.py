@@ -0,0 +1,141 @@
+# foreign devices
+# Most packets on the network come from devices we do not know: they have no device_eui, only the short
+# device_addr. The ForeignTracker keeps per gateway statistics for every address and a position when 3 or more
+# gateways hear it. There can be a lot of short lived addresses, so the table is an LRU: every packet moves its
+# device to the end, devices not heard for ttl seconds are dropped from the front and when the table is full the
+# least recently heard device is dropped. Memory stays capped no matter how many addresses show up.
+
+from collections import OrderedDict, deque
+import time
+
+import numpy as np
+
+from localization import GatewayDistance, combine_with_fixes, geometry_cache, solve_grouped
+from signals import GatewayStats, Signal, fix_history
+
+
+class ForeignDevice:
+    __slots__ = ("addr", "first_seen", "last_seen", "nr_of_packets", "gateway_stats", "lat", "lon", "fixes",
+                 "nr_of_fixes", "needs_localization")
+
+    def __init__(self, addr, now):
+        self.addr = addr
+        self.first_seen = now
+        self.last_seen = now
+        self.nr_of_packets = 0
+        # gateway eui -> GatewayStats
+        self.gateway_stats = {}
+        self.lat = None
+        self.lon = None
+        self.fixes = deque(maxlen=fix_history)
+        self.nr_of_fixes = 0
+        self.needs_localization = False
+
+    def is_located(self):
+        return self.lat is not None
+
+    def add_fix(self, lat, lon):
+        # the position of a single uplink, combined with the estimate by localize
+        self.fixes.append((lat, lon))
+        self.nr_of_fixes += 1
+        self.needs_localization = True
+
+
+class ForeignTracker:
+    def __init__(self, max_devices=50000, ttl=3600.0, interval=2.0, min_gateways=3):
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self.interval = interval
+        self.min_gateways = min_gateways
+        # addr -> ForeignDevice, least recently heard first
+        self.devices = OrderedDict()
+        self.nr_of_packets = 0
+        self.nr_of_evicted = 0
+        self.last_localize = 0.0
+
+    def add(self, packet, gateway_record, now=None):
+        """"
+            Adds one packet (packets.Packet) of a foreign device received by a known gateway, returns the device
+        """
+        if now is None:
+            now = time.time()
+        addr = packet.device_addr
+
+        device = self.devices.get(addr)
+        if device is None:
+            device = self.devices[addr] = ForeignDevice(addr, now)
+        else:
+            self.devices.move_to_end(addr)
+        device.last_seen = now
+        device.nr_of_packets += 1
+        self.nr_of_packets += 1
+
+        signal = Signal(gateway_record.eui, packet.rssi, gateway_record.lon, gateway_record.lat, packet.snr, now,
+                        sf=packet.sf)
+        stats = device.gateway_stats.get(gateway_record.eui)
+        if stats is None:
+            stats = device.gateway_stats[gateway_record.eui] = GatewayStats(gateway_record.eui)
+        stats.add(signal)
+        device.needs_localization = True
+
+        self.evict(now)
+        return device
+
+    def evict(self, now=None):
+        if now is None:
+            now = time.time()
+        # the front is the least recently heard, stop at the first device that is still alive
+        while self.devices:
+            addr, device = next(iter(self.devices.items()))
+            if device.last_seen + self.ttl > now and len(self.devices) <= self.max_devices:
+                break
+            del self.devices[addr]
+            self.nr_of_evicted += 1
+
+    def get(self, addr):
+        return self.devices.get(addr.lower())
+
+    def add_fix(self, addr, lat, lon):
+        device = self.get(addr)
+        if device is not None:
+            device.add_fix(lat, lon)
+
+    def located(self):
+        return [device for device in self.devices.values() if device.is_located()]
+
+    def maybe_localize(self, registry, now=None):
+        if now is None:
+            now = time.time()
+        if now - self.last_localize < self.interval:
+            return 0
+        self.last_localize = now
+        return self.localize(registry)
+
+    def localize(self, registry, cache=geometry_cache):
+        """"
+            Position from the average distances, for devices that were heard by enough different gateways over
+            time, refined with their uplink fixes when those agree
+        """
+        todo = []
+        signal_lists = []
+        for device in self.devices.values():
+            if not device.needs_localization or len(device.gateway_stats) < self.min_gateways:
+                continue
+            device.needs_localization = False
+            todo.append(device)
+            signal_lists.append([GatewayDistance(eui, record.lat, record.lon, stats.distance.mean)
+                                 for eui, stats in device.gateway_stats.items()
+                                 for record in (registry.lookup_gateway(eui),)])
+        if not todo:
+            return 0
+
+        count = 0
+        lats, lons = solve_grouped(signal_lists, cache)
+        for device, lat, lon in zip(todo, lats.tolist(), lons.tolist()):
+            if not (np.isnan(lat) or np.isnan(lon)):
+                device.lat, device.lon = combine_with_fixes(lat, lon, device.fixes)
+                count += 1
+        return count
+
+    def __len__(self):
+        return len(self.devices)
@@ -0,0 +1,167 @@
+# heatmap
+# The rssi heatmap of the map. Every reception is put in a cell of a fixed grid around campus (at the position of
+# the sensor: the catalog position of known sensors, the estimate of the others), the grid keeps per cell the
+# weighted number of receptions and the weighted sums of their rssi and snr.
+# Old receptions count less: their weight halves every half_life seconds. Instead of multiplying the whole grid
+# every time, a new reception is added with weight 2 ** ((t - epoch) / half_life), so the sums never have to be
+# touched for the decay itself. Only the totals are scaled back when they get too large (rebase).
+# The receptions of a batch are added in one numpy call. The map shows the cells as one density layer, so drawing
+# it costs the same for 300 or 300k receptions: it only depends on the number of cells that have receptions.
+
+import math
+import time
+
+import numpy as np
+
+from state import CoverageView, EMPTY_COVERAGE
+
+# meters per degree latitude, the cells are about cell_size meters wide (good enough for a heatmap)
+METERS_PER_DEGREE = 111320.0
+
+
+class CoverageGrid:
+    def __init__(self, south, west, north, east, cell_size=25.0, half_life=3600.0, max_cells=1000,
+                 rssi_range=(-130.0, -60.0), interval=5.0, refresh=60.0):
+        # a larger area gets larger cells, so the grid never has more than max_cells per side
+        mid_lat = math.radians((south + north) / 2)
+        height = (north - south) * METERS_PER_DEGREE
+        width = (east - west) * METERS_PER_DEGREE * math.cos(mid_lat)
+        cell_size = max(cell_size, height / max_cells, width / max_cells)
+        self.cell_lat = cell_size / METERS_PER_DEGREE
+        self.cell_lon = cell_size / (METERS_PER_DEGREE * math.cos(mid_lat))
+        self.cell_size = cell_size
+        self.south, self.west = south, west
+        self.rows = max(int(math.ceil((north - south) / self.cell_lat)), 1)
+        self.cols = max(int(math.ceil((east - west) / self.cell_lon)), 1)
+
+        # weighted receptions, rssi and snr sums per cell (scaled to the epoch, see above)
+        self.weight = np.zeros((self.rows, self.cols))
+        self.rssi_sum = np.zeros((self.rows, self.cols))
+        self.snr_sum = np.zeros((self.rows, self.cols))
+        self.snr_weight = np.zeros((self.rows, self.cols))
+        self.half_life = half_life
+        self.epoch = time.time()
+
+        # the rssi that is shown as no coverage and as full coverage
+        self.rssi_range = rssi_range
+        # receptions since the last flush, (lat, lon, rssi, snr)
+        self.pending = []
+        self.nr_of_receptions = 0
+        self.nr_of_outside = 0
+
+        # the view is made at most once per interval seconds, the map does not need every reception. Without new
+        # receptions it is made again every refresh seconds, so the map shows the cells fading out
+        self.interval = interval
+        self.refresh = refresh
+        self.view_cache = EMPTY_COVERAGE
+        self.view_time = 0.0
+        self.changed = False
+
+    @classmethod
+    def around(cls, lats, lons, margin=1000.0, **kwargs):
+        # grid over the given positions (e.g. the catalog) with a margin in meters, campus when there are none
+        points = [(lat, lon) for lat, lon in zip(lats, lons) if not (math.isnan(lat) or math.isnan(lon))]
+        if not points:
+            points = [(52.2394, 6.8566)]
+        south = min(p[0] for p in points)
+        north = max(p[0] for p in points)
+        west = min(p[1] for p in points)
+        east = max(p[1] for p in points)
+        d_lat = margin / METERS_PER_DEGREE
+        d_lon = margin / (METERS_PER_DEGREE * math.cos(math.radians((south + north) / 2)))
+        return cls(south - d_lat, west - d_lon, north + d_lat, east + d_lon, **kwargs)
+
+    def add(self, lat, lon, rssi, snr=None):
+        # cheap, the reception is binned by flush
+        self.pending.append((lat, lon, rssi, np.nan if snr is None else snr))
+
+    def flush(self, now=None):
+        """"
+            Bins the pending receptions, call this with the ingest lock held (once per batch)
+        """
+        if not self.pending:
+            return 0
+        if now is None:
+            now = time.time()
+        receptions = np.array(self.pending, dtype=float)
+        self.pending = []
+
+        # keep the weights in range, 2 ** 40 leaves plenty of precision
+        if (now - self.epoch) / self.half_life > 40:
+            self.rebase(now)
+
+        rows = np.floor((receptions[:, 0] - self.south) / self.cell_lat).astype(int)
+        cols = np.floor((receptions[:, 1] - self.west) / self.cell_lon).astype(int)
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        self.nr_of_outside += int(len(receptions) - inside.sum())
+        rows, cols, receptions = rows[inside], cols[inside], receptions[inside]
+        if not len(receptions):
+            return 0
+
+        # np.add.at adds every reception, also when several fall in the same cell
+        weight = 2.0 ** ((now - self.epoch) / self.half_life)
+        np.add.at(self.weight, (rows, cols), weight)
+        np.add.at(self.rssi_sum, (rows, cols), weight * receptions[:, 2])
+        has_snr = ~np.isnan(receptions[:, 3])
+        np.add.at(self.snr_sum, (rows[has_snr], cols[has_snr]), weight * receptions[has_snr, 3])
+        np.add.at(self.snr_weight, (rows[has_snr], cols[has_snr]), weight)
+        self.nr_of_receptions += len(receptions)
+        self.changed = True
+        return len(receptions)
+
+    def rebase(self, now):
+        # scale the sums to a new epoch, the means do not change
+        factor = 2.0 ** (-(now - self.epoch) / self.half_life)
+        for grid in (self.weight, self.rssi_sum, self.snr_sum, self.snr_weight):
+            grid *= factor
+        self.epoch = now
+
+    def decayed_weight(self, now=None):
+        # weighted number of receptions per cell at this time
+        if now is None:
+            now = time.time()
+        return self.weight * 2.0 ** (-(now - self.epoch) / self.half_life)
+
+    def cells(self, now=None, min_weight=0.01):
+        """"
+            (lat, lon, strength, mean rssi) arrays of the cells with receptions, the lat/lon is the center of the
+            cell. The strength (0 to 1) is the mean rssi in the rssi range, faded out when the cell has (almost)
+            no recent receptions.
+        """
+        weight = self.decayed_weight(now)
+        rows, cols = np.nonzero(weight > min_weight)
+        weight = weight[rows, cols]
+        rssi = self.rssi_sum[rows, cols] / self.weight[rows, cols]
+        low, high = self.rssi_range
+        strength = np.clip((rssi - low) / (high - low), 0.0, 1.0) * (1.0 - 2.0 ** -weight)
+        lats = self.south + (rows + 0.5) * self.cell_lat
+        lons = self.west + (cols + 0.5) * self.cell_lon
+        return lats, lons, strength, rssi
+
+    def view(self, now=None):
+        """"
+            The cells as a read only CoverageView for the state snapshots. A new view (with a new version) is made
+            when there were new receptions and the last one is older than interval seconds, or when the last one
+            still has cells and is older than refresh seconds (they faded since). Otherwise the last view is
+            returned.
+        """
+        if now is None:
+            now = time.time()
+        self.flush(now)
+        age = now - self.view_time
+        if age < self.interval or (not self.changed and (age < self.refresh or not self.view_cache.lat)):
+            return self.view_cache
+        lats, lons, strength, rssi = self.cells(now)
+        self.view_cache = CoverageView(
+            self.view_cache.version + 1,
+            tuple(np.round(lats, 6).tolist()),
+            tuple(np.round(lons, 6).tolist()),
+            tuple(np.round(strength, 3).tolist()),
+            tuple(np.round(rssi, 1).tolist()),
+        )
+        self.view_time = now
+        self.changed = False
+        return self.view_cache
+
+    def nr_of_cells(self):
+        return int(np.count_nonzero(self.weight))
@@ -0,0 +1,198 @@
+# ingest pipeline
+# Reads the lora websocket feed and hands the packets to the parser without letting a slow parser stall the socket.
+#     receiver task -> bounded queue -> consumer task(s) -> decode to packets -> handle_batch (in a worker thread)
+# The receiver only reads frames and puts them in the queue. When the queue is full the oldest frame is dropped
+# (or, with block_when_full, the receiver waits, which pushes back on the websocket).
+# The consumers take frames from the queue in batches, decode them and call handle_batch in a worker thread,
+# so the event loop (and the receiver) keeps running while the batch is processed.
+# When the connection drops we reconnect with exponential backoff, errors in a packet never stop the feed.
+# With a recorder (capture.CaptureWriter) every received frame is also written to a capture file.
+
+import asyncio
+import random
+import threading
+import time
+
+import websockets
+
+from packets import decode_frames
+from metrics import metrics
+import logs
+
+log = logs.get_logger("ingest")
+
+
+class IngestStats:
+    def __init__(self):
+        self.received = 0
+        self.dropped = 0
+        self.decoded = 0
+        self.decode_errors = 0
+        self.processed = 0
+        self.errors = 0
+        self.batches = 0
+        self.connects = 0
+        self.max_depth = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class IngestPipeline:
+    def __init__(self, url, handle_batch, queue_size=10000, batch_size=100, consumers=1, block_when_full=False,
+                 reconnect_delay=1.0, max_reconnect_delay=60.0, report_interval=60.0, recorder=None):
+        self.url = url
+        self.recorder = recorder
+        # called with a list of decoded packets (packets.Packet) from a worker thread, never two batches at once
+        self.handle_batch = handle_batch
+
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.consumers = consumers
+        self.block_when_full = block_when_full
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.report_interval = report_interval
+
+        self.stats = IngestStats()
+        self.queue = None
+        self.loop = None
+        self.running = False
+        self.handle_lock = threading.Lock()
+        self.add_metrics()
+
+    def add_metrics(self):
+        # the stats are counted anyway, the metrics only read them when /metrics is scraped
+        stats = self.stats
+        metrics.counter("lora_packets_received_total", "Frames read from the websocket", lambda: stats.received)
+        metrics.counter("lora_packets_decoded_total", "Frames decoded into packets", lambda: stats.decoded)
+        metrics.counter("lora_packets_dropped_total", "Frames dropped because the queue was full",
+                        lambda: stats.dropped)
+        metrics.counter("lora_decode_errors_total", "Frames that could not be decoded", lambda: stats.decode_errors)
+        metrics.counter("lora_batch_errors_total", "Batches the parser failed on", lambda: stats.errors)
+        metrics.counter("lora_connects_total", "Websocket connections made", lambda: stats.connects)
+        metrics.gauge("lora_queue_depth", "Frames waiting in the ingest queue", self.depth)
+        metrics.gauge("lora_queue_max_depth", "Highest queue depth seen", lambda: stats.max_depth)
+        self.batch_seconds = metrics.histogram("lora_batch_seconds", "Time to handle one batch of packets")
+
+    def run(self):
+        # blocking, use this as the target of the ingest thread
+        asyncio.run(self.main())
+
+    def stop(self):
+        # can be called from any thread
+        self.running = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(lambda: None)
+
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.running = True
+
+        tasks = [asyncio.create_task(self.receiver())]
+        tasks += [asyncio.create_task(self.consumer()) for _ in range(self.consumers)]
+        if self.report_interval:
+            tasks.append(asyncio.create_task(self.reporter()))
+
+        try:
+            while self.running:
+                await asyncio.sleep(0.5)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.recorder is not None:
+                self.recorder.close()
+
+    async def receiver(self):
+        delay = self.reconnect_delay
+        while self.running:
+            try:
+                async with websockets.connect(self.url) as websocket:
+                    self.stats.connects += 1
+                    log.info("Connected to %s", self.url)
+                    delay = self.reconnect_delay
+                    async for frame in websocket:
+                        await self.put(frame)
+                        if not self.running:
+                            break
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                # connection refused, dropped, bad handshake... wait and try again
+                log.warning("Connection lost: %s", e)
+
+            if not self.running:
+                break
+
+            # exponential backoff with some jitter so many clients do not reconnect at the same moment
+            wait = delay * random.uniform(0.5, 1.5)
+            log.info("Reconnecting in %.1f s", wait)
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def put(self, frame):
+        self.stats.received += 1
+        if self.recorder is not None:
+            self.recorder.write(frame)
+        if self.block_when_full:
+            await self.queue.put(frame)
+        else:
+            if self.queue.full():
+                # drop the oldest frame, new packets are more interesting than old ones
+                self.queue.get_nowait()
+                self.stats.dropped += 1
+            self.queue.put_nowait(frame)
+        self.stats.max_depth = max(self.stats.max_depth, self.queue.qsize())
+
+    async def next_batch(self):
+        # wait for one frame, then take whatever else is already waiting (up to batch_size)
+        batch = [await self.queue.get()]
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    def decode(self, frames):
+        # the whole batch at once, see packets.decode_frames
+        packets, errors = decode_frames(frames)
+        self.stats.decode_errors += errors
+        self.stats.decoded += len(packets)
+        return packets
+
+    async def consumer(self):
+        while self.running:
+            frames = await self.next_batch()
+            messages = self.decode(frames)
+            if messages:
+                await asyncio.to_thread(self.process, messages)
+
+    def process(self, messages):
+        with self.handle_lock:
+            start = time.perf_counter()
+            try:
+                self.handle_batch(messages)
+                self.stats.processed += len(messages)
+            except Exception as e:
+                # a bad batch should never stop the feed
+                self.stats.errors += 1
+                log.error("Could not handle batch of %d messages: %s", len(messages), e)
+            self.stats.batches += 1
+            self.batch_seconds.observe(time.perf_counter() - start)
+
+    async def reporter(self):
+        last = time.time()
+        last_processed = 0
+        while self.running:
+            await asyncio.sleep(self.report_interval)
+            now = time.time()
+            rate = (self.stats.processed - last_processed) / (now - last)
+            log.info("%.1f packets/s, queue %d/%d, dropped %d, decode errors %d, errors %d",
+                     rate, self.depth(), self.queue_size, self.stats.dropped, self.stats.decode_errors,
+                     self.stats.errors)
+            last, last_processed = now, self.stats.processed
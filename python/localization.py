@@ -0,0 +1,325 @@
+# localization
+# Estimates the position of sensors from their distance to 3 or more gateways (multilateration).
+# Instead of solving one sensor at a time on every packet, the Localizer collects all sensors that got new
+# signals and solves all of them in one numpy pass every few seconds.
+#
+# For one sensor the equations are linearised by subtracting the circle of the first gateway from the others:
+#     2 (xi - x1) x + 2 (yi - y1) y = (r1^2 - ri^2) - (x1^2 - xi^2 + y1^2 - yi^2)
+# which gives a small weighted least squares problem A p = b. We stack the 2x2 normal equations of all sensors
+# and solve them together.
+# A only depends on the gateways, so the GeometryCache keeps the projection and A for sets of gateways that many
+# sensors share. Solving such a group then only needs the distances. With many gateways almost every sensor has
+# its own set and building a geometry per sensor costs more than it saves: solve_grouped only builds a geometry
+# for groups of at least min_group sensors (or uses one that is cached already), everything else is solved in one
+# multilaterate_batch call.
+
+from collections import OrderedDict, namedtuple
+from operator import attrgetter
+import math
+import time
+import numpy as np
+
+from metrics import metrics
+import logs
+
+log = logs.get_logger("localization")
+localize_seconds = metrics.histogram("lora_localization_seconds", "Time of one batched multilateration run")
+localized_sensors = metrics.counter("lora_localized_sensors_total", "Sensor positions estimated by the localizer")
+
+R = 6371000  # Earth radius in meters
+
+# a gateway with its position and the (average) distance to it, for everything that is not a Signal
+GatewayDistance = namedtuple("GatewayDistance", ["eui_of_gateway", "lat", "lon", "distance"])
+
+
+def latlon_to_xy(lat_deg, lon_deg, lat0_deg, lon0_deg):
+    # same projection as Sensor.latlon_to_xy, but works on whole arrays
+    x = np.radians(lon_deg - lon0_deg) * R * np.cos(np.radians(lat0_deg))
+    y = np.radians(lat_deg - lat0_deg) * R
+    return x, y
+
+
+def xy_to_latlon(x, y, lat0_deg, lon0_deg):
+    # same projection as Sensor.xy_to_latlon, but works on whole arrays
+    lat = lat0_deg + (y / R) * (180 / np.pi)
+    lon = lon0_deg + (x / (R * np.cos(np.radians(lat0_deg)))) * (180 / np.pi)
+    return lat, lon
+
+
+def solve_normal_equations(m_xx, m_xy, m_yy, v_x, v_y, max_condition=1e8):
+    """"
+        Closed form solution of many symmetric 2x2 systems [[m_xx, m_xy], [m_xy, m_yy]] p = [v_x, v_y].
+        Returns x, y and a mask of the systems that were well conditioned (the others are nan)
+    """
+    det = m_xx * m_yy - m_xy ** 2
+    trace = m_xx + m_yy
+    spread = np.sqrt(np.maximum((m_xx - m_yy) ** 2 + 4 * m_xy ** 2, 0.0))
+    small = (trace - spread) / 2
+    large = (trace + spread) / 2
+    good = (small > 0) & (large <= small * max_condition)
+
+    safe_det = np.where(good, det, 1.0)
+    px = np.where(good, (m_yy * v_x - m_xy * v_y) / safe_det, np.nan)
+    py = np.where(good, (m_xx * v_y - m_xy * v_x) / safe_det, np.nan)
+    return px, py, good
+
+
+def multilaterate_batch(lats, lons, distances, mask=None, max_condition=1e8):
+    """"
+        Solves the position of many sensors at once.
+        lats, lons, distances: (sensors, gateways) arrays with the gateway positions and the distance estimates,
+        mask: which entries are used (rows may have a different number of gateways), the first column of every
+        row must be valid as it is used as reference. Returns (lat, lon) arrays, nan where a row has < 3 gateways.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    if mask is None:
+        mask = np.ones(lats.shape, dtype=bool)
+    count = mask.sum(axis=1)
+
+    # local projection around the centroid of the gateways of every sensor
+    lat0 = np.where(mask, lats, 0).sum(axis=1) / np.maximum(count, 1)
+    lon0 = np.where(mask, lons, 0).sum(axis=1) / np.maximum(count, 1)
+    x, y = latlon_to_xy(lats, lons, lat0[:, None], lon0[:, None])
+
+    # equations relative to the first gateway
+    x1, y1, r1 = x[:, :1], y[:, :1], distances[:, :1]
+    ax = 2 * (x[:, 1:] - x1)
+    ay = 2 * (y[:, 1:] - y1)
+    b = (r1 ** 2 - distances[:, 1:] ** 2) - (x1 ** 2 - x[:, 1:] ** 2 + y1 ** 2 - y[:, 1:] ** 2)
+
+    # Weight inversely proportional to distance squared (more trust in nearby gateways), padding gets weight 0
+    with np.errstate(divide='ignore'):
+        w = np.where(mask[:, 1:], 1 / distances[:, 1:] ** 2, 0.0)
+    w = np.nan_to_num(w, nan=0.0, posinf=0.0)
+
+    # stacked normal equations (A^T W A) p = A^T W b, only the three unique values of the 2x2 matrix
+    m_xx = (w * ax * ax).sum(axis=1)
+    m_xy = (w * ax * ay).sum(axis=1)
+    m_yy = (w * ay * ay).sum(axis=1)
+    v_x = (w * ax * b).sum(axis=1)
+    v_y = (w * ay * b).sum(axis=1)
+    px, py, good = solve_normal_equations(m_xx, m_xy, m_yy, v_x, v_y, max_condition)
+    solvable = count >= 3
+    good &= solvable
+
+    # fallback for (almost) colinear gateways: minimum norm least squares, which stays close to the centroid
+    for i in np.flatnonzero(solvable & ~good):
+        sw = np.sqrt(w[i])
+        A = np.column_stack((ax[i] * sw, ay[i] * sw))
+        result, _, _, _ = np.linalg.lstsq(A, b[i] * sw, rcond=1 / max_condition)
+        px[i], py[i] = result
+
+    return xy_to_latlon(px, py, lat0, lon0)
+
+
+def pack_signals(signal_lists):
+    """"
+        Packs lists of (average) signals into padded (sensors, gateways) arrays for multilaterate_batch
+    """
+    width = max((len(signals) for signals in signal_lists), default=0)
+    lats = np.zeros((len(signal_lists), width))
+    lons = np.zeros((len(signal_lists), width))
+    distances = np.ones((len(signal_lists), width))
+    mask = np.zeros((len(signal_lists), width), dtype=bool)
+    for i, signals in enumerate(signal_lists):
+        k = len(signals)
+        lats[i, :k] = [s.lat for s in signals]
+        lons[i, :k] = [s.lon for s in signals]
+        distances[i, :k] = [s.distance for s in signals]
+        mask[i, :k] = True
+    return lats, lons, distances, mask
+
+
+class Geometry:
+    """"
+        Everything of the multilateration that only depends on the gateways: the projection origin,
+        the projected gateway positions, A and the parts of the normal equations that come from A.
+        The first gateway is the reference.
+    """
+    def __init__(self, euis, lats, lons, max_condition=1e8):
+        self.euis = tuple(euis)
+        self.max_condition = max_condition
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+
+        self.lat0 = lats.mean()
+        self.lon0 = lons.mean()
+        x, y = latlon_to_xy(lats, lons, self.lat0, self.lon0)
+        self.x, self.y = x, y
+
+        # design matrix and the part of b that does not depend on the distances
+        self.A = np.column_stack((2 * (x[1:] - x[0]), 2 * (y[1:] - y[0])))
+        self.offset = -(x[0] ** 2 - x[1:] ** 2 + y[0] ** 2 - y[1:] ** 2)
+
+        # rows of A^T A per equation, so A^T W A is a single (weights @ outer) product
+        ax, ay = self.A[:, 0], self.A[:, 1]
+        self.outer = np.column_stack((ax * ax, ax * ay, ay * ay))
+
+        # pseudo inverse for the ill conditioned fallback (minimum norm, stays close to the centroid)
+        self.pinv = np.linalg.pinv(self.A, rcond=1 / max_condition)
+
+    def solve(self, distances):
+        """"
+            distances: (sensors, gateways) array in the order of self.euis, returns (lat, lon) arrays
+        """
+        distances = np.atleast_2d(np.asarray(distances, dtype=float))
+        b = distances[:, :1] ** 2 - distances[:, 1:] ** 2 + self.offset
+        w = 1 / distances[:, 1:] ** 2
+
+        # A^T W A and A^T W b for every row at once
+        m = w @ self.outer
+        v = (w * b) @ self.A
+        px, py, good = solve_normal_equations(m[:, 0], m[:, 1], m[:, 2], v[:, 0], v[:, 1], self.max_condition)
+
+        if not good.all():
+            fallback = b[~good] @ self.pinv.T
+            px[~good] = fallback[:, 0]
+            py[~good] = fallback[:, 1]
+
+        return xy_to_latlon(px, py, self.lat0, self.lon0)
+
+
+class GeometryCache:
+    """"
+        LRU cache of Geometry objects keyed by the (sorted) tuple of gateway euis.
+        Gateways do not move, so a geometry never has to be invalidated.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.geometries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        # the cached geometry of this tuple of gateway euis, None when there is none (nothing is built)
+        geometry = self.geometries.get(key)
+        if geometry is not None:
+            self.hits += 1
+            self.geometries.move_to_end(key)
+        return geometry
+
+    def get(self, signals):
+        # signals must be sorted by gateway eui, see sort_signals
+        key = tuple(s.eui_of_gateway for s in signals)
+        geometry = self.lookup(key)
+        if geometry is not None:
+            return geometry
+
+        self.misses += 1
+        geometry = Geometry(key, [s.lat for s in signals], [s.lon for s in signals])
+        self.geometries[key] = geometry
+        if len(self.geometries) > self.maxsize:
+            self.geometries.popitem(last=False)
+        return geometry
+
+    def __len__(self):
+        return len(self.geometries)
+
+
+# shared cache, used by the Localizer and Sensor.multilateration
+geometry_cache = GeometryCache()
+
+
+by_gateway = attrgetter("eui_of_gateway")
+
+
+def sort_signals(signals):
+    # the same set of gateways always gives the same key (and the same reference gateway)
+    return sorted(signals, key=by_gateway)
+
+
+def multilaterate_signals(signals, cache=geometry_cache):
+    """"
+        Position of one sensor from its (average) signals, using the geometry cache
+    """
+    signals = sort_signals(signals)
+    lat, lon = cache.get(signals).solve([[s.distance for s in signals]])
+    return float(lat[0]), float(lon[0])
+
+
+def solve_grouped(signal_lists, cache=geometry_cache, min_group=4):
+    """"
+        Positions of many sensors from their lists of (average) signals, anything with eui_of_gateway, lat, lon and
+        distance. Returns (lat, lon) arrays in the order of signal_lists, nan where there is no solution.
+    """
+    lats = np.full(len(signal_lists), np.nan)
+    lons = np.full(len(signal_lists), np.nan)
+    sorted_lists = [sort_signals(signals) for signals in signal_lists]
+
+    # group the lists by their set of gateways
+    groups = {}
+    for i, signals in enumerate(sorted_lists):
+        groups.setdefault(tuple(s.eui_of_gateway for s in signals), []).append(i)
+
+    # every group with a (cached or worth building) geometry is one matrix product
+    rest = []
+    for key, members in groups.items():
+        geometry = cache.lookup(key)
+        if geometry is None and len(members) >= min_group:
+            geometry = cache.get(sorted_lists[members[0]])
+        if geometry is None:
+            rest += members
+            continue
+        lats[members], lons[members] = geometry.solve([[s.distance for s in sorted_lists[i]] for i in members])
+
+    # the rest together in one padded batch
+    if rest:
+        lats[rest], lons[rest] = multilaterate_batch(*pack_signals([sorted_lists[i] for i in rest]))
+    return lats, lons
+
+
+def combine_with_fixes(lat, lon, fixes, agree_distance=300.0):
+    """"
+        The position from the average distances, moved halfway to the median of the uplink fixes when that median
+        is within agree_distance meters of it. Single fixes have large outliers, even their median can be far off.
+    """
+    if not fixes:
+        return lat, lon
+    fix_lat, fix_lon = np.median(np.asarray(fixes), axis=0).tolist()
+    x, y = latlon_to_xy(fix_lat, fix_lon, lat, lon)
+    if math.hypot(x, y) > agree_distance:
+        return lat, lon
+    return (lat + fix_lat) / 2, (lon + fix_lon) / 2
+
+
+class Localizer:
+    """"
+        Estimates the position of all sensors that received new signals, at most once every interval seconds
+    """
+    def __init__(self, interval=2.0, min_gateways=3, cache=geometry_cache):
+        self.cache = cache
+        self.interval = interval
+        self.min_gateways = min_gateways
+        self.last_run = 0.0
+        self.nr_of_solves = 0
+
+    def maybe_run(self, sensors, now=None):
+        # call this as often as you like, it only solves when the interval has passed
+        if now is None:
+            now = time.time()
+        if now - self.last_run < self.interval:
+            return 0
+        self.last_run = now
+        return self.run(sensors)
+
+    def run(self, sensors):
+        # only the sensors with new signals (or uplink fixes) and enough gateways
+        todo = [s for s in sensors if s.needs_localization and len(s.avg_signals) >= self.min_gateways]
+        if not todo:
+            return 0
+        start = time.perf_counter()
+
+        est_lats, est_lons = solve_grouped([sensor.avg_signals for sensor in todo], self.cache)
+        for sensor, lat, lon in zip(todo, est_lats.tolist(), est_lons.tolist()):
+            sensor.needs_localization = False
+            if not (np.isnan(lat) or np.isnan(lon)):
+                sensor.lat, sensor.lon = combine_with_fixes(lat, lon, sensor.fixes)
+                sensor.localized = True
+
+        self.nr_of_solves += len(todo)
+        localize_seconds.observe(time.perf_counter() - start)
+        localized_sensors.inc(len(todo))
+        log.debug("Estimated %d sensors", len(todo))
+        return len(todo)
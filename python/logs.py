@@ -0,0 +1,135 @@
+# logging
+# Every component logs to its own logger (lora.parser, lora.calibration, lora.localization, lora.mapper, ...),
+# so the level can be set per component:
+#     python main.py --log info,parser=debug
+#     LORA_LOG=warning,localization=debug python main.py
+# The lines look like the old prints: "[Parser]: Added new sensor to list".
+# Messages that come from the hot path (once per packet) are rate limited: the same message (same format string)
+# is written at most burst times per interval seconds, the next one that gets through says how many were skipped.
+# Instead of a line per packet there are summary lines (see Summary) with the packet rate and what was new.
+
+import logging
+import os
+import threading
+import time
+
+COMPONENTS = ("main", "ingest", "parser", "calibration", "localization", "mapper", "registry")
+
+
+def get_logger(component):
+    return logging.getLogger("lora." + component)
+
+
+class ComponentFormatter(logging.Formatter):
+    def format(self, record):
+        component = record.name.rsplit(".", 1)[-1].capitalize()
+        text = "[%s]: %s" % (component, record.getMessage())
+        if record.levelno >= logging.WARNING:
+            text = "[%s]: %s: %s" % (component, record.levelname, record.getMessage())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=10.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (logger name, format string) -> [start of the window, passed in this window, skipped]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = record.created
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                skipped = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+            else:
+                skipped = 0
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        if skipped:
+            record.msg = "%s (%d more like this skipped)" % (record.msg, skipped)
+        return True
+
+
+def parse_levels(spec):
+    """"
+        "info,parser=debug" -> {"": INFO, "parser": DEBUG}, the empty name is the level of all components
+    """
+    levels = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        component, _, level = part.rpartition("=")
+        level = logging.getLevelName(level.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError("unknown log level in %r" % part)
+        levels[component.strip().lower()] = level
+    return levels
+
+
+def setup(spec=None, interval=10.0, burst=5, stream=None):
+    """"
+        Sets up the lora loggers, spec is like "info,parser=debug" (default: LORA_LOG or info)
+    """
+    if spec is None:
+        spec = os.environ.get("LORA_LOG", "info")
+    levels = parse_levels(spec)
+
+    root = logging.getLogger("lora")
+    root.setLevel(levels.pop("", logging.INFO))
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(ComponentFormatter())
+    handler.addFilter(RateLimitFilter(interval, burst))
+    root.addHandler(handler)
+
+    for component in COMPONENTS:
+        get_logger(component).setLevel(levels.pop(component, logging.NOTSET))
+    for component, level in levels.items():
+        # components that are not in the list are still allowed
+        get_logger(component).setLevel(level)
+    return root
+
+
+class Summary:
+    """"
+        Counts events and logs one line with the rates every interval seconds
+    """
+    def __init__(self, logger, interval=60.0, rates=("packets",)):
+        self.logger = logger
+        self.interval = interval
+        # these counters are shown per second, the others as totals of the interval
+        self.rates = rates
+        self.counts = {}
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def maybe_report(self, now=None):
+        if now is None:
+            now = time.time()
+        if now - self.last < self.interval:
+            return False
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            elapsed, self.last = now - self.last, now
+        parts = []
+        for name in self.rates:
+            parts.append("%.1f %s/s" % (counts.pop(name, 0) / elapsed, name))
+        for name, value in sorted(counts.items()):
+            parts.append("%d %s" % (value, name))
+        self.logger.info(", ".join(parts))
+        return True
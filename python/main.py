@@ -6,186 +6,332 @@
 # we also draw a line between the sensor and the gateway to show the signal.
 # to achieve this we make use of multiple threads, as the mapper and websocket are both blocking calls. This way both can
 # run simultaneously.
+# The websocket url can be changed with --url (or LORA_WS_URL), e.g. to point at a local replay.py server,
+# and --record writes the raw feed to a capture file that replay.py can serve again.
+# --profile (or LORA_PROFILE) times every stage of the pipeline, see profiling.py.
+# With --mode ingest there is no map server in this process, the state is written to a shared state file and
+# web.py workers serve the map from it (see sharedstate.py), so ingest and viewers each get their own cores.
+# The web workers only have their own metrics, --metrics-port serves the metrics of the ingest.
+# With --store the packets and checkpoints of the state are kept in a sqlite file and loaded again on startup,
+# see storage.py.
 
 
 # own script imports
 from signals import Signal, Sensor, Gateway
 from mapper import Mapper
+from registry import Registry
+from packets import as_packet
+from localization import Localizer
+from ingest import IngestPipeline
+from capture import CaptureWriter
+from state import StateStore
+from sharedstate import SharedStateWriter, default_state_file
+from storage import SignalStore
+from calibration import CalibrationWorker
+from uplinks import UplinkGrouper, localize_uplinks
+from metrics import metrics, serve as serve_metrics
+import logs
+import profiling
 
 # library imports
-from websockets.sync.client import connect
-import json
-import pandas as pd
+import argparse
+import atexit
+import os
+import sys
 import threading
+import time
 import random
-import math
 
-# pip install websockets json pandas dash plotly scipy
+# pip install websockets json pandas dash plotly
 
-def handle_message(sensors, gateways, msg, sensor_data, gateway_data, muting=False):
-    # print message
+DEFAULT_URL = "ws://192.87.172.71:1337"
+
+log = logs.get_logger("parser")
+main_log = logs.get_logger("main")
+# one summary line per minute instead of a line per packet
+summary = logs.Summary(log, interval=60.0)
+message_seconds = metrics.histogram("lora_handle_message_seconds", "Time to parse one packet")
+
+def handle_message(registry, msg, muting=False):
+    # the ingest pipeline already gives us decoded packets, plain message dicts are decoded here
+    packet = as_packet(msg)
+
+    # log message
     if not muting:
-        print("[Parser]: Received message (rssi): %d." % msg['rssi'])
-        print(msg)
+        log.debug("Received message (rssi): %d.", packet.rssi)
+        log.debug("%r", packet)
+
+    # the gateway euid, already normalized by the decoder
+    gateway_eui = packet.gateway
 
-    # check if the message has a device eui
-    if 'device_eui' not in msg:
+    # check if the message has a device eui, if not it is foreign traffic and we only know its short address
+    if packet.device_eui is None:
         if not muting:
-            print("[Parser]: No device EUI found")
+            log.debug("No device EUI found")
+        summary.count("foreign")
+        gateway_record = registry.lookup_gateway(gateway_eui)
+        if packet.device_addr is not None and gateway_record is not None:
+            registry.foreign.add(packet, gateway_record)
         return
 
+    # store sensor eui
+    sensor_eui = packet.device_eui
+
     # check if device_euid is in the csv file
-    if msg['device_eui'] not in sensor_data['Sensor_Eui'].values:
+    record = registry.lookup_sensor(sensor_eui)
+    if record is None:
         if not muting:
-            print("[Parser]: Unknown device EUI", msg['device_eui'])
-
+            log.debug("Unknown device EUI %s", sensor_eui)
 
     if not muting:
-        print("[Parser]: Device found in csv (name): ", msg['device_name'])
-
-    # store sensor eui and gateway euid
-    sensor_eui = msg['device_eui']
-    gateway_eui = msg['gateway'].replace(":", "")
-
-    #the standard sensor is not known so location to 0,0
-    lat = 52.2394 + random.uniform(-0.0001, 0.0001)  # random latitude around campus
-    lon = 6.8566 + random.uniform(-0.0001, 0.0001)  # random longitude around campus
-    known = False
+        log.debug("Device found in csv (name): %s", packet.device_name)
 
-    # check if device_euid is in the csv file
-    if msg['device_eui'] in sensor_data['Sensor_Eui'].values:
+    # check if we already have this sensor
+    sensor = registry.get_sensor(sensor_eui)
 
-        #get its location
-        temp_lon = sensor_data["St_X"][sensor_data['Sensor_Eui'] == sensor_eui].values[0],
-        temp_lat = sensor_data["St_Y"][sensor_data['Sensor_Eui'] == sensor_eui].values[0],
+    # if this is a new sensor, add it to the registry
+    if sensor is None:
+        #the standard sensor is not known so location to 0,0
+        lat = 52.2394 + random.uniform(-0.0001, 0.0001)  # random latitude around campus
+        lon = 6.8566 + random.uniform(-0.0001, 0.0001)  # random longitude around campus
+        known = False
 
         #some sensor in the csv have no location, check if there is a actual location
-        if (not math.isnan(temp_lon[0])) and (not math.isnan(temp_lon[0])) :
+        if record is not None and record.known:
             #We know the location so known is ture
             known = True
             #And set the lon and lat
-            lon = temp_lon[0]
-            lat = temp_lat[0]
-        print("Device EUI found in CSV file!")
+            lon = record.lon
+            lat = record.lat
 
-    # check if theres a sensor with the same eui and gatewate eui in the list
-    sensor = next((s for s in sensors if s.get_sensor_id() == sensor_eui), None)
-
-    # if this is a new sensor, add it to the list
-    if sensor is None:
-        sensor = Sensor(
-            msg['device_name'],
+        sensor = registry.add_sensor(Sensor(
+            packet.device_name or "",
             known,
             sensor_eui,
             lon,
             lat,
-        )
-        sensors.append(sensor)
-        # print in green
-        print("[Parser]: \033[92mAdded new sensor to list\033[0m")
+        ))
+        log.info("Added new sensor to list")
+        summary.count("new sensors")
 
     else:
         # if we already found this sensor, increment its packet count
         sensor.nr_of_packets += 1
         if not muting:
-            print("[Parser]: Sensor already in list, incrementing packet count")
+            log.debug("Sensor already in list, incrementing packet count")
 
-    # create a new signal for this sensor and add it to the sensor
-    gate_lat = gateway_data["latitude"][gateway_data['eui'] == gateway_eui].values[0],
-    gate_lon = gateway_data["longitude"][gateway_data['eui'] == gateway_eui].values[0],
+    # check if gateway_eui is known (in csv), without a location we cannot use the signal
+    gateway_record = registry.lookup_gateway(gateway_eui)
+    if gateway_record is None:
+        if registry.mark_unknown_gateway(gateway_eui):
+            log.warning("Unknown gateway EUI %s, ignoring its signals", gateway_eui)
+        return
 
     #create the new signal
-    incomming_signal = Signal(gateway_eui, msg['rssi'], float(gate_lon[0]), float(gate_lat[0]))
+    incomming_signal = Signal(gateway_eui, packet.rssi, gateway_record.lon, gateway_record.lat, packet.snr,
+                              true_distance=registry.true_distance(sensor_eui, gateway_eui) if sensor.known else None,
+                              sf=packet.sf)
     #add the signal to the sensor
     sensor.add_signal(incomming_signal)
 
-    if not muting:
-        print("[Parser]: incoming distance ", incomming_signal.distance)
-
-    # check if gateway_eui is known (in csv)
-    if gateway_eui in gateway_data['eui'].values:
-
-        # add gateway to the list if its not already found
-        gateway = next((g for g in gateways if g.get_gateway_id() == gateway_eui), None)
-        if gateway is None:
-            lon_g = float(gateway_data['longitude'][gateway_data['eui'] == gateway_eui].values[0])
-            lat_g = float(gateway_data['latitude'][gateway_data['eui'] == gateway_eui].values[0])
-            altitude = float(gateway_data['altitude'][gateway_data['eui'] == gateway_eui].values[0])
+    # the heatmap, only where we know (or estimated) the position of the sensor, not at the placeholder position
+    # of a sensor the Localizer did not solve yet
+    if sensor.known:
+        registry.coverage.add(sensor.get_known_lat(), sensor.get_known_lon(), packet.rssi, packet.snr)
+    elif sensor.localized:
+        registry.coverage.add(sensor.lat, sensor.lon, packet.rssi, packet.snr)
 
-            # create a new gateway
-            gateway = Gateway(
-                gateway_data['name'][gateway_data['eui'] == gateway_eui].values[0].strip(),
-                gateway_eui,
-                lon_g,
-                lat_g,
-                altitude,
-            )
-
-            gateways.append(gateway)
-            print("[Parser]: \033[92mAdded new gateway to list\033[0m")
-
-
-
-
-def websocket_handler(sensors, gateways, sensor_data, gateway_data, mapper):
-    running = True
-    num_of_packets = 0
-
-    # make websocket connection
-    with connect("ws://192.87.172.71:1337") as websocket:
-
-        # keep on looping
-        while running:
-            msg = websocket.recv()
+    if not muting:
+        log.debug("incoming distance %.1f", incomming_signal.distance)
+
+    # add gateway to the registry if its not already found
+    if registry.get_gateway(gateway_eui) is None:
+        # create a new gateway
+        registry.add_gateway(Gateway(
+            gateway_record.name,
+            gateway_eui,
+            gateway_record.lon,
+            gateway_record.lat,
+            gateway_record.altitude,
+        ))
+        log.info("Added new gateway to list")
+        summary.count("new gateways")
+
+
+def handle_uplinks(registry, uplinks):
+    # localize every complete uplink that was heard by 3 or more gateways (one solve per uplink)
+    for uplink, lat, lon in localize_uplinks(uplinks, registry):
+        if uplink.device_eui is None:
+            # foreign device
+            registry.foreign.add_fix(uplink.device_addr, lat, lon)
+            continue
+        sensor = registry.get_sensor(uplink.device_eui)
+        if sensor is not None:
+            sensor.add_fix(lat, lon)
+
+
+def make_batch_handler(registry, store, localizer, grouper, persistence=None):
+    # the ingest pipeline calls this with a batch of decoded packets
+    def handle_batch(packets):
+        uplinks = []
+        for packet in packets:
             try:
-                # Decode the message
-                msg = json.loads(msg)
-                handle_message(sensors, gateways, msg, sensor_data, gateway_data, muting=True)
-
-                # show the sensors on a leaflet map
-                mapper.update(sensors, gateways)
-
-            except json.JSONDecodeError:
-                print("[Parser]: Failed to decode json, assuming next packet will be ok...")
-                pass
-
+                start = time.perf_counter()
+                packet = as_packet(packet)
+                handle_message(registry, packet, muting=True)
+                message_seconds.observe(time.perf_counter() - start)
+                # join the receptions of the same uplink by different gateways
+                uplinks += grouper.add(packet)
             except Exception as e:
-                # Assume something went wrong and stop receiving
-                print("[Parser]: Could not parse the message")
-                print("[Parser]: Error:", e)
-                break
-
-            # Increment the packet count
-            num_of_packets += 1
+                # skip this packet, the next one is probably fine
+                log.warning("Could not parse the message: %s", e)
+                summary.count("errors")
+
+        uplinks += grouper.expire()
+        handle_uplinks(registry, uplinks)
+
+        # bin the receptions of this batch in the heatmap
+        registry.coverage.flush()
+
+        # keep the packets and (every few minutes) a checkpoint of the state on disk
+        if persistence is not None:
+            persistence.append(packets)
+            persistence.maybe_write(registry)
+
+        # estimate the positions of the sensors and foreign devices with new signals (only every few seconds)
+        localizer.maybe_run(registry.sensors)
+        registry.foreign.maybe_localize(registry)
+
+        # let the state store know there is something new to show on the map
+        store.mark_changed()
+
+        summary.count("packets", len(packets))
+        summary.maybe_report()
+
+    return handle_batch
+
+
+def add_registry_metrics(registry):
+    # only computed when /metrics is scraped
+    def signal_history():
+        return sum(len(sensor.raw_signals) for sensor in list(registry.sensors))
+
+    metrics.gauge("lora_sensors", "Sensors that sent us packets", lambda: len(registry.sensors))
+    metrics.gauge("lora_gateways", "Known gateways that received packets", lambda: len(registry.gateways))
+    metrics.gauge("lora_unknown_gateways", "Gateways that are not in the csv", lambda: len(registry.unknown_gateways))
+    metrics.gauge("lora_foreign_devices", "Foreign devices in the tracking table", lambda: len(registry.foreign))
+    metrics.gauge("lora_coverage_cells", "Heatmap cells with receptions", registry.coverage.nr_of_cells)
+    metrics.counter("lora_coverage_receptions_total", "Receptions binned in the heatmap",
+                    lambda: registry.coverage.nr_of_receptions)
+    metrics.gauge("lora_signal_history", "Signals kept in the raw signal history of all sensors", signal_history)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Show the lora traffic around campus on a map")
+    parser.add_argument("--url", default=os.environ.get("LORA_WS_URL", DEFAULT_URL), help="websocket to read from")
+    parser.add_argument("--record", help="append the raw websocket frames to this capture file")
+    parser.add_argument("--log", default=os.environ.get("LORA_LOG", "info"),
+                        help="log levels, e.g. 'info' or 'warning,parser=debug' (components: %s)" % ", ".join(
+                            logs.COMPONENTS))
+    parser.add_argument("--mode", choices=("all", "ingest"), default="all",
+                        help="all: ingest and map server in this process, ingest: only ingest, for web.py workers")
+    parser.add_argument("--state-file", help="write the state to this file for web.py workers (default in ingest "
+                                             "mode: LORA_STATE_FILE or /dev/shm/lora_state)")
+    parser.add_argument("--port", type=int, default=8050, help="port of the map server")
+    parser.add_argument("--metrics-port", type=int, default=os.environ.get("LORA_METRICS_PORT"),
+                        help="serve /metrics on this port (the map server already serves it, use this in ingest mode)")
+    parser.add_argument("--debug", action="store_true", help="run the map server in dash debug mode (with reloader)")
+    parser.add_argument("--store", default=os.environ.get("LORA_STORE"),
+                        help="sqlite file to keep the packets and state in, the state is loaded from it on startup")
+    parser.add_argument("--retention-days", type=int, default=90, help="days of hourly history to keep")
+    parser.add_argument("--downsample-days", type=int, default=7, help="days of full packet history to keep")
+    parser.add_argument("--profile", nargs="?", const="profile.json",
+                        help="time every stage and write the results to this json file (or set LORA_PROFILE)")
+    parser.add_argument("--profile-sample", type=float,
+                        help="fraction of the packets that get a full trace (default 0.01, or LORA_PROFILE_SAMPLE)")
+    return parser.parse_args()
 
 
 def main():
-    # init the sensors and gateways object list
-    sensors = []
-    gateways = []
-
-    # init the mapper
-    mapper = Mapper()
+    args = parse_args()
+    logs.setup(args.log)
+    # profiling wraps the stages, so it has to be on before anything is made
+    profiling.enable_from_env(args.profile, args.profile_sample, sys.modules[__name__])
 
     # read the csv files with the sensor and gateway locations
-    sensor_data = pd.read_csv('data/sensor_locations.csv')
-    sensor_data['Sensor_Eui'] = sensor_data['Sensor_Eui'].astype(str).str.replace(":", "")
+    # the registry also holds the sensors and gateways object lists
+    registry = Registry.from_csv('data/sensor_locations.csv', 'data/gateway_locations.csv')
+    add_registry_metrics(registry)
+
+    # load the state of the last run, and keep the new packets and state
+    persistence = None
+    if args.store:
+        persistence = SignalStore(args.store, downsample_days=args.downsample_days,
+                                  retention_days=args.retention_days)
+        persistence.restore(registry, handle_message)
+
+    # the state store publishes read only snapshots of the registry for the mapper
+    store = StateStore(interval=0.5)
+
+    # the web workers in other processes read the snapshots from the state file
+    state_file = args.state_file or (default_state_file() if args.mode == "ingest" else None)
+    if state_file:
+        writer = SharedStateWriter(state_file)
+        store.add_listener(writer.write)
+        main_log.info("Writing the state to %s", state_file)
 
-    gateway_data = pd.read_csv('data/gateway_locations.csv')
+    # init the mapper
+    mapper = Mapper(store) if args.mode == "all" else None
+
+    # fit the path loss models per gateway and spreading factor in the background
+    calibration = CalibrationWorker(interval=30.0)
+    calibration.start()
+
+    # the localizer estimates the sensor positions in batches
+    localizer = Localizer(interval=2.0)
+
+    # the grouper joins the receptions of one uplink by different gateways
+    grouper = UplinkGrouper(window=1.0)
+
+    # the ingest pipeline reads the websocket and calls the parser with batches of messages
+    recorder = CaptureWriter(args.record) if args.record else None
+    pipeline = IngestPipeline(args.url, make_batch_handler(registry, store, localizer, grouper, persistence),
+                              recorder=recorder)
+
+    if persistence is not None:
+        # a last checkpoint when we stop, while no batch is being parsed
+        def close_store():
+            with pipeline.handle_lock:
+                persistence.close(registry)
+        atexit.register(close_store)
+
+    # publish snapshots in the background, holding the same lock the pipeline holds while it parses
+    store.start(registry, pipeline.handle_lock)
+
+    # the map server serves /metrics itself, without it the metrics get their own port
+    if args.metrics_port:
+        metrics_server = serve_metrics(args.metrics_port)
+        main_log.info("Serving metrics on port %d", metrics_server.server_port)
+    elif mapper is None:
+        main_log.warning("No map server and no --metrics-port, the ingest metrics are not served")
+
+    if mapper is None:
+        # only ingest, the websocket handler can have the main thread
+        main_log.info("Starting ingest, the map is served by web.py")
+        pipeline.run()
+        return
 
     # start the websocket handler in a new thread
-    # we use the websocket function as the thread, we give it the right arguments for the function
     websocket_thread = threading.Thread(
-        target=websocket_handler,
+        target=pipeline.run,
         daemon=True,
-        args=(sensors, gateways, sensor_data, gateway_data, mapper)
     )
     websocket_thread.start()
-    print("[Main]: Websocket thread started")
+    main_log.info("Websocket thread started")
 
-    # And start the map server on port 8050. Do this in the main thread
-    print("[Main]: Starting mapper server on port 8050")
-    mapper.app.run(debug=True, port=8050)
+    # And start the map server. Do this in the main thread
+    main_log.info("Starting mapper server on port %d", args.port)
+    mapper.app.run(debug=args.debug, port=args.port)
 
 
 if __name__ == "__main__":
@@ -1,93 +1,216 @@
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output
+from flask import Response, request
 import plotly.graph_objects as go
+import math
+
+from figures import FigureCache, pick_encoding
+from metrics import metrics
+from spatial import ViewCache, Viewport, viewport_around
+from state import StateStore
+from streaming import DeltaBroadcaster
 
-import plotly.express as px
 import pandas as pd
-import numpy as np
+
+# colors and sizes of the points, every type is one trace on the map
+POINT_STYLES = {
+    "Actual Position Sensors": ("pink", 3),
+    "Sensor": ("lime", 3),
+    "Unknown Sensor": ("orange", 3),
+    "Foreign Device": ("mediumpurple", 3),
+    "Gateway": ("aqua", 5),
+}
+
+# colors of the lines, every type is one trace on the map
+LINE_STYLES = {
+    "Signal (known sensor)": "rgba(0, 255, 0, 0.2)",
+    "Signal (unknown sensor)": "rgba(255, 200, 0, 0.15)",
+    "Signal (foreign device)": "rgba(147, 112, 219, 0.1)",
+    "Actual Position Sensors": "rgba(255, 198, 208, 0.2)",
+}
+
+# the clusters of devices when there are too many to show them all (see spatial.py), size grows with the count
+CLUSTER_STYLE = ("white", 6)
+
+# the graph of the page before map_stream.js loaded the figure from /map/figure
+EMPTY_FIGURE = {"data": [], "layout": {"margin": {"r": 0, "t": 0, "l": 0, "b": 0}, "xaxis": {"visible": False},
+                                       "yaxis": {"visible": False}}}
+
+# the heatmap: radius of a cell in pixels and the colors from weak to strong rssi
+COVERAGE_RADIUS = 12
+COVERAGE_COLORS = [[0.0, "rgba(0, 0, 0, 0)"], [0.3, "rgb(40, 40, 160)"], [0.7, "rgb(230, 120, 30)"],
+                   [1.0, "rgb(255, 255, 200)"]]
+
+
+def cluster_size(count):
+    # marker size of a cluster, the same as clusterSize in map_stream.js
+    return CLUSTER_STYLE[1] + 3 * math.log2(count)
+
+
+def cluster_text(cluster):
+    # hover text of a cluster, the same as clusterText in map_stream.js
+    _, _, count, known, unknown, foreign = cluster
+    return "%d devices (%d sensors, %d unknown, %d foreign)" % (count, known, unknown, foreign)
+
 
 class Mapper:
-    def __init__(self):
-        # create object lists for the sensors and gateways (optimization possible, just use a pointer instead of a copy)
-        self.sensors = []
-        self.gateways = []
+    def __init__(self, store=None, max_points=2000):
+        # the mapper only reads the read only snapshots of the state store, never the live sensors and gateways
+        self.store = store if store is not None else StateStore()
 
         # create a dash app
         self.app = dash.Dash(__name__)
         self.location_center = (52.2394, 6.8566)  # campus
+        self.zoom = 14
         self.initial_data = pd.DataFrame({"lat": [self.location_center[0]], "lon": [self.location_center[1]]})
 
-        # Set up the layout of the app
-        self.app.layout = html.Div([
+        # every version of the figure is built, serialized and compressed once and served to all viewers, the page
+        # loads it from /map/figure so the compressed bodies and the etag are used
+        self.figures = FigureCache(self.build_figure)
+        self.app.server.add_url_rule('/map/figure', 'map_figure', self.serve_figure)
+
+        # updates are pushed to the browsers as server sent events, assets/map_stream.js applies them to the map
+        self.broadcaster = DeltaBroadcaster(self.store, max_points=max_points)
+        self.app.server.add_url_rule('/map/events', 'map_events', self.serve_events)
+
+        # with more than max_points devices the browsers only get the devices (or clusters) of their viewport
+        self.max_points = max_points
+        self.views = ViewCache(max_points)
+        self.app.server.add_url_rule('/map/view', 'map_view', self.serve_view)
+
+        # counters, gauges and histograms of the whole process for prometheus (see metrics.py)
+        self.app.server.add_url_rule('/metrics', 'metrics', self.serve_metrics)
+        metrics.gauge("lora_map_version", "Version of the latest state snapshot", self.store.version)
+        metrics.gauge("lora_map_clients", "Browsers connected to the event stream",
+                      lambda: self.broadcaster.nr_of_clients)
+        metrics.counter("lora_map_cache_hits_total", "Figure requests served from the cache",
+                        lambda: self.figures.hits)
+        metrics.counter("lora_map_cache_misses_total", "Figure requests that built the figure",
+                        lambda: self.figures.misses)
+        metrics.counter("lora_map_view_cache_hits_total", "Viewport requests served from the cache",
+                        lambda: self.views.hits)
+        metrics.counter("lora_map_view_cache_misses_total", "Viewport requests that queried the spatial index",
+                        lambda: self.views.misses)
+
+        # Set up the layout of the app, the figure itself is not in it (see above)
+        self.app.layout = self.serve_layout
+
+    def serve_layout(self):
+        return html.Div([
             dcc.Graph(
                 id='live-map',
+                figure=EMPTY_FIGURE,
                 style={"width": "95vw", "height": "100vh"},
                 config = {
                     "displayModeBar": False  # This hides the toolbar!
                 }
             ),
-            # Add an interval component to update the map every 2 seconds
-            dcc.Interval(
-                id='interval-component',
-                interval=2 * 1000,
-                n_intervals=0
-            )
+            # tells map_stream.js where to get the figure and the updates
+            html.Div(id='map-events', **{"data-url": self.app.get_relative_path('/map/events'),
+                                         "data-figure-url": self.app.get_relative_path('/map/figure'),
+                                         "data-view-url": self.app.get_relative_path('/map/view')}),
         ], style={"margin": "0", "padding": "0"})
 
-        # Register the callback using self.app.callback.
-        # This sets the function that is run when the interval is triggered
-        self.app.callback(
-            Output('live-map', 'figure'),
-            Input('interval-component', 'n_intervals')
-        )(self.update_map)
-
-
+    def serve_events(self):
+        # one long running response per browser, the browser reconnects by itself when it is closed
+        stream = self.broadcaster.stream(request.headers.get("Last-Event-ID"))
+        return Response(stream, mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def serve_metrics(self):
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    def serve_figure(self):
+        # take the latest snapshot, if the browser already shows this version there is nothing to send
+        snapshot = self.store.get()
+        version = str(snapshot.version)
+        if request.args.get('version') == version:
+            return Response(status=204)
+
+        return self.send_entry(self.figures.get(snapshot), version)
+
+    def serve_view(self):
+        # the devices or clusters in the viewport of a browser: /map/view?zoom=14&south=..&west=..&north=..&east=..
+        try:
+            viewport = Viewport(*(float(request.args[name]) for name in Viewport._fields))
+        except (KeyError, ValueError):
+            return Response("zoom, south, west, north and east are needed", status=400)
+        if not all(math.isfinite(value) for value in viewport):
+            return Response("zoom, south, west, north and east must be finite numbers", status=400)
+        snapshot = self.store.get()
+        return self.send_entry(self.views.get(snapshot, viewport), str(snapshot.version))
+
+    def send_entry(self, entry, version):
+        headers = {"ETag": entry.etag, "X-Map-Version": version, "Cache-Control": "no-cache",
+                   "Vary": "Accept-Encoding"}
+        if entry.etag in request.headers.get("If-None-Match", ""):
+            return Response(status=304, headers=headers)
+
+        # send the precompressed body the browser accepts
+        encoding = pick_encoding(request.headers.get("Accept-Encoding"), entry.bodies)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(entry.body(encoding), mimetype="application/json", headers=headers)
+
+    def build_figure(self, snapshot):
+        # All points and lines are collected in plain lists first, every category becomes a single trace.
+        # Lines of one category are drawn as one trace by putting None between the lines (plotly breaks the line there)
+        # This keeps the number of traces fixed, no matter how many sensors and signals there are.
+        points = {point_type: {"lat": [], "lon": [], "text": []} for point_type in POINT_STYLES}
+        lines = {line_type: {"lat": [], "lon": [], "text": []} for line_type in LINE_STYLES}
+
+        def add_point(point_type, lat, lon, text):
+            trace = points[point_type]
+            trace["lat"].append(lat)
+            trace["lon"].append(lon)
+            trace["text"].append(text)
+
+        def add_line(line_type, lat1, lon1, lat2, lon2, text):
+            trace = lines[line_type]
+            trace["lat"] += [lat1, lat2, None]
+            trace["lon"] += [lon1, lon2, None]
+            trace["text"] += [text, text, None]
+
+        # too many devices: only the devices and clusters of the starting view, the browser asks for the rest
+        sensors, clusters = snapshot.sensors, []
+        if len(sensors) > self.max_points:
+            sensors, clusters = self.views.query(snapshot, viewport_around(*self.location_center, self.zoom))
 
+        # Get the sensor and gateway data (these are points were gonna plot later
+        gateways_by_eui = snapshot.gateways_by_eui
+        for sensor in sensors:
+            # determine position of the sensor and determine the type
+            lat = sensor.lat
+            lon = sensor.lon
+            name = sensor.name
 
+            if sensor.known:
+                add_point("Sensor", lat, lon, name)
+                add_point("Actual Position Sensors", sensor.known_lat, sensor.known_lon, name)
+                link_type = "Signal (known sensor)"
+
+                #if there is a estimated position, draw a line between the actual and the estimated position
+                if sensor.estimated:
+                    add_line("Actual Position Sensors", lat, lon, sensor.known_lat, sensor.known_lon, name)
+            elif sensor.foreign:
+                # devices without eui, we only know their short address
+                add_point("Foreign Device", lat, lon, name)
+                link_type = "Signal (foreign device)"
+            else:
+                # unkown sensors, draw with orange lines
+                add_point("Unknown Sensor", lat, lon, name)
+                link_type = "Signal (unknown sensor)"
 
-    def update(self, sensors, gateways):
-        # in this function we update the sensors and gateways
-        # (optimization possible, just use a pointer instead of a copy)
-        self.sensors = sensors
-        self.gateways = gateways
+            # loop through all gateways that received the sensor
+            for gateway_eui in sensor.gateways:
+                # get the gateway eui > get the gateway position
+                gateway_pos = gateways_by_eui.get(gateway_eui)
+                if gateway_pos:
+                    # a line between the sensor and the gateway
+                    add_line(link_type, lat, lon, gateway_pos.lat, gateway_pos.lon, f"{name} to {gateway_pos.name}")
 
-    def update_map(self, n_intervals):
-        # Get the sensor and gateway data (these are points were gonna plot later
-        data = []
-        for s in self.sensors:
-            # determine position of the sensor and determine the type
-            lat = s.get_lat()
-            lon = s.get_lon()
-            type = "Sensor"
-            if not s.known:
-                type = "Unknown Sensor"
-            data.append({
-                "lat": lat,
-                "lon": lon,
-                "known_lat": s.get_known_lat(),
-                "known_lon": s.get_known_lon(),
-                "type": type,
-                "eui": s.get_sensor_id(),
-                "name": s.name_of_sensor if s.has_sensor_name() else "Unknown",
-            })
-        for g in self.gateways:
-            lat = g.get_lat()
-            lon = g.get_lon()
-            data.append({
-                "lat": lat,
-                "lon": lon,
-                "type": "Gateway",
-                "eui": g.get_gateway_id(),
-                "name": g.name_of_gateway,
-                "altitude": g.altitude,
-            })
-        df = pd.DataFrame(data)
-
-        # use a center point as a fallback
-        if df.empty:
-            df = pd.DataFrame(
-                [{"lat": self.location_center[0], "lon": self.location_center[1], "type": "Center", "name": "Center"}])
+        for g in snapshot.gateways:
+            add_point("Gateway", g.lat, g.lon, g.name)
 
         # Create a scatter mapbox figure
         fig = go.Figure()
@@ -95,88 +218,62 @@ class Mapper:
             mapbox=dict(
                 style="carto-darkmatter",
                 center={"lat": self.location_center[0], "lon": self.location_center[1]},
-                zoom=14
-
-            )
-        )
+                zoom=self.zoom
 
-        # add extra tranparent circles
-        fig.add_trace(
-            dict(
-                type="scattermapbox",
-                lat=df["lat"],
-                lon=df["lon"],
-                mode="markers",
-                marker=dict(
-                    size=6,
-                    color="white",
-                    opacity=0.15,
-                    allowoverlap=True,
-                ),
-                hoverinfo="skip",  # <--- This disables hover for this trace!
-                showlegend=False,
             )
         )
 
-        # add extra transpartent circles
+        # the rssi heatmap, one density layer with a point per grid cell (see heatmap.py) instead of a glow around
+        # every point, so it does not get slower with more receptions
+        coverage = snapshot.coverage
         fig.add_trace(
             dict(
-                type="scattermapbox",
-                lat=df["lat"],
-                lon=df["lon"],
-                mode="markers",
-                marker=dict(
-                    size=10,
-                    color="white",
-                    opacity=0.05,
-                    allowoverlap=True,
-                ),
-                hoverinfo="skip",  # <--- This disables hover for this trace!
+                type="densitymapbox",
+                lat=coverage.lat,
+                lon=coverage.lon,
+                z=coverage.strength,
+                zmin=0,
+                zmax=1,
+                radius=COVERAGE_RADIUS,
+                colorscale=COVERAGE_COLORS,
+                opacity=0.5,
+                showscale=False,
+                hoverinfo="skip",
+                name="Coverage",
                 showlegend=False,
             )
         )
 
-        # Add a layer for the points
-        for point_type in {"Sensor", "Gateway", "Unknown Sensor"}:
-            subdf = df[df["type"] == point_type]
-            size = 3
-            if point_type == "Sensor":
-                color = "pink"
-                actual_pos_df = df[df["known_lat"].notnull() & df["known_lon"].notnull()]
-                name = df["name"]
-
-
-                fig.add_trace(
-                    dict(
-                        type="scattermapbox",
-                        lat=actual_pos_df["known_lat"],
-                        lon=actual_pos_df["known_lon"],
-                        mode="markers",
-                        marker=dict(
-                            size=3,
-                            color="pink",
-                            opacity=0.9,
-                            allowoverlap=True,
-                        ),
-                        name="Actual Position Sensors",
-                        text=name,
-                        hoverinfo="text",
-
-                    )
+        # one trace per line category
+        for line_type, color in LINE_STYLES.items():
+            trace = lines[line_type]
+            fig.add_trace(
+                dict(
+                    type="scattermapbox",
+                    lat=trace["lat"],
+                    lon=trace["lon"],
+                    mode="lines",
+                    line=dict(
+                        width=1.5,  # Line width
+                        color=color,  # Line color
+                    ),
+                    name=line_type,
+                    text=trace["text"],
+                    hoverinfo="text",
+                    legendgroup=line_type,
+                    # the lines to the actual position share the legend entry of the actual position points
+                    showlegend=line_type not in POINT_STYLES,
                 )
+            )
 
-                color = "lime"
-            elif point_type == "Gateway":
-                color = "aqua"
-                size = 5
-            elif point_type == "Unknown Sensor":
-                color = "orange"
-
+        # Add a layer for the points, one trace per point type
+        for point_type, (color, size) in POINT_STYLES.items():
+            trace = points[point_type]
             fig.add_trace(
                 dict(
                     type="scattermapbox",
-                    lat=subdf["lat"],
-                    lon=subdf["lon"],
+                    lat=trace["lat"],
+                    lon=trace["lon"],
                     mode="markers",
                     marker=dict(
                         size=size,
@@ -185,100 +282,32 @@ class Mapper:
                         allowoverlap=True,
                     ),
                     name=point_type,
-                    text=subdf["name"],
+                    text=trace["text"],
                     hoverinfo="text",
+                    legendgroup=point_type,
                 )
             )
 
-        # loop through all sensors
-        for sensor in self.sensors:
-            if sensor.known:
-
-                # loop through all signals of the sensor
-                for signal in sensor.avg_signals:
-
-                    # get the gateway eui > get the gateway position
-                    gateway = signal.eui_of_gateway
-                    gateway_pos = next((g for g in self.gateways if g.get_gateway_id() == gateway), None)
-                    if gateway_pos:
-                        # store all the coordinates of the line (2 points, 4 values)
-                        line_coordinates = {
-                            "lat": [sensor.get_lat(), gateway_pos.get_lat()],
-                            "lon": [sensor.get_lon(), gateway_pos.get_lon()]
-                        }
-
-                        # Add a line between the sensor and the gateway
-                        fig.add_trace(
-                            dict(
-                                type="scattermapbox",
-                                lat=line_coordinates["lat"],
-                                lon=line_coordinates["lon"],
-                                mode="lines",
-                                line=dict(
-                                    width=1.5,  # Line width
-                                    color="rgba(0, 255, 0, 0.2)",  # Line color
-                                ),
-                                name=f"Signal to {gateway_pos.name_of_gateway}",
-                                showlegend=True,
-                            )
-                        )
-
-                #if there is a estimated position
-                if sensor.pos_is_estimated():
-                    line_coordinates = {
-                        "lat": [sensor.get_lat(), sensor.get_known_lat()],
-                        "lon": [sensor.get_lon(), sensor.get_known_lon()]
-                    }
-
-                    # Add a pink line between the actual sensor and the estimated sensor position
-                    fig.add_trace(
-                        dict(
-                            type="scattermapbox",
-                            lat=line_coordinates["lat"],
-                            lon=line_coordinates["lon"],
-                            mode="lines",
-                            line=dict(
-                                width=1.5,  # Line width
-                                color="rgba(255, 198, 208, 0.2)",  # Line color
-                            ),
-                            name="Actual Position Sensors",
-                            showlegend=True,  # Hide legend for these lines
-                        )
-                    )
-
-
-
-            # unkown sensors, draw with orange lines
-            else:
-                # loop through all signals of the sensor
-                for signal in sensor.avg_signals:
-
-                    # get the gateway eui > get the gateway position
-                    gateway = signal.eui_of_gateway
-                    gateway_pos = next((g for g in self.gateways if g.get_gateway_id() == gateway), None)
-                    if gateway_pos:
-                        # store all the coordinates of the line (2 points, 4 values)
-                        line_coordinates = {
-                            "lat": [sensor.get_lat(), gateway_pos.get_lat()],
-                            "lon": [sensor.get_lon(), gateway_pos.get_lon()]
-                        }
-
-                        # Add a line between the sensor and the gateway
-                        fig.add_trace(
-                            dict(
-                                type="scattermapbox",
-                                lat=line_coordinates["lat"],
-                                lon=line_coordinates["lon"],
-                                mode="lines",
-                                line=dict(
-                                    width=1.5,  # Line width
-                                    color="rgba(255, 200, 0, 0.15)",  # Line color
-                                ),
-                                name=f"Signal to {gateway_pos.name_of_gateway}",
-                                showlegend=True,  # Hide legend for these lines
-                            )
-                        )
-
+        # the clusters, one trace that is empty when all devices are shown
+        color, size = CLUSTER_STYLE
+        fig.add_trace(
+            dict(
+                type="scattermapbox",
+                lat=[c[0] for c in clusters],
+                lon=[c[1] for c in clusters],
+                mode="markers",
+                marker=dict(
+                    size=[cluster_size(c[2]) for c in clusters],
+                    color=color,
+                    opacity=0.6,
+                    allowoverlap=True,
+                ),
+                name="Cluster",
+                text=[cluster_text(c) for c in clusters],
+                hoverinfo="text",
+                legendgroup="Cluster",
+            )
+        )
 
         fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
         return fig
@@ -292,14 +321,14 @@ if __name__ == "__main__":
 
     # Example sensor and gateway data
     sensors = [
-        Sensor("Sensor1", "EUI1", "Gateway1", 52.233, 6.860, 0.5),
-        Sensor("Sensor2", "EUI2", "Gateway2", 52.232, 6.868, 0.6)
+        Sensor("Sensor1", True, "EUI1", 6.860, 52.233),
+        Sensor("Sensor2", False, "EUI2", 6.868, 52.232)
     ]
     gateways = [
-        Gateway("Gateway1", "EUI1", 52.236, 6.860, 10),
-        Gateway("Gateway2", "EUI2", 52.231, 6.868, 20)
+        Gateway("Gateway1", "GW1", 6.860, 52.236, 10),
+        Gateway("Gateway2", "GW2", 6.868, 52.231, 20)
     ]
 
     mapper = Mapper()
-    mapper.update(sensors, gateways)
+    mapper.store.publish(sensors, gateways)
     mapper.run()
@@ -0,0 +1,169 @@
+# metrics
+# Counters, gauges and histograms in the prometheus text format, served on /metrics by the mapper.
+# Recording must cost next to nothing because it happens on every packet: a counter is one addition and a
+# histogram one bisect and two additions, without locks (a scrape can be off by a packet, that is fine).
+# Numbers that are already kept somewhere else (queue depth, number of sensors, ingest stats) are not counted
+# twice, they are gauges with a function that is only called when somebody scrapes /metrics.
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+# seconds, from 10 microseconds (one packet) up to 10 seconds (a big map build)
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# bytes
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 5e7)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        # with a function the value is read from it on every scrape instead of counted here
+        self.function = function
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, "", value)]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # one count per bucket and one for everything above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), list(self.counts)):
+            total += count
+            samples.append((self.name + "_bucket", '{le="%s"}' % format_value(float(bound)), total))
+        samples.append((self.name + "_sum", "", self.sum))
+        samples.append((self.name + "_count", "", total))
+        return samples
+
+
+class Timer:
+    # with histogram.time(): ... observes how long the block took
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        # name -> metric, in the order they were made
+        self.metrics = {}
+
+    def add(self, metric):
+        # making the same metric twice (e.g. two pipelines in one process) replaces the first one
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, function=None):
+        return self.add(Counter(name, description, function))
+
+    def gauge(self, name, description, function=None):
+        return self.add(Gauge(name, description, function))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, description, buckets))
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def render(self):
+        """"
+            All metrics in the prometheus text format (version 0.0.4)
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception:
+                # a gauge whose function fails should not break the other metrics
+                continue
+            lines.append("# HELP %s %s" % (metric.name, metric.description))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in samples:
+                lines.append("%s%s %s" % (name, labels, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+# the metrics of this process, the mapper serves these on /metrics
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a log line
+        pass
+
+
+def serve(port, host="0.0.0.0"):
+    """"
+        Serves /metrics on its own port in a background thread, for processes without the map server
+        (main.py --mode ingest). Returns the server, server.shutdown() stops it.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,353 @@
+# offline localization
+# Runs calibration and localization over recorded traffic instead of the live feed, e.g. to try path loss settings
+# on days of packets:
+#     python offline.py capture.bin --out estimates.csv
+#     python offline.py lora.db --workers 8 --fit-power --out estimates.parquet
+# The input is a capture file (capture.py, main.py --record) or a store (storage.py, main.py --store).
+# The work is split by device over a process pool, every device is in exactly one shard:
+#     1. decode      the input is split in chunks of frames (or rows), every worker reads its chunks from the input
+#                    itself, decodes them and writes the packets of every shard to its own file in a temporary
+#                    directory. The main process never has the packets, memory does not grow with the input.
+#     2. calibrate   every shard sums the least squares terms of the path loss model of its known sensors, the sums
+#                    of all shards give one model (the fit the live PathLossEstimator converges to)
+#     3. localize    every shard (read from its files) estimates its devices with that model: from the average distance to every gateway
+#                    and from the single uplinks (median of the uplink fixes, single fixes can be far off)
+# The output has one row per device with both estimates and, for sensors with a catalog position, their errors.
+# A store is opened read only, the analysis does not change it.
+# Parquet needs pyarrow (or fastparquet), without it the output is written as csv.
+
+import argparse
+from multiprocessing import Pool
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+from urllib.parse import quote
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from capture import MAGIC, capture_chunks, read_capture
+from localization import GatewayDistance, solve_grouped
+from packets import Packet, loads
+from registry import Registry, ellipsoidal_distance
+from signals import RunningStats, path_loss, transmition_power
+from storage import day_tables
+from uplinks import UplinkGrouper, localize_uplinks
+import logs
+
+log = logs.get_logger("localization")
+
+# the registry of a worker process, made once by init_worker
+worker_registry = None
+
+
+def init_worker(sensor_path, gateway_path):
+    global worker_registry
+    worker_registry = Registry.from_csv(sensor_path, gateway_path)
+
+
+def open_store(path):
+    # read only, sqlite3.connect would create a missing file and SignalStore writes its tables and settings
+    return sqlite3.connect("file:%s?mode=ro" % quote(os.path.abspath(path)), uri=True)
+
+
+def input_chunks(path, chunk_size):
+    """"
+        The chunks of a capture file (offset and number of frames) or of a store (day table and rowid range),
+        every chunk is read by a worker with read_chunk
+    """
+    with open(path, "rb") as file:
+        is_capture = file.read(len(MAGIC)) == MAGIC
+    if is_capture:
+        return [("capture", path, offset, count) for offset, count in capture_chunks(path, chunk_size)]
+    db = open_store(path)
+    try:
+        chunks = []
+        for table in day_tables(db):
+            first, last = db.execute("SELECT MIN(rowid), MAX(rowid) FROM %s" % table).fetchone()
+            if first is None:
+                continue
+            chunks += [("store", path, table, start, start + chunk_size)
+                       for start in range(first, last + 1, chunk_size)]
+        return chunks
+    finally:
+        db.close()
+
+
+def read_chunk(chunk):
+    """"
+        (time, frame) of a capture chunk or (time, Packet) of a store chunk
+    """
+    if chunk[0] == "capture":
+        _, path, offset, count = chunk
+        return read_capture(path, offset, count)
+    _, path, table, start, end = chunk
+    db = open_store(path)
+    try:
+        rows = db.execute("SELECT * FROM %s WHERE rowid >= ? AND rowid < ? ORDER BY rowid" % table,
+                          (start, end)).fetchall()
+    finally:
+        db.close()
+    return [(row[0], Packet(*row[1:])) for row in rows]
+
+
+def shard_of(packet, nr_of_shards):
+    # crc32 of the device, so a device always ends up in the same shard (unlike hash(), which changes per run)
+    device = packet.device_key()
+    if device is None:
+        return None
+    return zlib.crc32(device.encode("utf-8")) % nr_of_shards
+
+
+def shard_path(directory, shard):
+    return os.path.join(directory, "shard-%04d" % shard)
+
+
+def decode_chunk(task):
+    """"
+        Reads and decodes one chunk of the input and writes its packets to the files of their shards, returns
+        (frames, packets)
+    """
+    index, chunk, directory, nr_of_shards = task
+    shards = {}
+    nr_of_frames = 0
+    for timestamp, frame in read_chunk(chunk):
+        nr_of_frames += 1
+        if not isinstance(frame, Packet):
+            try:
+                frame = Packet.from_dict(loads(frame))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+        shard = shard_of(frame, nr_of_shards)
+        if shard is not None:
+            shards.setdefault(shard, []).append((timestamp, frame))
+
+    for shard, packets in shards.items():
+        with open(os.path.join(shard_path(directory, shard), "chunk-%06d.pickle" % index), "wb") as file:
+            pickle.dump(packets, file, pickle.HIGHEST_PROTOCOL)
+    return nr_of_frames, sum(len(packets) for packets in shards.values())
+
+
+def load_shard(path):
+    # the packets of one shard from the files of all chunks, the uplink grouper needs them in time order
+    packets = []
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), "rb") as file:
+            packets += pickle.load(file)
+    packets.sort(key=lambda item: item[0])
+    return packets
+
+
+def calibration_terms(path):
+    """"
+        Sums for the least squares fit of rssi = power + n * x, x = -10 log10(d), over the known sensors of the
+        shard: [count, sum x, sum rssi, sum x^2, sum x * rssi]
+    """
+    registry = worker_registry
+    terms = np.zeros(5)
+    for _, packet in load_shard(path):
+        if packet.device_eui is None:
+            continue
+        distance = registry.true_distance(packet.device_eui, packet.gateway)
+        if distance is None:
+            continue
+        x = -10 * np.log10(max(distance, path_loss.min_distance))
+        terms += (1.0, x, packet.rssi, x * x, x * packet.rssi)
+    return terms
+
+
+def fit_path_loss(terms, power=transmition_power, fit_power=False):
+    # returns (power, n), None when there are not enough different distances
+    count, sum_x, sum_y, sum_xx, sum_xy = terms
+    if fit_power:
+        determinant = count * sum_xx - sum_x * sum_x
+        if count < 2 or abs(determinant) < 1e-9:
+            return None
+        n = (count * sum_xy - sum_x * sum_y) / determinant
+        return (sum_y - n * sum_x) / count, n
+    if sum_xx <= 0:
+        return None
+    return power, (sum_xy - power * sum_x) / sum_xx
+
+
+def localize_shard(task):
+    path, power, n, min_gateways, window = task
+    registry = worker_registry
+    shard = load_shard(path)
+    # the model of this run, used by path_loss.distance here and in localize_uplinks
+    path_loss.power, path_loss.n = power, n
+
+    devices = {}
+    grouper = UplinkGrouper(window=window, max_open=100000)
+    uplinks = []
+    for timestamp, packet in shard:
+        if registry.lookup_gateway(packet.gateway) is None:
+            continue
+        key = packet.device_key()
+        device = devices.get(key)
+        if device is None:
+            device = devices[key] = {"eui": packet.device_eui, "addr": packet.device_addr,
+                                     "name": packet.device_name, "packets": 0, "gateways": {}, "fixes": []}
+        device["packets"] += 1
+        stats = device["gateways"].get(packet.gateway)
+        if stats is None:
+            stats = device["gateways"][packet.gateway] = RunningStats()
+        stats.add(path_loss.distance(packet.rssi))
+        uplinks += grouper.add(packet, timestamp)
+    uplinks += grouper.close_all()
+
+    # position of every single uplink
+    for uplink, lat, lon in localize_uplinks(uplinks, registry, min_gateways):
+        devices[uplink.device]["fixes"].append((lat, lon))
+
+    # position from the average distances, devices with the same gateways are solved together
+    todo = [device for device in devices.values() if len(device["gateways"]) >= min_gateways]
+    signal_lists = [[GatewayDistance(eui, record.lat, record.lon, stats.mean)
+                     for eui, stats in device["gateways"].items()
+                     for record in (registry.lookup_gateway(eui),)]
+                    for device in todo]
+    lats, lons = solve_grouped(signal_lists)
+    for device, lat, lon in zip(todo, lats.tolist(), lons.tolist()):
+        device["average"] = (lat, lon)
+
+    rows = []
+    for key, device in devices.items():
+        record = registry.lookup_sensor(device["eui"]) if device["eui"] is not None else None
+        known = record is not None and record.known
+        avg_lat, avg_lon = device.get("average", (np.nan, np.nan))
+        nr_of_fixes = len(device["fixes"])
+        uplink_lat, uplink_lon = np.median(device["fixes"], axis=0) if nr_of_fixes else (np.nan, np.nan)
+        rows.append({
+            "device": key,
+            "device_eui": device["eui"],
+            "device_addr": device["addr"],
+            "name": device["name"],
+            "known": known,
+            "packets": device["packets"],
+            "gateways": len(device["gateways"]),
+            "uplinks": nr_of_fixes,
+            "average_lat": avg_lat,
+            "average_lon": avg_lon,
+            "uplink_lat": uplink_lat,
+            "uplink_lon": uplink_lon,
+            "known_lat": record.lat if known else np.nan,
+            "known_lon": record.lon if known else np.nan,
+            "average_error_m": float(ellipsoidal_distance(record.lat, record.lon, avg_lat, avg_lon)) if known
+            else np.nan,
+            "uplink_error_m": float(ellipsoidal_distance(record.lat, record.lon, uplink_lat, uplink_lon)) if known
+            else np.nan,
+        })
+    return rows
+
+
+def error_summary(errors):
+    errors = errors.dropna()
+    if errors.empty:
+        return {"count": 0}
+    return {"count": int(errors.count()), "mean_m": float(errors.mean()), "median_m": float(errors.median()),
+            "p90_m": float(errors.quantile(0.9))}
+
+
+def write_estimates(estimates, path):
+    if path.endswith(".parquet"):
+        try:
+            estimates.to_parquet(path, index=False)
+            return path
+        except ImportError:
+            path = path[:-len(".parquet")] + ".csv"
+            log.warning("No parquet engine installed, writing %s instead", path)
+    estimates.to_csv(path, index=False)
+    return path
+
+
+def run(args):
+    timings = {}
+    start = time.perf_counter()
+    chunks = input_chunks(args.input, args.chunk_size)
+    timings["read"] = time.perf_counter() - start
+
+    workers = max(args.workers, 1)
+    nr_of_shards = args.shards or workers * 4
+    pool = Pool(workers, initializer=init_worker, initargs=(args.sensors, args.gateways)) if workers > 1 else None
+    if pool is None:
+        init_worker(args.sensors, args.gateways)
+    map_function = pool.map if pool is not None else map
+    directory = tempfile.TemporaryDirectory(prefix="offline-", dir=args.tmp)
+    try:
+        start = time.perf_counter()
+        for shard in range(nr_of_shards):
+            os.mkdir(shard_path(directory.name, shard))
+        tasks = [(index, chunk, directory.name, nr_of_shards) for index, chunk in enumerate(chunks)]
+        counts = list(map_function(decode_chunk, tasks))
+        nr_of_frames = sum(frames for frames, _ in counts)
+        nr_of_packets = sum(packets for _, packets in counts)
+        shards = [shard_path(directory.name, shard) for shard in range(nr_of_shards)
+                  if os.listdir(shard_path(directory.name, shard))]
+        timings["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model = None
+        if args.n is None:
+            terms = sum(map_function(calibration_terms, shards), np.zeros(5))
+            model = fit_path_loss(terms, args.power, args.fit_power)
+            if model is None:
+                log.warning("Not enough known sensors to calibrate, using the default model")
+        power, n = model if model is not None else (args.power, args.n if args.n is not None else path_loss.n)
+        timings["calibrate"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tasks = [(shard, power, n, args.min_gateways, args.window) for shard in shards]
+        rows = [row for shard_rows in map_function(localize_shard, tasks) for row in shard_rows]
+        timings["localize"] = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        directory.cleanup()
+
+    estimates = pd.DataFrame(rows).sort_values("device") if rows else pd.DataFrame()
+    out = write_estimates(estimates, args.out)
+    known = estimates[estimates["known"]] if not estimates.empty else estimates
+    return {
+        "input": args.input,
+        "output": out,
+        "frames": nr_of_frames,
+        "packets": nr_of_packets,
+        "devices": len(estimates),
+        "shards": len(shards),
+        "workers": workers,
+        "model": {"power": power, "n": n},
+        "average_error": error_summary(known["average_error_m"]) if not known.empty else {"count": 0},
+        "uplink_error": error_summary(known["uplink_error_m"]) if not known.empty else {"count": 0},
+        "seconds": timings,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate and localize all devices of a capture or store file")
+    parser.add_argument("input", help="capture file (main.py --record) or store (main.py --store)")
+    parser.add_argument("--out", default="estimates.csv", help="csv or .parquet file for the estimates")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shards", type=int, help="number of device shards (default 4 per worker)")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="frames per decode task")
+    parser.add_argument("--tmp", help="directory for the decoded shards (default: the system temp directory)")
+    parser.add_argument("--sensors", default="data/sensor_locations.csv")
+    parser.add_argument("--gateways", default="data/gateway_locations.csv")
+    parser.add_argument("--power", type=float, default=transmition_power, help="transmition power in dBm")
+    parser.add_argument("--fit-power", action="store_true", help="fit the transmition power as well")
+    parser.add_argument("--n", type=float, help="use this path loss exponent instead of calibrating")
+    parser.add_argument("--min-gateways", type=int, default=3)
+    parser.add_argument("--window", type=float, default=1.0, help="seconds in which receptions are one uplink")
+    args = parser.parse_args()
+
+    logs.setup()
+    summary = run(args)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# packet decoding
+# Turns the raw websocket frames into Packet records. A Packet has __slots__ and only the fields the parser uses,
+# the euis are normalized once here (no colons, lowercase) so the rest of the code never has to do it again.
+# When orjson is installed it is used for the json decoding, it is a lot faster than the json module.
+# decode_frames decodes a whole batch of frames with one call by joining them into one json array, if that fails
+# (a broken frame) every frame is decoded on its own so only the broken ones are lost.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from registry import normalize_eui
+
+# both raise a ValueError on bad json
+loads = orjson.loads if orjson is not None else json.loads
+
+
+# datr -> spreading factor, there are only a handful of different data rates
+spreading_factors = {}
+
+
+def spreading_factor(datr):
+    """"
+        "SF7BW125" -> 7, None when the data rate is not a lora data rate
+    """
+    sf = spreading_factors.get(datr, -1)
+    if sf == -1:
+        sf = None
+        if isinstance(datr, str) and datr.startswith("SF"):
+            digits = datr[2:].split("BW")[0]
+            sf = int(digits) if digits.isdigit() else None
+        spreading_factors[datr] = sf
+    return sf
+
+
+class Packet:
+    __slots__ = ("device_eui", "device_addr", "device_name", "gateway", "rssi", "snr", "size", "freq", "datr", "time",
+                 "sf")
+
+    def __init__(self, device_eui, device_addr, device_name, gateway, rssi, snr=None, size=None, freq=None,
+                 datr=None, time=None):
+        # normalized eui, None for foreign devices
+        self.device_eui = device_eui
+        # lowercase short address, None if the packet has none
+        self.device_addr = device_addr
+        self.device_name = device_name
+        # normalized eui of the gateway that received the packet
+        self.gateway = gateway
+        self.rssi = rssi
+        self.snr = snr
+        self.size = size
+        self.freq = freq
+        self.datr = datr
+        self.time = time
+        self.sf = spreading_factor(datr)
+
+    @classmethod
+    def from_dict(cls, msg):
+        """"
+            Packet from a decoded websocket message, raises KeyError when gateway or rssi is missing
+        """
+        get = msg.get
+        device_eui = get('device_eui')
+        device_addr = get('device_addr')
+        return cls(
+            normalize_eui(device_eui) if device_eui is not None else None,
+            device_addr.lower() if device_addr is not None else None,
+            get('device_name'),
+            normalize_eui(msg['gateway']),
+            msg['rssi'],
+            get('lsnr'),
+            get('size'),
+            get('freq'),
+            get('datr'),
+            get('time'),
+        )
+
+    def device_key(self):
+        # the key the uplink grouper uses, foreign devices only have the short address
+        if self.device_eui is not None:
+            return self.device_eui
+        if self.device_addr is not None:
+            return "addr:" + self.device_addr
+        return None
+
+    def __repr__(self):
+        return "Packet(%s)" % ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__)
+
+
+def as_packet(msg):
+    # the parser accepts both packets and plain message dicts (replayed or made by hand)
+    return msg if isinstance(msg, Packet) else Packet.from_dict(msg)
+
+
+def decode_frame(frame):
+    return Packet.from_dict(loads(frame))
+
+
+def decode_frames(frames):
+    """"
+        Decodes a batch of frames, returns (packets, nr of frames that could not be decoded)
+    """
+    if not frames:
+        return [], 0
+
+    try:
+        if all(isinstance(frame, str) for frame in frames):
+            messages = loads("[" + ",".join(frames) + "]")
+        else:
+            messages = loads(b"[" + b",".join(f if isinstance(f, bytes) else f.encode() for f in frames) + b"]")
+        if len(messages) != len(frames):
+            # a frame with more than one value (like "1,2"), decode one by one to find it
+            raise ValueError("frame count mismatch")
+    except ValueError:
+        messages = []
+        for frame in frames:
+            try:
+                messages.append(loads(frame))
+            except ValueError:
+                messages.append(None)
+
+    packets = []
+    errors = 0
+    for msg in messages:
+        try:
+            packets.append(Packet.from_dict(msg))
+        except (KeyError, TypeError, AttributeError):
+            errors += 1
+    return packets, errors
@@ -0,0 +1,210 @@
+# profiling
+# Opt-in timing of every stage of the pipeline, to find out where the time goes when the throughput drops:
+#     python main.py --profile profile.json
+#     LORA_PROFILE=profile.json LORA_PROFILE_SAMPLE=0.05 python main.py
+# When profiling is off nothing is changed, so it costs nothing. When it is on, enable() replaces the functions of
+# the stages (decode, parse, registry lookup, signal, calibration, localization, map, ...) by timed wrappers.
+# Every stage keeps its count, total and max, and the last durations for percentiles.
+# A fraction of the packets (sample_rate) also get a full trace: every stage the packet went through, nested,
+# with its offset and duration.
+# The results are written as json on exit, and every time the process gets SIGUSR1 (kill -USR1 <pid>).
+
+from collections import deque
+import atexit
+import functools
+import json
+import os
+import random
+import signal
+import threading
+import time
+
+import logs
+
+log = logs.get_logger("main")
+
+
+class StageStats:
+    def __init__(self, keep=2000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # the last durations, for the percentiles
+        self.recent = deque(maxlen=keep)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.recent.append(elapsed)
+
+    def as_dict(self):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            return recent[min(int(p * len(recent)), len(recent) - 1)] if recent else None
+
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_us": self.total / self.count * 1e6 if self.count else None,
+            "p50_us": percentile(0.5) * 1e6 if recent else None,
+            "p99_us": percentile(0.99) * 1e6 if recent else None,
+            "max_us": self.max * 1e6,
+        }
+
+
+class Profiler:
+    def __init__(self, sample_rate=0.01, max_traces=200):
+        self.enabled = False
+        self.sample_rate = sample_rate
+        self.path = None
+        self.started = time.time()
+        # stage name -> StageStats
+        self.stages = {}
+        self.traces = deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+        # the active trace and nesting depth of every thread
+        self.local = threading.local()
+        # (owner, attribute name, original) of everything that was wrapped, so it can be undone
+        self.wrapped = []
+
+    def wrap(self, owner, name, stage, root=False):
+        """"
+            Replaces owner.name (a function of a module or a method of a class) by a timed version.
+            A root stage starts a trace for a sampled fraction of its calls.
+        """
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            return self.call(stage, root, original, args, kwargs)
+
+        setattr(owner, name, timed)
+        self.wrapped.append((owner, name, original))
+        with self.lock:
+            self.stages.setdefault(stage, StageStats())
+
+    def unwrap(self):
+        for owner, name, original in reversed(self.wrapped):
+            setattr(owner, name, original)
+        self.wrapped = []
+        self.enabled = False
+
+    def call(self, stage, root, function, args, kwargs):
+        local = self.local
+        trace = getattr(local, "trace", None)
+        started = False
+        if trace is None and root and random.random() < self.sample_rate:
+            trace = local.trace = {"stage": stage, "time": time.time(), "start": time.perf_counter(), "spans": []}
+            started = True
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            local.depth = depth
+            with self.lock:
+                self.stages[stage].add(elapsed)
+            if trace is not None:
+                # (stage, nesting depth, start after the start of the trace, duration), in microseconds
+                trace["spans"].append((stage, depth, (start - trace["start"]) * 1e6, elapsed * 1e6))
+                if started:
+                    local.trace = None
+                    del trace["start"]
+                    # the spans are added when they end, sort them by start so they read top down
+                    trace["spans"].sort(key=lambda span: span[2])
+                    self.traces.append(trace)
+
+    def results(self):
+        with self.lock:
+            stages = {name: stats.as_dict() for name, stats in self.stages.items()}
+            traces = list(self.traces)
+        return {
+            "started": self.started,
+            "time": time.time(),
+            "sample_rate": self.sample_rate,
+            # the stages that took the most time first
+            "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["total_seconds"])),
+            "traces": traces,
+        }
+
+    def dump(self, path=None):
+        path = path or self.path
+        if path is None:
+            return None
+        with open(path, "w") as file:
+            json.dump(self.results(), file, indent=1)
+        log.info("Profile written to %s", os.path.abspath(path))
+        return path
+
+
+# the profiler of this process, off until enable() is called
+profiler = Profiler()
+
+
+def enable(path="profile.json", sample_rate=0.01, parser=None):
+    """"
+        Wraps all pipeline stages and writes the results to path on exit and on SIGUSR1.
+        parser is the module with handle_message and handle_uplinks (main, also when it runs as __main__).
+        Call this before the pipeline and the mapper are made.
+    """
+    import figures
+    import foreign
+    import heatmap
+    import ingest
+    import localization
+    import mapper
+    import registry
+    import signals
+    import spatial
+    import state
+    import uplinks
+    if parser is None:
+        import main as parser
+
+    if profiler.enabled:
+        return profiler
+    profiler.enabled = True
+    profiler.path = path
+    profiler.sample_rate = sample_rate
+
+    profiler.wrap(ingest.IngestPipeline, "decode", "decode")
+    profiler.wrap(ingest.IngestPipeline, "process", "batch")
+    profiler.wrap(parser, "handle_message", "packet", root=True)
+    profiler.wrap(registry.Registry, "lookup_sensor", "registry lookup")
+    profiler.wrap(registry.Registry, "lookup_gateway", "registry lookup")
+    profiler.wrap(signals.Sensor, "add_signal", "signal")
+    profiler.wrap(signals.PathLossEstimator, "update", "calibration")
+    profiler.wrap(uplinks.UplinkGrouper, "add", "uplink grouping")
+    profiler.wrap(parser, "handle_uplinks", "uplink localization")
+    profiler.wrap(foreign.ForeignTracker, "add", "foreign")
+    profiler.wrap(foreign.ForeignTracker, "localize", "foreign localization")
+    profiler.wrap(heatmap.CoverageGrid, "flush", "heatmap")
+    profiler.wrap(localization.Localizer, "run", "localization")
+    profiler.wrap(state.StateStore, "swap", "publish")
+    profiler.wrap(state.StateStore, "notify", "publish listeners")
+    profiler.wrap(mapper.Mapper, "build_figure", "map build")
+    profiler.wrap(figures.FigureEntry, "__init__", "map compress")
+    profiler.wrap(spatial.SpatialIndex, "__init__", "spatial index")
+    profiler.wrap(spatial.SpatialIndex, "query", "map view")
+
+    atexit.register(profiler.dump)
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump())
+    log.info("Profiling on, %.1f%% of the packets are traced, results go to %s", sample_rate * 100, path)
+    return profiler
+
+
+def enable_from_env(path=None, sample_rate=None, parser=None):
+    # --profile wins over LORA_PROFILE, nothing happens when neither is set
+    path = path or os.environ.get("LORA_PROFILE")
+    if not path:
+        return None
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("LORA_PROFILE_SAMPLE", "0.01"))
+    return enable(path, sample_rate, parser)
@@ -0,0 +1,183 @@
+# registry class
+# The registry holds everything we know about sensors and gateways, indexed by eui.
+# It is built once at startup from the csv files in data/ and is shared between the parser and the mapper.
+# The catalog part (what is in the csv files) is static, the live part (Sensor and Gateway objects)
+# grows as we receive packets. All lookups are dict lookups, so they take the same time no matter how many
+# sensors or gateways there are.
+# Because the catalog positions never change, the distance between every known sensor and every gateway is
+# computed once when the catalog is loaded, the path loss calibration only has to look it up.
+
+from collections import namedtuple
+import math
+
+import numpy as np
+import pandas as pd
+
+from foreign import ForeignTracker
+from heatmap import CoverageGrid
+import logs
+
+log = logs.get_logger("registry")
+
+# catalog records, these are the rows from the csv files we actually use
+SensorRecord = namedtuple("SensorRecord", ["eui", "lon", "lat", "known", "room"])
+GatewayRecord = namedtuple("GatewayRecord", ["eui", "name", "lon", "lat", "altitude"])
+
+
+def ellipsoidal_distance(lat1, lon1, lat2, lon2):
+    """"
+        Distance in meters on the WGS84 ellipsoid using the flat earth approximation with the ellipsoid
+        radii at the mean latitude (FCC 47 CFR 73.208). Works on numpy arrays and is within about ten
+        centimeters of the geodesic over the few kilometers between a sensor and a gateway.
+    """
+    mean_lat = np.radians((np.asarray(lat1) + np.asarray(lat2)) / 2)
+    k1 = 111.13209 - 0.56605 * np.cos(2 * mean_lat) + 0.00120 * np.cos(4 * mean_lat)
+    k2 = 111.41513 * np.cos(mean_lat) - 0.09455 * np.cos(3 * mean_lat) + 0.00012 * np.cos(5 * mean_lat)
+    d_lat = np.asarray(lat2) - np.asarray(lat1)
+    d_lon = np.asarray(lon2) - np.asarray(lon1)
+    return 1000 * np.sqrt((k1 * d_lat) ** 2 + (k2 * d_lon) ** 2)
+
+
+def normalize_eui(eui):
+    # the csv files and the packets do not agree on the format, so strip the colons and lowercase everything
+    return str(eui).replace(":", "").strip().lower()
+
+
+class Registry:
+    def __init__(self, sensor_data, gateway_data):
+        # catalog lookup tables (eui -> record)
+        self.sensor_catalog = {}
+        self.gateway_catalog = {}
+
+        # live objects, the lists keep the order in which we found them (the mapper draws them in that order)
+        self.sensors = []
+        self.gateways = []
+        self.sensors_by_eui = {}
+        self.gateways_by_eui = {}
+
+        # gateways that sent us packets but are not in the csv, with the number of packets we saw from them
+        self.unknown_gateways = {}
+
+        # devices without eui (foreign traffic), keyed by their short address
+        self.foreign = ForeignTracker()
+
+        self.load_sensors(sensor_data)
+        self.load_gateways(gateway_data)
+
+        # rssi heatmap over the area of the catalog
+        catalog = [r for r in self.sensor_catalog.values() if r.known] + list(self.gateway_catalog.values())
+        self.coverage = CoverageGrid.around([r.lat for r in catalog], [r.lon for r in catalog])
+
+        # known sensors x gateways distance matrix (meters), with the row/column of every eui
+        self.sensor_index = {}
+        self.gateway_index = {}
+        self.distances = np.zeros((0, 0))
+        self.distance_error = 0.0
+        self.build_distance_matrix()
+
+    @classmethod
+    def from_csv(cls, sensor_path='data/sensor_locations.csv', gateway_path='data/gateway_locations.csv'):
+        return cls(pd.read_csv(sensor_path), pd.read_csv(gateway_path))
+
+    def load_sensors(self, sensor_data):
+        # only look at the columns once, iterating over plain python lists is a lot faster than iterrows
+        euis = sensor_data['Sensor_Eui'].astype(str).tolist()
+        lons = sensor_data['St_X'].tolist()
+        lats = sensor_data['St_Y'].tolist()
+        rooms = sensor_data['Roomname'].tolist() if 'Roomname' in sensor_data else [None] * len(euis)
+
+        for eui, lon, lat, room in zip(euis, lons, lats, rooms):
+            eui = normalize_eui(eui)
+
+            # the first row wins, this is the same as the old .values[0] lookup
+            if eui in self.sensor_catalog:
+                continue
+
+            # some sensors in the csv have no location
+            known = not (math.isnan(lon) or math.isnan(lat))
+            self.sensor_catalog[eui] = SensorRecord(eui, lon, lat, known, room)
+
+    def load_gateways(self, gateway_data):
+        for eui, name, lat, lon, altitude in zip(
+                gateway_data['eui'].astype(str).tolist(),
+                gateway_data['name'].astype(str).tolist(),
+                gateway_data['latitude'].tolist(),
+                gateway_data['longitude'].tolist(),
+                gateway_data['altitude'].tolist()):
+            eui = normalize_eui(eui)
+            if eui in self.gateway_catalog:
+                continue
+            self.gateway_catalog[eui] = GatewayRecord(eui, name.strip(), float(lon), float(lat), float(altitude))
+
+    def build_distance_matrix(self, nr_of_checks=50):
+        # only sensors with a location get a row
+        sensors = [r for r in self.sensor_catalog.values() if r.known]
+        gateways = list(self.gateway_catalog.values())
+        self.sensor_index = {r.eui: i for i, r in enumerate(sensors)}
+        self.gateway_index = {r.eui: j for j, r in enumerate(gateways)}
+
+        sensor_lat = np.array([r.lat for r in sensors], dtype=float)
+        sensor_lon = np.array([r.lon for r in sensors], dtype=float)
+        gateway_lat = np.array([r.lat for r in gateways], dtype=float)
+        gateway_lon = np.array([r.lon for r in gateways], dtype=float)
+        self.distances = ellipsoidal_distance(sensor_lat[:, None], sensor_lon[:, None],
+                                              gateway_lat[None, :], gateway_lon[None, :])
+
+        # compare a few entries with the exact geodesic, so we notice when the approximation is not good enough
+        if self.distances.size:
+            self.distance_error = self.check_distance_matrix(sensors, gateways, nr_of_checks)
+
+    def check_distance_matrix(self, sensors, gateways, nr_of_checks):
+        # largest relative error between the matrix and geopy's geodesic for a spread of sensor/gateway pairs
+        from geopy.distance import geodesic
+
+        rows, cols = self.distances.shape
+        worst = 0.0
+        for k in np.linspace(0, rows * cols - 1, min(nr_of_checks, rows * cols)).astype(int):
+            i, j = divmod(int(k), cols)
+            exact = geodesic((sensors[i].lat, sensors[i].lon), (gateways[j].lat, gateways[j].lon)).meters
+            if exact > 0:
+                worst = max(worst, abs(self.distances[i, j] - exact) / exact)
+        if worst > 0.001:
+            log.warning("Distance matrix is off by %.3f%% compared to the geodesic", worst * 100)
+        return worst
+
+    def true_distance(self, sensor_eui, gateway_eui):
+        # distance in meters between a known sensor and a gateway from the catalog, None if one of them is unknown
+        i = self.sensor_index.get(sensor_eui)
+        j = self.gateway_index.get(gateway_eui)
+        if i is None or j is None:
+            return None
+        return float(self.distances[i, j])
+
+    def lookup_sensor(self, eui):
+        # catalog record of a sensor, None if the sensor is not in the csv
+        return self.sensor_catalog.get(eui)
+
+    def lookup_gateway(self, eui):
+        # catalog record of a gateway, None if the gateway is not in the csv
+        return self.gateway_catalog.get(eui)
+
+    def get_sensor(self, eui):
+        # live sensor object, None if we have not received anything from it yet
+        return self.sensors_by_eui.get(eui)
+
+    def get_gateway(self, eui):
+        # live gateway object, None if we have not received anything through it yet
+        return self.gateways_by_eui.get(eui)
+
+    def add_sensor(self, sensor):
+        self.sensors.append(sensor)
+        self.sensors_by_eui[sensor.get_sensor_id()] = sensor
+        return sensor
+
+    def add_gateway(self, gateway):
+        self.gateways.append(gateway)
+        self.gateways_by_eui[gateway.get_gateway_id()] = gateway
+        return gateway
+
+    def mark_unknown_gateway(self, eui):
+        # count packets from gateways that are not in the csv, returns True the first time we see one
+        count = self.unknown_gateways.get(eui, 0)
+        self.unknown_gateways[eui] = count + 1
+        return count == 0
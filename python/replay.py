@@ -0,0 +1,137 @@
+# replay server
+# Serves a capture file (see capture.py) as a local stand-in for the lora websocket, so we can run main.py
+# against recorded traffic and load test it:
+#     python replay.py capture.bin --speed 10 --loop --multiply 50
+#     python main.py --url ws://localhost:1337
+# --speed 1 replays in real time, --speed N N times faster and --speed max as fast as the client reads.
+# --multiply K sends every frame K times with a different device eui and address for every copy, which looks
+# like a network with K times as many devices (K is at most 256, the copies differ in the first byte).
+# Every client that connects gets its own replay from the start of the capture. Without --loop the connection
+# stays open after the last frame until the client closes it, so a client that reconnects on close does not get
+# the capture twice.
+
+import argparse
+import asyncio
+import json
+import time
+
+from websockets.asyncio.server import serve
+
+from capture import read_capture
+
+
+MAX_COPIES = 256
+
+
+def copy_id(value, copy):
+    # changes the first byte of a hex eui/address so every copy looks like a different device
+    if copy == 0 or not value:
+        return value
+    try:
+        first = int(value[:2], 16)
+    except (TypeError, ValueError):
+        # not hex, still make it unique per copy
+        return "%s-%d" % (value, copy)
+    return "%02x" % ((first + copy) % MAX_COPIES) + value[2:]
+
+
+def multiply_frame(frame, copies):
+    # the original frame and copies-1 copies with other device ids
+    if copies <= 1:
+        return [frame]
+    try:
+        msg = json.loads(frame)
+    except json.JSONDecodeError:
+        return [frame]
+
+    frames = [frame]
+    for copy in range(1, copies):
+        clone = dict(msg)
+        if 'device_eui' in clone:
+            clone['device_eui'] = copy_id(clone['device_eui'], copy)
+        if 'device_addr' in clone:
+            clone['device_addr'] = copy_id(clone['device_addr'], copy)
+        frames.append(json.dumps(clone))
+    return frames
+
+
+class ReplayServer:
+    def __init__(self, path, speed=1.0, loop=False, multiply=1):
+        self.path = path
+        # None means as fast as possible
+        self.speed = speed
+        self.loop = loop
+        self.multiply = multiply
+
+    async def handler(self, websocket):
+        print("[Replay]: Client connected")
+        sent = 0
+        start = time.time()
+        while True:
+            # replay on a fixed schedule relative to the first frame, so sleeping does not add up to drift
+            replay_start = time.monotonic()
+            first = None
+            for timestamp, frame in read_capture(self.path):
+                if first is None:
+                    first = timestamp
+                if self.speed is not None:
+                    wait = (timestamp - first) / self.speed - (time.monotonic() - replay_start)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+
+                for out in multiply_frame(frame, self.multiply):
+                    await websocket.send(out)
+                    sent += 1
+
+                # let other clients (and the socket) do some work when running at max speed
+                if self.speed is None and sent % 1000 == 0:
+                    await asyncio.sleep(0)
+
+            if not self.loop or first is None:
+                break
+
+        print("[Replay]: Sent %d frames in %.1f s" % (sent, time.time() - start))
+        # returning would close the connection, keep it open until the client is done
+        await websocket.wait_closed()
+
+    async def serve(self, host, port):
+        async with serve(self.handler, host, port):
+            print("[Replay]: Serving %s on ws://%s:%d" % (self.path, host, port))
+            await asyncio.get_running_loop().create_future()
+
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def parse_multiply(value):
+    copies = int(value)
+    if not 1 <= copies <= MAX_COPIES:
+        raise argparse.ArgumentTypeError("multiply must be between 1 and %d" % MAX_COPIES)
+    return copies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a lora capture file as a websocket server")
+    parser.add_argument("capture", help="capture file written with main.py --record")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1337)
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="replay speed factor, or 'max'")
+    parser.add_argument("--loop", action="store_true", help="start over at the end of the capture")
+    parser.add_argument("--multiply", type=parse_multiply, default=1, help="send every frame as this many devices")
+    args = parser.parse_args()
+
+    server = ReplayServer(args.capture, args.speed, args.loop, args.multiply)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# shared state
+# Lets the ingest and the web server run in different processes (see web.py):
+#     python main.py --mode ingest --state-file /dev/shm/lora_state
+#     LORA_STATE_FILE=/dev/shm/lora_state gunicorn -w 4 -k gthread --threads 32 -b 0.0.0.0:8050 web:server
+# The ingest process writes every new snapshot of its StateStore to a memory mapped file, the web workers map the
+# same file and read it. The file is
+#     header: magic, sequence number, snapshot version, data length, snapshot time
+#     data:   the snapshot as json (the fields of the SensorView, GatewayView and CoverageView tuples)
+# The header and data are protected by a sequence lock: the writer makes the sequence number odd, writes, and
+# makes it even again. A reader copies the data and checks the sequence number did not change while it read,
+# otherwise it tries again. Readers never block the writer and never see half a snapshot.
+# The file is sparse, so its capacity only costs memory for the part that is used.
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from packets import loads
+from state import EMPTY_COVERAGE, CoverageView, GatewayView, SensorView, StateStore, build_snapshot
+import logs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logs.get_logger("main")
+
+MAGIC = b"LORASTA1"
+# magic, sequence, version, data length, snapshot time
+HEADER = struct.Struct("<8sQQQd")
+DATA_OFFSET = 64
+DEFAULT_CAPACITY = 64 * 1024 * 1024
+
+
+def default_state_file():
+    # /dev/shm is memory on linux, anywhere else a file in the temp dir (the page cache keeps it in memory)
+    folder = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.environ.get("LORA_STATE_FILE", os.path.join(folder, "lora_state"))
+
+
+def encode_snapshot(snapshot):
+    data = {
+        "sensors": [list(s) for s in snapshot.sensors],
+        "gateways": [list(g) for g in snapshot.gateways],
+        "coverage": list(snapshot.coverage),
+    }
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def decode_snapshot(version, timestamp, data):
+    data = loads(data)
+    sensors = []
+    for fields in data["sensors"]:
+        # the gateways of a sensor are a tuple in the view, json made it a list
+        fields[9] = tuple(fields[9])
+        sensors.append(SensorView(*fields))
+    gateways = [GatewayView(*fields) for fields in data["gateways"]]
+    version_of_coverage, lats, lons, strength, rssi = data.get("coverage", EMPTY_COVERAGE)
+    coverage = CoverageView(version_of_coverage, tuple(lats), tuple(lons), tuple(strength), tuple(rssi))
+    return build_snapshot(version, timestamp, sensors, gateways, coverage)
+
+
+class SharedStateWriter:
+    """"
+        Writes the snapshots of a StateStore to the state file, use it as listener: store.add_listener(writer.write)
+    """
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY):
+        self.path = path or default_state_file()
+        self.capacity = capacity
+        self.file = open(self.path, "a+b")
+        if os.path.getsize(self.path) < DATA_OFFSET + capacity:
+            self.file.truncate(DATA_OFFSET + capacity)
+        self.map = mmap.mmap(self.file.fileno(), DATA_OFFSET + capacity)
+
+        # continue the sequence and versions of an earlier ingest process, so readers only see them go up
+        magic, sequence, version, _, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            sequence, version = 0, 0
+        self.sequence = sequence + (sequence & 1)
+        self.base_version = version
+        self.lock = threading.Lock()
+        self.nr_of_writes = 0
+
+    def write(self, old, new):
+        data = encode_snapshot(new)
+        if len(data) > self.capacity:
+            log.error("Snapshot of %d bytes does not fit in the state file (%d bytes), not written",
+                      len(data), self.capacity)
+            return False
+
+        version = self.base_version + new.version
+        with self.lock:
+            # odd: a write is busy
+            self.sequence += 1
+            struct.pack_into("<8sQ", self.map, 0, MAGIC, self.sequence)
+            self.map[DATA_OFFSET:DATA_OFFSET + len(data)] = data
+            HEADER.pack_into(self.map, 0, MAGIC, self.sequence, version, len(data), new.time)
+            # even: done
+            self.sequence += 1
+            struct.pack_into("<8sQ", self.map, 0, MAGIC, self.sequence)
+            self.nr_of_writes += 1
+        return True
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SharedStateReader(StateStore):
+    """"
+        A StateStore that gets its snapshots from the state file instead of a registry.
+        The mapper and the delta broadcaster use it like a normal StateStore.
+    """
+    def __init__(self, path=None, interval=0.25):
+        super().__init__(interval)
+        self.path = path or default_state_file()
+        self.file = None
+        self.map = None
+        self.sequence = None
+        self.nr_of_retries = 0
+
+    def open(self):
+        # the ingest process may not have made the file yet
+        if self.map is not None:
+            return True
+        try:
+            self.file = open(self.path, "rb")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            return False
+        return True
+
+    def read(self):
+        """"
+            (sequence, version, time, data) of the snapshot in the file, None when there is none (yet)
+        """
+        if not self.open():
+            return None
+        for _ in range(1000):
+            magic, sequence, version, length, timestamp = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                return None
+            if sequence & 1:
+                # the writer is busy
+                self.nr_of_retries += 1
+                time.sleep(0.0001)
+                continue
+            data = self.map[DATA_OFFSET:DATA_OFFSET + length]
+            if struct.unpack_from("<8sQ", self.map, 0)[1] == sequence:
+                return sequence, version, timestamp, data
+            self.nr_of_retries += 1
+        return None
+
+    def poll(self):
+        # cheap when nothing changed: only the sequence number is read
+        if not self.open():
+            return False
+        if struct.unpack_from("<8sQ", self.map, 0)[1] == self.sequence:
+            return False
+        result = self.read()
+        if result is None:
+            return False
+        sequence, version, timestamp, data = result
+        self.sequence = sequence
+        return self.load(decode_snapshot(version, timestamp, data))
+
+    def load(self, snapshot):
+        with self.publish_lock:
+            current = self.snapshot
+            if snapshot.version == current.version or snapshot.same_content(current):
+                return False
+            self.snapshot = snapshot
+            for listener in self.listeners:
+                listener(current, snapshot)
+            return True
+
+    def start(self, registry=None, lock=None):
+        # poll the file in the background, there is no registry in this process
+        self.poll()
+        self.thread = threading.Thread(target=self.poller, daemon=True)
+        self.thread.start()
+
+    def poller(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                log.warning("Could not read the state file: %s", e)
+            time.sleep(self.interval)
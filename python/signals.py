@@ -7,38 +7,239 @@
 #     time of flight
 #     altitude
 #     RSSI
-from math import cos, radians
+from math import cos, radians, log10, sqrt
+from collections import deque
+from types import MappingProxyType
+import time
 import numpy as np
-from scipy.optimize import curve_fit
 from geopy.distance import geodesic
 
+from localization import multilaterate_signals
+from metrics import metrics
+import logs
+
+log = logs.get_logger("localization")
+calibration_log = logs.get_logger("calibration")
+calibration_seconds = metrics.histogram("lora_calibration_update_seconds", "Time of one path loss model update")
+
 #Global parameters used for rssi based distance calculation
 #Should be global so all sensors can use the same information
 transmition_power = 14
-n = 5.6 #path loss exponent, tuneable range [2; 3.5]
-true_distances = []
-RSSIs = []
+signal_history = 100 #number of raw signals each sensor keeps
+fix_history = 50 #number of uplink positions each sensor keeps
+
+
+class PathLossEstimator:
+    """"
+        Recursive least squares estimate of the log distance path loss model
+            RSSI = transmition_power - 10 * n * log10(d)
+        Every observation updates the estimate in constant time and memory, so nothing is stored per packet.
+        forgetting (0 < forgetting <= 1) slowly forgets old observations, half_life (seconds) forgets
+        based on the time between observations. With fit_power the transmition power is estimated as well.
+        path_loss_exponent is only where the estimate starts, use path_loss.n for the current exponent.
+    """
+    def __init__(self, power=transmition_power, path_loss_exponent=5.6, forgetting=0.999, half_life=None,
+                 fit_power=False, prior_variance=100.0, min_distance=1.0):
+        self.power = float(power)
+        self.n = float(path_loss_exponent)
+        self.forgetting = forgetting
+        self.half_life = half_life
+        self.fit_power = fit_power
+        self.min_distance = min_distance
+
+        # covariance matrix of [power, n] (symmetric, so three values), a large prior means we trust the data quickly
+        self.p_pp = prior_variance if fit_power else 0.0
+        self.p_pn = 0.0
+        self.p_nn = prior_variance
+
+        # exponentially weighted residual variance and effective number of samples
+        self.residual_variance = 0.0
+        self.weight = 0.0
+        self.nr_of_updates = 0
+        self.last_update = None
+
+    def decay(self, timestamp):
+        # forgetting factor for this update, optionally combined with the time since the last update
+        lam = self.forgetting
+        if self.half_life is not None and self.last_update is not None:
+            lam *= 0.5 ** (max(timestamp - self.last_update, 0.0) / self.half_life)
+        return lam
+
+    def update(self, rssi, distance, timestamp=None):
+        """"
+            Adds one (rssi, true distance) observation and returns the new n
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        lam = max(self.decay(timestamp), 1e-6)
+        self.last_update = timestamp
+
+        # regressor of the model, rssi = power * 1 + n * x
+        x = -10 * log10(max(distance, self.min_distance))
+        error = rssi - (self.power + self.n * x)
+
+        # P @ phi with phi = [1, x]
+        g_p = self.p_pp + self.p_pn * x
+        g_n = self.p_pn + self.p_nn * x
+        denominator = lam + g_p + g_n * x
+        k_p = g_p / denominator
+        k_n = g_n / denominator
+
+        # update the estimate and the covariance
+        self.power += k_p * error
+        self.n += k_n * error
+        self.p_pp = (self.p_pp - k_p * g_p) / lam
+        self.p_pn = (self.p_pn - k_p * g_n) / lam
+        self.p_nn = (self.p_nn - k_n * g_n) / lam
+
+        self.weight = lam * self.weight + 1
+        self.residual_variance += (error * error - self.residual_variance) / self.weight
+        self.nr_of_updates += 1
+        return self.n
+
+    def confidence(self):
+        """"
+            Standard deviation of n, large when we have not seen enough (or too similar) distances
+        """
+        if self.nr_of_updates < 2:
+            return float('inf')
+        return sqrt(max(self.residual_variance * self.p_nn, 0.0))
+
+    def distance(self, rssi):
+        # invert the model, rssi -> distance in meters
+        return 10 ** ((self.power - rssi) / (10 * self.n))
+
+
+# shared estimator used by every signal
+path_loss = PathLossEstimator()
+
+
+class ModelTable:
+    """"
+        Path loss models per gateway and spreading factor, (gateway eui, sf) -> (power, n). The calibration
+        worker (calibration.py) fits them in the background and publishes a whole new table at once, so a
+        lookup never sees half an update. A lookup falls back from (gateway, sf) to (gateway, None) to
+        (None, sf), and to the global path_loss when none of them is in the table. The global path_loss is
+        not in the table, it is updated right away on every observation.
+    """
+    def __init__(self, history=100000):
+        # replaced as a whole, never changed in place
+        self.models = MappingProxyType({})
+        self.version = 0
+        # (gateway, sf, rssi, true distance, time) for the calibration worker, the oldest are dropped when it
+        # falls behind
+        self.observations = deque(maxlen=history)
+        # set while a calibration worker takes the observations
+        self.background = False
+
+    def observe(self, gateway, sf, rssi, distance, timestamp=None):
+        # the global model is the fallback of every distance, it has to be good from the first packets on
+        path_loss.update(rssi, distance, timestamp)
+        calibration_log.debug("updated n: %.3f", path_loss.n)
+        if self.background:
+            self.observations.append((gateway, sf, rssi, distance, timestamp))
+
+    def publish(self, models):
+        models = dict(models)
+        # checkpoints of older versions have the global model in the table, the live path_loss is newer
+        models.pop((None, None), None)
+        self.models = MappingProxyType(models)
+        self.version += 1
+
+    def lookup(self, gateway, sf):
+        models = self.models
+        return models.get((gateway, sf)) or models.get((gateway, None)) or models.get((None, sf))
+
+    def distance(self, rssi, gateway=None, sf=None):
+        model = self.lookup(gateway, sf) if self.models else None
+        if model is None:
+            return path_loss.distance(rssi)
+        power, n = model
+        return 10 ** ((power - rssi) / (10 * n))
+
+
+# the table every signal reads its distance model from
+path_loss_models = ModelTable()
+
+
+class RunningStats:
+    """"
+        Running count, mean and variance (Welford), updated in constant time without storing the samples
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+
+class GatewayStats:
+    """"
+        Running statistics of all signals from one sensor received by one gateway
+    """
+    def __init__(self, eui_of_gateway):
+        self.eui_of_gateway = eui_of_gateway
+        self.rssi = RunningStats()
+        self.snr = RunningStats()
+        self.distance = RunningStats()
+        self.first_seen = None
+        self.last_seen = None
+
+    def add(self, signal):
+        self.rssi.add(signal.RSSI)
+        self.distance.add(signal.distance)
+        if signal.snr is not None:
+            self.snr.add(signal.snr)
+        if self.first_seen is None:
+            self.first_seen = signal.time
+        self.last_seen = signal.time
+
+    def get_count(self):
+        return self.rssi.count
 
 
 class Signal:
-    def __init__(self,  eui_of_gateway, RSSI, lon, lat,):
+    # there is one signal per packet, slots keep them small and the attribute access fast
+    __slots__ = ("eui_of_gateway", "RSSI", "snr", "sf", "distance", "lon", "lat", "time", "true_distance")
+
+    def __init__(self,  eui_of_gateway, RSSI, lon, lat, snr=None, timestamp=None, true_distance=None, sf=None):
         self.eui_of_gateway = eui_of_gateway
 
 
         self.RSSI = RSSI
+        self.snr = snr
+        # spreading factor of the packet, the path loss model can be different per spreading factor
+        self.sf = sf
         self.distance= self.distance_estimate()
 
         self.lon = lon  # longitude of gateway
         self.lat = lat  # lattitude of gateway
 
+        # time we received the signal
+        self.time = timestamp if timestamp is not None else time.time()
+
+        # distance between the gateway and the catalog position of the sensor, if we know it
+        self.true_distance = true_distance
+
 
 
     def distance_estimate(self):
         # max is 14dB. recieved signal strength usually negative. look a the attenuation we can find the distance.
-        return 10 ** ((transmition_power - self.RSSI) / (10 * n))
+        # the model of this gateway and spreading factor, when the calibration has one
+        return path_loss_models.distance(self.RSSI, self.eui_of_gateway, self.sf)
 
 class Sensor:
-    def __init__(self, name_of_sensor, known, eui_of_sensor, lon, lat):
+    def __init__(self, name_of_sensor, known, eui_of_sensor, lon, lat, history=None):
         self.eui_of_sensor = eui_of_sensor
         self.known = known
 
@@ -54,23 +255,30 @@ class Sensor:
 
         self.nr_of_packets = 0
 
-        #Array with all signals recieved from sensor
-        self.raw_signals = []
+        #set when new signals arrived since the last position estimate
+        self.needs_localization = False
+        #set when the Localizer wrote a real estimate, before that an unknown sensor is at a placeholder position
+        self.localized = False
+
+        #the last positions of single uplinks (see uplinks.py), their median refines the estimate from the
+        #average distances when the two agree (see localization.combine_with_fixes)
+        self.fixes = deque(maxlen=fix_history)
+        self.nr_of_fixes = 0
+
+        #Ring buffer with the last signals recieved from sensor, the oldest are dropped when it is full
+        self.raw_signals = deque(maxlen=history if history is not None else signal_history)
 
         #Array with average signal for each gateway from senor
         self.avg_signals = []
 
-    def rssi_model(self, d, path_loss_exponent):
-        """"
-                    rssi_model calculates RSSI based
-                    based on the true distance and n
-                """
-        return transmition_power - 10 * path_loss_exponent * np.log10(d)
+        #Running statistics for each gateway (eui -> GatewayStats) and the matching average signal
+        self.gateway_stats = {}
+        self.avg_signal_by_gateway = {}
 
     def get_lon(self):
         return self.lon
     def pos_is_estimated(self):
-        return len(self.avg_signals) >= 3
+        return len(self.avg_signals) >= 3 or self.nr_of_fixes > 0
     def get_lat(self):
         return self.lat
 
@@ -118,21 +326,14 @@ class Sensor:
 
         #if we know the actual location
         if self.known:
-            #update the global variables
-            global n
-            global RSSIs
-            global true_distances
-
-            #add the RSSI and True distance
-            RSSIs.append(signal.RSSI)
-            true_distances.append(geodesic((self.known_lat, self.known_lon), (signal.lat, signal.lon)).meters)
-            print(f'true distances: {true_distances[:5]}')
-            #Fit the RSSI_model to the true distance and RSSI
-            params, _ = curve_fit(self.rssi_model, true_distances, RSSIs, p0=[3])
-
-            #Update n
-            n = params[0]
-            print(f'updated n: {n}')
+            #update the global estimate with the RSSI and the true distance
+            #the parser fills in the true distance from the registry's distance matrix
+            true_distance = signal.true_distance
+            if true_distance is None:
+                true_distance = geodesic((self.known_lat, self.known_lon), (signal.lat, signal.lon)).meters
+            start = time.perf_counter()
+            path_loss_models.observe(signal.eui_of_gateway, signal.sf, signal.RSSI, true_distance, signal.time)
+            calibration_seconds.observe(time.perf_counter() - start)
 
         # add signal to the raw signals
         self.raw_signals.append(signal)
@@ -140,30 +341,45 @@ class Sensor:
         # use signal to update the avg_signal array
         self.average_distances_to_gateway(signal)
 
-        print(f'Connected to {len(self.avg_signals)}, different gateways \n')
+        log.debug("Connected to %d different gateways", len(self.avg_signals))
+
+        #the position is not estimated here, the localization.Localizer estimates all sensors
+        #that received new signals (and are connected to 3 different gateways) in one go
+        self.needs_localization = True
 
-        #if signal recieved by 3 different gateways
-        if len(self.avg_signals) >= 3:
-            #estimate the lat and lon
-            self.lat, self.lon = self.multilateration(self.avg_signals)
-            print(f'estimated lat, lon: {self.lat}; {self.lon}')
 
+    def add_fix(self, lat, lon):
+        """"
+            Adds the position of one uplink, the Localizer combines the fixes with its estimate
+        """
+        self.fixes.append((lat, lon))
+        self.nr_of_fixes += 1
+        self.needs_localization = True
 
     def average_distances_to_gateway(self, new_signal):
         # Check if this gateway already has an average signal
-        for avg_signal in self.avg_signals:
-            if avg_signal.eui_of_gateway == new_signal.eui_of_gateway:
-                # Count how many previous raw signals came from this gateway
-                count = sum(1 for s in self.raw_signals if s.eui_of_gateway == new_signal.eui_of_gateway)
-                # Compute new average
-                previous_avg_distance = avg_signal.distance
-                new_avg_distance = (previous_avg_distance * count + new_signal.distance) / (count + 1)
-                print(f'average distance distance to {avg_signal.eui_of_gateway}, is: {new_avg_distance}')
-                avg_signal.distance = new_avg_distance
-                return
+        stats = self.gateway_stats.get(new_signal.eui_of_gateway)
 
         # If not found, add new signal to avg_signals
-        self.avg_signals.append(Signal(new_signal.eui_of_gateway, new_signal.RSSI, new_signal.lon,new_signal.lat))
+        if stats is None:
+            stats = GatewayStats(new_signal.eui_of_gateway)
+            self.gateway_stats[new_signal.eui_of_gateway] = stats
+            avg_signal = Signal(new_signal.eui_of_gateway, new_signal.RSSI, new_signal.lon, new_signal.lat,
+                                new_signal.snr, new_signal.time)
+            self.avg_signal_by_gateway[new_signal.eui_of_gateway] = avg_signal
+            self.avg_signals.append(avg_signal)
+        else:
+            avg_signal = self.avg_signal_by_gateway[new_signal.eui_of_gateway]
+
+        # update the running statistics and copy the new averages to the average signal
+        stats.add(new_signal)
+        avg_signal.RSSI = stats.rssi.mean
+        avg_signal.distance = stats.distance.mean
+        if stats.snr.count:
+            avg_signal.snr = stats.snr.mean
+        avg_signal.time = stats.last_seen
+        if stats.get_count() > 1:
+            log.debug("average distance to %s is %.1f", avg_signal.eui_of_gateway, avg_signal.distance)
 
     def multilateration(self, gateways):
         """"
@@ -171,41 +387,8 @@ class Sensor:
             I dont fully understand how the calculation works
         """
         # gateways: list of signals with (lat, lon, distance)
-        lat0 = sum(g.lat for g in gateways) / len(gateways)
-        lon0 = sum(g.lon for g in gateways) / len(gateways)
-
-        positions = [self.latlon_to_xy(g.lat, g.lon, lat0, lon0) for g in gateways]
-        distances = [g.distance for g in gateways]
-
-        # Set up equations using the first as a reference
-        x1, y1 = positions[0]
-        r1 = distances[0]
-        A = []
-        b = []
-
-        for i in range(1, len(positions)):
-            xi, yi = positions[i]
-            ri = distances[i]
-            A.append([2 * (xi - x1), 2 * (yi - y1)])
-            b.append((r1 ** 2 - ri ** 2) - (x1 ** 2 - xi ** 2 + y1 ** 2 - yi ** 2))
-
-        A = np.array(A)
-        b = np.array(b)
-
-        # Weight inversely proportional to distance squared (more trust in nearby gateways)
-        weights = 1 / (np.array(distances[1:]) ** 2)
-        W = np.diag(weights)
-
-        # Solve weighted least squares
-        AtW = A.T @ W
-        result = np.linalg.inv(AtW @ A) @ AtW @ b
-
-        x, y = result
-
-        # Convert back to lat/lon using inverse of latlon_to_xy
-        lat, lon = self.xy_to_latlon(x, y, lat0, lon0)
-
-        return lat, lon
+        # the gateway geometry is cached, see localization.multilaterate_signals
+        return multilaterate_signals(gateways)
 
 
 # gateway
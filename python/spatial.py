@@ -0,0 +1,199 @@
+# spatial index
+# With many sensors and foreign devices the map cannot get every point: the figure and the event stream would grow
+# with the traffic. For large snapshots the browser asks for its viewport instead (/map/view, see map_stream.js)
+# and gets at most max_points entries back:
+#     - all devices in the viewport, when there are not more than max_points of them
+#     - otherwise clusters: the devices are grouped per quadtree cell of about cluster_size pixels at the zoom of
+#       the browser, a cluster with one device is sent as that device
+# The index is a linear quadtree: every device gets the morton code (interleaved bits of its web mercator tile
+# x and y at MAX_LEVEL) and the devices are sorted by it. All devices of a quadtree cell at a lower level are then
+# next to each other, so the clusters of any zoom are found with one shift and one pass over the sorted codes.
+# The index is built once per snapshot version, every answer is encoded and compressed once per viewport.
+
+from collections import OrderedDict, namedtuple
+import json
+import math
+import threading
+
+import numpy as np
+
+from figures import FigureEntry
+from metrics import metrics
+from streaming import encode_gateway, encode_sensor
+
+MAX_LEVEL = 24
+# mapbox draws the world 512 pixels wide at zoom 0
+TILE_SIZE = 512
+MAX_LAT = 85.05112878
+
+view_requests = metrics.counter("lora_map_view_requests_total", "Viewport requests of the map")
+
+Viewport = namedtuple("Viewport", ["zoom", "south", "west", "north", "east"])
+
+
+def mercator(lat, lon):
+    # web mercator position as a fraction of the world (0..1), y goes down from the north
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LAT, MAX_LAT))
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0
+    return x, y
+
+
+def spread_bits(v):
+    # 24 bits abcd.. -> 0a0b0c0d..
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_codes(lat, lon):
+    x, y = mercator(lat, lon)
+    side = 1 << MAX_LEVEL
+    ix = np.clip((x * side).astype(np.int64), 0, side - 1)
+    iy = np.clip((y * side).astype(np.int64), 0, side - 1)
+    return spread_bits(ix) | (spread_bits(iy) << np.uint64(1))
+
+
+def viewport_around(lat, lon, zoom, width=1920, height=1080):
+    # the area a map of width x height pixels shows around this center
+    world = TILE_SIZE * 2.0 ** zoom
+    x, y = mercator(lat, lon)
+    half_x = width / 2.0 / world
+    half_y = height / 2.0 / world
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (float(y) - half_y)))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (float(y) + half_y)))))
+    return Viewport(zoom, south, lon - half_x * 360.0, north, lon + half_x * 360.0)
+
+
+def device_kind(sensor):
+    # column in the kind counts of a cluster
+    if sensor.known:
+        return 0
+    return 2 if sensor.foreign else 1
+
+
+class SpatialIndex:
+    def __init__(self, snapshot):
+        self.version = snapshot.version
+        sensors = snapshot.sensors
+        lat = np.array([s.lat for s in sensors], dtype=float)
+        lon = np.array([s.lon for s in sensors], dtype=float)
+        codes = morton_codes(lat, lon)
+        order = np.argsort(codes, kind="stable")
+
+        # everything sorted by morton code
+        self.sensors = [sensors[i] for i in order.tolist()]
+        self.codes = codes[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+        self.kinds = np.zeros((len(sensors), 3))
+        self.kinds[np.arange(len(sensors)), [device_kind(s) for s in self.sensors]] = 1.0
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def query(self, viewport, max_points=2000, cluster_size=64):
+        """"
+            (devices, clusters) in the viewport, together never more than max_points.
+            A cluster is [lat, lon, count, known, unknown, foreign] with the mean position of its devices.
+        """
+        inside = np.flatnonzero((self.lat >= viewport.south) & (self.lat <= viewport.north)
+                                & (self.lon >= viewport.west) & (self.lon <= viewport.east))
+        if len(inside) <= max_points:
+            return [self.sensors[i] for i in inside.tolist()], []
+
+        # the quadtree level with cells of about cluster_size pixels, coarser while there are too many clusters
+        level = int(math.floor(viewport.zoom + math.log2(TILE_SIZE / cluster_size)))
+        level = min(max(level, 0), MAX_LEVEL)
+        codes = self.codes[inside]
+        while True:
+            cells = codes >> np.uint64(2 * (MAX_LEVEL - level))
+            starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+            if len(starts) <= max_points or level == 0:
+                break
+            level -= 1
+
+        counts = np.diff(np.r_[starts, len(cells)])
+        lats = np.add.reduceat(self.lat[inside], starts) / counts
+        lons = np.add.reduceat(self.lon[inside], starts) / counts
+        kinds = np.add.reduceat(self.kinds[inside], starts, axis=0)
+
+        devices = []
+        clusters = []
+        for start, count, lat, lon, kind in zip(starts.tolist(), counts.tolist(), lats.tolist(), lons.tolist(),
+                                                kinds.tolist()):
+            if count == 1:
+                devices.append(self.sensors[inside[start]])
+            else:
+                clusters.append([round(lat, 6), round(lon, 6), count] + [int(k) for k in kind])
+        return devices, clusters
+
+
+class ViewCache:
+    def __init__(self, max_points=2000, cluster_size=64, maxsize=256):
+        self.max_points = max_points
+        self.cluster_size = cluster_size
+        self.maxsize = maxsize
+        self.index = None
+        # (version, zoom, tile bounds) -> FigureEntry with the encoded answer
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_index(self, snapshot):
+        index = self.index
+        if index is None or index.version != snapshot.version:
+            index = self.index = SpatialIndex(snapshot)
+        return index
+
+    def snap(self, viewport):
+        # viewports are widened to whole tiles at their zoom, so small pans of a map give the same answer
+        zoom = min(max(int(math.floor(viewport.zoom)), 0), MAX_LEVEL)
+        side = 2 ** zoom
+        x1, y1 = mercator(viewport.north, viewport.west)
+        x2, y2 = mercator(viewport.south, viewport.east)
+        tiles = (int(math.floor(float(x1) * side)), int(math.floor(float(y1) * side)),
+                 int(math.ceil(float(x2) * side)), int(math.ceil(float(y2) * side)))
+
+        def lat_of(y):
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / side))))
+
+        snapped = Viewport(zoom, lat_of(tiles[3]), tiles[0] / side * 360.0 - 180.0, lat_of(tiles[1]),
+                           tiles[2] / side * 360.0 - 180.0)
+        return (zoom,) + tiles, snapped
+
+    def query(self, snapshot, viewport):
+        index = self.get_index(snapshot)
+        _, snapped = self.snap(viewport)
+        return index.query(snapped, self.max_points, self.cluster_size)
+
+    def get(self, snapshot, viewport):
+        """"
+            The answer for a browser at this viewport, as an encoded and compressed FigureEntry
+        """
+        view_requests.inc()
+        tiles, snapped = self.snap(viewport)
+        key = (snapshot.version,) + tiles
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        with self.lock:
+            self.misses += 1
+            devices, clusters = self.get_index(snapshot).query(snapped, self.max_points, self.cluster_size)
+            data = {
+                "version": snapshot.version,
+                "sensors": [encode_sensor(s) for s in devices],
+                "gateways": [encode_gateway(g) for g in snapshot.gateways],
+                "clusters": clusters,
+            }
+            entry = FigureEntry(snapshot.version, json.dumps(data, separators=(",", ":")).encode("utf-8"))
+            entry.etag = '"view-%d-%s"' % (snapshot.version, "-".join(str(t) for t in tiles))
+            self.entries[key] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return entry
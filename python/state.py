@@ -0,0 +1,152 @@
+# state store
+# The ingest thread changes the sensors and gateways all the time, while the dash thread draws them.
+# Instead of letting the mapper read the live objects, the ingest side publishes read only snapshots:
+# a Snapshot is made of tuples of namedtuples, so it can never change after it is made and can be read from any
+# thread without locks. Every snapshot with new content gets a higher version number, so the map (and
+# everything else that reads the state) can skip work when nothing changed.
+
+from collections import namedtuple
+from types import MappingProxyType
+import threading
+import time
+
+SensorView = namedtuple("SensorView", [
+    "eui", "name", "known", "lat", "lon", "known_lat", "known_lon", "estimated", "nr_of_packets", "gateways",
+    "foreign"])
+GatewayView = namedtuple("GatewayView", ["eui", "name", "lat", "lon", "altitude"])
+# the cells of the rssi heatmap (see heatmap.py), the version only goes up when the cells changed
+CoverageView = namedtuple("CoverageView", ["version", "lat", "lon", "strength", "rssi"])
+EMPTY_COVERAGE = CoverageView(0, (), (), (), ())
+
+
+class Snapshot(namedtuple("Snapshot", ["version", "time", "sensors", "gateways", "gateways_by_eui", "coverage"])):
+    __slots__ = ()
+
+    def same_content(self, other):
+        return (other is not None and self.sensors == other.sensors and self.gateways == other.gateways
+                and self.coverage.version == other.coverage.version)
+
+
+def sensor_view(sensor):
+    return SensorView(
+        sensor.get_sensor_id(),
+        sensor.name_of_sensor if sensor.has_sensor_name() else "Unknown",
+        sensor.known,
+        sensor.get_lat(),
+        sensor.get_lon(),
+        sensor.get_known_lat(),
+        sensor.get_known_lon(),
+        sensor.pos_is_estimated(),
+        sensor.nr_of_packets,
+        tuple(signal.eui_of_gateway for signal in sensor.avg_signals),
+        False,
+    )
+
+
+def foreign_view(device):
+    # foreign devices are shown like unknown sensors, their eui is their short address
+    return SensorView("addr:" + device.addr, device.addr, False, device.lat, device.lon, device.lat, device.lon,
+                      True, device.nr_of_packets, tuple(device.gateway_stats), True)
+
+
+def gateway_view(gateway):
+    return GatewayView(gateway.get_gateway_id(), gateway.get_gateway_name(), gateway.get_lat(), gateway.get_lon(),
+                       gateway.get_gateway_altitude())
+
+
+def make_snapshot(version, sensors, gateways, foreign=(), coverage=None):
+    return build_snapshot(
+        version,
+        time.time(),
+        [sensor_view(s) for s in sensors] + [foreign_view(d) for d in foreign],
+        [gateway_view(g) for g in gateways],
+        coverage.view() if coverage is not None else EMPTY_COVERAGE,
+    )
+
+
+def build_snapshot(version, timestamp, sensor_views, gateway_views, coverage=EMPTY_COVERAGE):
+    # from views that are already made, e.g. read back from the shared state file
+    gateway_views = tuple(gateway_views)
+    return Snapshot(
+        version,
+        timestamp,
+        tuple(sensor_views),
+        gateway_views,
+        MappingProxyType({g.eui: g for g in gateway_views}),
+        coverage,
+    )
+
+
+class StateStore:
+    def __init__(self, interval=1.0, refresh=60.0):
+        # snapshots are published at most once per interval seconds, and every refresh seconds without changes
+        # (the heatmap fades out when there is no traffic)
+        self.interval = interval
+        self.refresh = refresh
+        self.snapshot = make_snapshot(0, [], [])
+        self.changed = threading.Event()
+        self.publish_lock = threading.Lock()
+        self.notify_lock = threading.Lock()
+        self.thread = None
+        # called with (old snapshot, new snapshot) every time a new version is published
+        self.listeners = []
+
+    def get(self):
+        # the latest snapshot, reading an attribute is atomic so no lock is needed
+        return self.snapshot
+
+    def version(self):
+        return self.snapshot.version
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def mark_changed(self):
+        # called by the ingest side after it changed sensors or gateways
+        self.changed.set()
+
+    def publish(self, sensors, gateways, foreign=(), coverage=None):
+        """"
+            Makes a snapshot of the sensors and gateways (and the heatmap cells of coverage, a CoverageGrid) and
+            tells the listeners. The caller must make sure they are not changed while this runs.
+            The version only goes up when the content is different from the last snapshot.
+        """
+        current, snapshot = self.swap(sensors, gateways, foreign, coverage)
+        if snapshot is not current:
+            self.notify(current, snapshot)
+        return snapshot
+
+    def swap(self, sensors, gateways, foreign=(), coverage=None):
+        # makes the new snapshot, returns (old, new), new is old when nothing changed. Only this needs the
+        # sensors and gateways to stay the same, the listeners only read the snapshot
+        with self.publish_lock:
+            current = self.snapshot
+            snapshot = make_snapshot(current.version + 1, sensors, gateways, foreign, coverage)
+            if snapshot.same_content(current):
+                return current, current
+            self.snapshot = snapshot
+            return current, snapshot
+
+    def notify(self, old, new):
+        # the lock keeps the listeners getting the versions in order
+        with self.notify_lock:
+            for listener in self.listeners:
+                listener(old, new)
+
+    def start(self, registry, lock):
+        # publish in a background thread, lock is the lock the ingest side holds while it changes the registry
+        self.thread = threading.Thread(target=self.publisher, args=(registry, lock), daemon=True)
+        self.thread.start()
+
+    def publisher(self, registry, lock):
+        while True:
+            self.changed.wait(self.refresh)
+            self.changed.clear()
+            # the lock is only held to make the snapshot, encoding it for the listeners (e.g. the shared state
+            # file) does not stop the ingest
+            with lock:
+                current, snapshot = self.swap(registry.sensors, registry.gateways, registry.foreign.located(),
+                                              registry.coverage)
+            if snapshot is not current:
+                self.notify(current, snapshot)
+            time.sleep(self.interval)
@@ -0,0 +1,374 @@
+# storage
+# Keeps the receptions and the learned state on disk, so a restart does not start from nothing:
+#     python main.py --store lora.db
+# Everything is in one sqlite file:
+#     receptions_YYYYMMDD  every decoded packet of that (utc) day, one table per day
+#     hourly               per hour, device and gateway: count and rssi/snr averages of the days that were
+#                          downsampled
+#     checkpoints          the state of all sensors, gateways, foreign devices, the path loss model and the
+#                          heatmap, zlib compressed json
+# Packets are buffered and written in one transaction every second. A checkpoint is written every few minutes
+# and when the program stops. On startup the last checkpoint is loaded and only the receptions after it are
+# parsed again, instead of all history.
+# One table per day makes retention cheap: days older than downsample_days are summed into hourly and dropped,
+# hourly rows older than retention_days are deleted.
+
+import json
+import math
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from foreign import ForeignDevice
+from packets import Packet
+from signals import Gateway, GatewayStats, RunningStats, Sensor, Signal, path_loss, path_loss_models
+import logs
+
+log = logs.get_logger("main")
+
+RECEPTION_COLUMNS = ("time", "device_eui", "device_addr", "device_name", "gateway", "rssi", "snr", "size", "freq",
+                     "datr")
+
+
+def day_table(timestamp):
+    return "receptions_" + time.strftime("%Y%m%d", time.gmtime(timestamp))
+
+
+def day_tables(db):
+    rows = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'receptions_%' ORDER BY name")
+    return [row[0] for row in rows]
+
+
+def stats_state(stats):
+    return [stats.count, stats.mean, stats.m2]
+
+
+def restore_stats(state):
+    stats = RunningStats()
+    stats.count, stats.mean, stats.m2 = state
+    return stats
+
+
+def gateway_stats_state(stats):
+    return [stats.eui_of_gateway, stats_state(stats.rssi), stats_state(stats.snr), stats_state(stats.distance),
+            stats.first_seen, stats.last_seen]
+
+
+def restore_gateway_stats(state):
+    eui, rssi, snr, distance, first_seen, last_seen = state
+    stats = GatewayStats(eui)
+    stats.rssi, stats.snr, stats.distance = restore_stats(rssi), restore_stats(snr), restore_stats(distance)
+    stats.first_seen, stats.last_seen = first_seen, last_seen
+    return stats
+
+
+def sensor_state(sensor):
+    return {
+        "eui": sensor.eui_of_sensor,
+        "name": sensor.name_of_sensor,
+        "known": sensor.known,
+        "lat": sensor.lat,
+        "lon": sensor.lon,
+        "known_lat": sensor.get_known_lat(),
+        "known_lon": sensor.get_known_lon(),
+        "nr_of_packets": sensor.nr_of_packets,
+        "localized": sensor.localized,
+        "fixes": [list(sensor.fixes), sensor.nr_of_fixes],
+        # in the order of avg_signals
+        "gateways": [gateway_stats_state(sensor.gateway_stats[signal.eui_of_gateway])
+                     for signal in sensor.avg_signals],
+    }
+
+
+def restore_sensor(state, registry):
+    if state["known"]:
+        sensor = Sensor(state["name"], True, state["eui"], state["known_lon"], state["known_lat"])
+    else:
+        sensor = Sensor(state["name"], False, state["eui"], state["lon"], state["lat"])
+    sensor.lat, sensor.lon = state["lat"], state["lon"]
+    sensor.nr_of_packets = state["nr_of_packets"]
+    sensor.localized = state.get("localized", False)
+    # checkpoints before the fix history only have the mean of the fixes, that is not used anymore
+    if "fixes" in state:
+        fixes, sensor.nr_of_fixes = state["fixes"]
+        sensor.fixes.extend(tuple(fix) for fix in fixes)
+
+    for gateway in state["gateways"]:
+        stats = restore_gateway_stats(gateway)
+        eui = stats.eui_of_gateway
+        record = registry.lookup_gateway(eui)
+        if record is None:
+            # the gateway is not in the catalog anymore
+            continue
+        sensor.gateway_stats[eui] = stats
+
+        # the average signal has the averages of the stats, like average_distances_to_gateway makes it
+        signal = Signal(eui, stats.rssi.mean, record.lon, record.lat, stats.snr.mean if stats.snr.count else None,
+                        stats.last_seen)
+        signal.distance = stats.distance.mean
+        sensor.avg_signal_by_gateway[eui] = signal
+        sensor.avg_signals.append(signal)
+    return sensor
+
+
+def foreign_state(device):
+    return {
+        "addr": device.addr,
+        "first_seen": device.first_seen,
+        "last_seen": device.last_seen,
+        "nr_of_packets": device.nr_of_packets,
+        "lat": device.lat,
+        "lon": device.lon,
+        "fixes": [list(device.fixes), device.nr_of_fixes],
+        "gateways": [gateway_stats_state(stats) for stats in device.gateway_stats.values()],
+    }
+
+
+def restore_foreign(state, registry):
+    device = ForeignDevice(state["addr"], state["first_seen"])
+    device.last_seen = state["last_seen"]
+    device.nr_of_packets = state["nr_of_packets"]
+    device.lat, device.lon = state["lat"], state["lon"]
+    fixes, device.nr_of_fixes = state["fixes"]
+    device.fixes.extend(tuple(fix) for fix in fixes)
+    for gateway in state["gateways"]:
+        stats = restore_gateway_stats(gateway)
+        # only gateways that are still in the catalog can be used for a position
+        if registry.lookup_gateway(stats.eui_of_gateway) is not None:
+            device.gateway_stats[stats.eui_of_gateway] = stats
+    return device
+
+
+def coverage_state(grid):
+    # only the cells with receptions, the grid is mostly empty
+    rows, cols = np.nonzero(grid.weight)
+    return {
+        "grid": [grid.south, grid.west, grid.rows, grid.cols, grid.cell_size],
+        "epoch": grid.epoch,
+        "nr_of_receptions": grid.nr_of_receptions,
+        "nr_of_outside": grid.nr_of_outside,
+        "cells": np.column_stack([rows * grid.cols + cols, grid.weight[rows, cols], grid.rssi_sum[rows, cols],
+                                  grid.snr_sum[rows, cols], grid.snr_weight[rows, cols]]).tolist(),
+    }
+
+
+def restore_coverage(grid, state):
+    # the grid is made around the catalog, when that changed the cells of the checkpoint do not fit anymore
+    south, west, rows, cols, cell_size = state["grid"]
+    if (rows, cols) != (grid.rows, grid.cols) or not all(
+            math.isclose(a, b) for a, b in ((south, grid.south), (west, grid.west), (cell_size, grid.cell_size))):
+        log.warning("Heatmap of the checkpoint is not restored, the grid around the catalog changed")
+        return False
+    grid.epoch = state["epoch"]
+    grid.nr_of_receptions = state["nr_of_receptions"]
+    grid.nr_of_outside = state["nr_of_outside"]
+    cells = np.array(state["cells"], dtype=float).reshape(-1, 5)
+    index = cells[:, 0].astype(int)
+    for column, target in enumerate((grid.weight, grid.rssi_sum, grid.snr_sum, grid.snr_weight), 1):
+        target.flat[index] = cells[:, column]
+    grid.changed = True
+    return True
+
+
+def make_checkpoint(registry):
+    """"
+        The learned state of the registry as a dict, call this while the registry is not being changed
+    """
+    return {
+        "time": time.time(),
+        "path_loss": dict(vars(path_loss)),
+        "path_loss_models": [[gateway, sf, power, n] for (gateway, sf), (power, n) in path_loss_models.models.items()],
+        "sensors": [sensor_state(sensor) for sensor in registry.sensors],
+        "gateways": [gateway.get_gateway_id() for gateway in registry.gateways],
+        "unknown_gateways": registry.unknown_gateways,
+        # least recently heard first, like the tracker keeps them
+        "foreign": [foreign_state(device) for device in registry.foreign.devices.values()],
+        "coverage": coverage_state(registry.coverage),
+    }
+
+
+def restore_checkpoint(registry, checkpoint):
+    vars(path_loss).update(checkpoint["path_loss"])
+    path_loss_models.publish({(gateway, sf): (power, n)
+                              for gateway, sf, power, n in checkpoint.get("path_loss_models", [])})
+    for eui in checkpoint["gateways"]:
+        record = registry.lookup_gateway(eui)
+        if record is not None and registry.get_gateway(eui) is None:
+            registry.add_gateway(Gateway(record.name, eui, record.lon, record.lat, record.altitude))
+    for state in checkpoint["sensors"]:
+        if registry.get_sensor(state["eui"]) is None:
+            registry.add_sensor(restore_sensor(state, registry))
+    registry.unknown_gateways.update(checkpoint["unknown_gateways"])
+    # checkpoints before the foreign devices and the heatmap were kept do not have them
+    for state in checkpoint.get("foreign", []):
+        registry.foreign.devices[state["addr"]] = restore_foreign(state, registry)
+    registry.foreign.evict()
+    if "coverage" in checkpoint:
+        restore_coverage(registry.coverage, checkpoint["coverage"])
+
+
+class SignalStore:
+    def __init__(self, path, flush_interval=1.0, checkpoint_interval=300.0, downsample_days=7, retention_days=90,
+                 keep_checkpoints=3):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.downsample_days = downsample_days
+        self.retention_days = retention_days
+        self.keep_checkpoints = keep_checkpoints
+
+        # the ingest calls us from changing worker threads, the lock keeps the connection to one at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (time REAL PRIMARY KEY, data BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS hourly (hour INTEGER, device TEXT, gateway TEXT, count INTEGER, "
+                        "rssi_mean REAL, rssi_min REAL, rssi_max REAL, snr_mean REAL, "
+                        "PRIMARY KEY (hour, device, gateway))")
+        self.db.commit()
+        self.lock = threading.Lock()
+
+        self.buffer = []
+        self.tables = set(self.day_tables())
+        # databases written before the index was added
+        with self.db:
+            for table in self.tables:
+                self.create_time_index(table)
+        self.last_flush = time.time()
+        self.last_checkpoint = time.time()
+        self.last_retention = 0.0
+        self.nr_of_rows = 0
+
+    def day_tables(self):
+        return day_tables(self.db)
+
+    def create_time_index(self, table):
+        # receptions_after reads the receptions after a checkpoint, without an index that is a full table scan
+        self.db.execute("CREATE INDEX IF NOT EXISTS %s_time ON %s (time)" % (table, table))
+
+    def append(self, packets, now=None):
+        # buffered, written by flush
+        if now is None:
+            now = time.time()
+        for p in packets:
+            self.buffer.append((now, p.device_eui, p.device_addr, p.device_name, p.gateway, p.rssi, p.snr, p.size,
+                                p.freq, p.datr))
+
+    def flush(self):
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+            self.last_flush = time.time()
+            if not rows:
+                return 0
+            # the rows of one batch can be on both sides of midnight
+            by_table = {}
+            for row in rows:
+                by_table.setdefault(day_table(row[0]), []).append(row)
+            with self.db:
+                for table, table_rows in by_table.items():
+                    if table not in self.tables:
+                        self.db.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, ", ".join(RECEPTION_COLUMNS)))
+                        self.create_time_index(table)
+                        self.tables.add(table)
+                    placeholders = ", ".join("?" * len(RECEPTION_COLUMNS))
+                    self.db.executemany("INSERT INTO %s VALUES (%s)" % (table, placeholders), table_rows)
+            self.nr_of_rows += len(rows)
+            return len(rows)
+
+    def checkpoint(self, registry):
+        # call this while the registry is not being changed (with the ingest lock held)
+        start = time.perf_counter()
+        checkpoint = make_checkpoint(registry)
+        data = zlib.compress(json.dumps(checkpoint, separators=(",", ":")).encode("utf-8"), 6)
+        self.flush()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)", (checkpoint["time"], data))
+            self.db.execute("DELETE FROM checkpoints WHERE time NOT IN "
+                            "(SELECT time FROM checkpoints ORDER BY time DESC LIMIT ?)", (self.keep_checkpoints,))
+        self.last_checkpoint = time.time()
+        log.info("Checkpoint of %d sensors and %d foreign devices written (%d bytes) in %.2f s",
+                 len(checkpoint["sensors"]), len(checkpoint["foreign"]), len(data), time.perf_counter() - start)
+        return checkpoint["time"]
+
+    def latest_checkpoint(self):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM checkpoints ORDER BY time DESC LIMIT 1").fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def receptions_after(self, after):
+        """"
+            (time, packet) of the packets received after the given time, oldest first
+        """
+        first_table = day_table(after)
+        for table in self.day_tables():
+            if table < first_table:
+                continue
+            with self.lock:
+                rows = self.db.execute("SELECT * FROM %s WHERE time > ? ORDER BY time" % table, (after,)).fetchall()
+            for row in rows:
+                yield row[0], Packet(*row[1:])
+
+    def restore(self, registry, handle_message):
+        """"
+            Rebuilds the registry from the last checkpoint and the receptions after it, returns the number of
+            packets parsed again. handle_message(registry, packet) is the parser.
+        """
+        start = time.perf_counter()
+        checkpoint = self.latest_checkpoint()
+        after = 0.0
+        if checkpoint is not None:
+            restore_checkpoint(registry, checkpoint)
+            after = checkpoint["time"]
+        count = 0
+        for _, packet in self.receptions_after(after):
+            handle_message(registry, packet, muting=True)
+            count += 1
+        # every sensor with signals gets a new position estimate
+        for sensor in registry.sensors:
+            sensor.needs_localization = len(sensor.avg_signals) >= 3
+        log.info("Restored %d sensors and %d gateways, %d packets parsed again, in %.2f s", len(registry.sensors),
+                 len(registry.gateways), count, time.perf_counter() - start)
+        return count
+
+    def apply_retention(self, now=None):
+        # old days are summed into hourly rows, very old hourly rows are deleted
+        if now is None:
+            now = time.time()
+        downsample_before = day_table(now - self.downsample_days * 86400)
+        with self.lock, self.db:
+            for table in self.day_tables():
+                if table >= downsample_before:
+                    continue
+                self.db.execute(
+                    "INSERT OR REPLACE INTO hourly SELECT CAST(time / 3600 AS INTEGER), "
+                    "COALESCE(device_eui, 'addr:' || device_addr), gateway, COUNT(*), AVG(rssi), MIN(rssi), "
+                    "MAX(rssi), AVG(snr) FROM %s GROUP BY 1, 2, 3" % table)
+                self.db.execute("DROP TABLE %s" % table)
+                self.tables.discard(table)
+                log.info("Downsampled %s to hourly", table)
+            self.db.execute("DELETE FROM hourly WHERE hour < ?", (int((now - self.retention_days * 86400) // 3600),))
+        self.last_retention = now
+
+    def maybe_write(self, registry, now=None):
+        # call this after every batch, with the ingest lock held
+        if now is None:
+            now = time.time()
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+        if now - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint(registry)
+        if now - self.last_retention >= 3600:
+            self.apply_retention(now)
+
+    def close(self, registry=None):
+        if registry is not None:
+            self.checkpoint(registry)
+        else:
+            self.flush()
+        with self.lock:
+            self.db.close()
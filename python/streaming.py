@@ -0,0 +1,157 @@
+# delta streaming
+# Pushes map updates to the browsers with server sent events (/map/events) instead of letting them poll.
+# When a client connects it gets one 'snapshot' event with the full state, after that it only gets 'delta'
+# events with the sensors and gateways that are new or changed (moved, new gateway links, new estimate), and the
+# heatmap cells when they changed.
+# Every event is encoded once and sent to all clients. The last few events are kept, so a client that reconnects
+# (the browser sends Last-Event-ID) only gets what it missed, or a new snapshot when it missed too much.
+# The browser side is assets/map_stream.js, it applies the events to the plotly map.
+# When a snapshot has more than max_points devices the events only say there is a new version (lod), the browsers
+# then get the devices of their viewport from /map/view instead (see spatial.py).
+
+from collections import deque
+import json
+import threading
+
+import logs
+
+log = logs.get_logger("mapper")
+
+
+def encode_sensor(sensor):
+    # compact list instead of a dict, the order is the same as in map_stream.js
+    return [sensor.eui, sensor.name, int(sensor.known), round(sensor.lat, 6), round(sensor.lon, 6),
+            round(sensor.known_lat, 6), round(sensor.known_lon, 6), int(sensor.estimated), list(sensor.gateways),
+            int(sensor.foreign)]
+
+
+def encode_gateway(gateway):
+    return [gateway.eui, gateway.name, round(gateway.lat, 6), round(gateway.lon, 6)]
+
+
+def encode_coverage(coverage):
+    # the heatmap cells as [lats, lons, strengths], the rssi is not shown in the browser
+    return [coverage.lat, coverage.lon, coverage.strength]
+
+
+def diff_snapshots(old, new):
+    """"
+        The changes needed to go from the old to the new snapshot
+    """
+    old_sensors = {s.eui: s for s in old.sensors}
+    new_sensors = {s.eui: s for s in new.sensors}
+    old_gateways = {g.eui: g for g in old.gateways}
+    new_gateways = {g.eui: g for g in new.gateways}
+    delta = {
+        "version": new.version,
+        "base": old.version,
+        "sensors": [encode_sensor(s) for s in new.sensors if old_sensors.get(s.eui) != s],
+        "removed_sensors": [eui for eui in old_sensors if eui not in new_sensors],
+        "gateways": [encode_gateway(g) for g in new.gateways if old_gateways.get(g.eui) != g],
+        "removed_gateways": [eui for eui in old_gateways if eui not in new_gateways],
+    }
+    # the heatmap only changes every few seconds, it is sent whole when it did
+    if new.coverage.version != old.coverage.version:
+        delta["coverage"] = encode_coverage(new.coverage)
+    return delta
+
+
+def version_event(old, new):
+    # a new version of a large snapshot, without the devices
+    event = {"version": new.version, "base": old.version if old is not None else None, "lod": 1}
+    if old is None or new.coverage.version != old.coverage.version:
+        event["coverage"] = encode_coverage(new.coverage)
+    return event
+
+
+def sse_event(event, version, data):
+    return "event: %s\nid: %d\ndata: %s\n\n" % (event, version, json.dumps(data, separators=(",", ":")))
+
+
+class DeltaBroadcaster:
+    def __init__(self, store, history=100, keepalive=15.0, max_points=None):
+        self.store = store
+        self.keepalive = keepalive
+        # above this number of devices only versions are sent, None sends everything
+        self.max_points = max_points
+        # (version, base version, encoded event) of the last events
+        self.events = deque(maxlen=history)
+        self.condition = threading.Condition()
+        self.snapshot_event = None
+        self.nr_of_clients = 0
+        store.add_listener(self.on_publish)
+
+    def on_publish(self, old, new):
+        # called by the state store for every new snapshot, the delta is made once for all clients
+        delta = version_event(old, new) if self.is_large(new) else diff_snapshots(old, new)
+        text = sse_event("delta", new.version, delta)
+        with self.condition:
+            self.events.append((new.version, old.version, text))
+            self.condition.notify_all()
+
+    def is_large(self, snapshot):
+        return self.max_points is not None and len(snapshot.sensors) > self.max_points
+
+    def full_snapshot(self):
+        # the full state as one event, encoded once per version
+        snapshot = self.store.get()
+        cached = self.snapshot_event
+        if cached is None or cached[0] != snapshot.version:
+            if self.is_large(snapshot):
+                data = version_event(None, snapshot)
+            else:
+                data = {
+                    "version": snapshot.version,
+                    "sensors": [encode_sensor(s) for s in snapshot.sensors],
+                    "gateways": [encode_gateway(g) for g in snapshot.gateways],
+                    "coverage": encode_coverage(snapshot.coverage),
+                }
+            cached = (snapshot.version, sse_event("snapshot", snapshot.version, data))
+            self.snapshot_event = cached
+        return cached
+
+    def events_after(self, version):
+        # the events a client at this version still needs, None when some of them are not kept anymore
+        # (or when the client is ahead of us, after a restart or when it talked to another web worker)
+        if version > self.store.version():
+            return None
+        missed = [event for event in self.events if event[0] > version]
+        if missed and missed[0][1] != version:
+            return None
+        return missed
+
+    def stream(self, last_event_id=None):
+        """"
+            Generator with the text of the event stream for one client
+        """
+        self.nr_of_clients += 1
+        log.info("Map client connected, %d connected", self.nr_of_clients)
+        try:
+            cursor = None
+            if last_event_id is not None and last_event_id.isdigit():
+                cursor = int(last_event_id)
+                if self.events_after(cursor) is None:
+                    cursor = None
+            if cursor is None:
+                cursor, text = self.full_snapshot()
+                yield text
+
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.events and self.events[-1][0] > cursor, self.keepalive)
+                    events = self.events_after(cursor)
+
+                if events is None:
+                    # the client is too far behind, start over with a full snapshot
+                    cursor, text = self.full_snapshot()
+                    yield text
+                elif not events:
+                    # comment line, keeps proxies from closing the connection
+                    yield ": keepalive\n\n"
+                else:
+                    for version, _, text in events:
+                        cursor = version
+                        yield text
+        finally:
+            self.nr_of_clients -= 1
+            log.info("Map client disconnected, %d connected", self.nr_of_clients)
@@ -0,0 +1,146 @@
+# uplink grouping
+# The same uplink (one transmission of a device) is received by every gateway in range, and the websocket gives us
+# one packet per gateway. The UplinkGrouper joins these receptions back into one Uplink:
+# packets of the same device (device eui, or device_addr for foreign devices) with the same size, frequency and
+# data rate that arrive within a short window belong to the same uplink.
+# An uplink is closed when its window has passed, or earlier when too many uplinks are open at the same time,
+# so memory stays bounded. Closed uplinks can be localized on their own (one solve per uplink), all receptions are
+# of the same transmission. Single fixes still have large outliers, so they only refine the estimate from the long
+# run averages when their median agrees with it (see localization.combine_with_fixes).
+
+from collections import OrderedDict, namedtuple
+import math
+import time
+
+import numpy as np
+
+from localization import R, GatewayDistance, geometry_cache, solve_grouped
+from metrics import metrics
+from packets import as_packet, spreading_factor
+from signals import path_loss_models
+
+Reception = namedtuple("Reception", ["gateway", "rssi", "snr", "time"])
+
+uplink_seconds = metrics.histogram("lora_uplink_localization_seconds", "Time to localize a batch of uplinks")
+localized_uplinks = metrics.counter("lora_localized_uplinks_total", "Uplinks with a position")
+
+
+class Uplink:
+    __slots__ = ("device", "device_eui", "device_addr", "device_name", "frame", "opened", "receptions")
+
+    def __init__(self, device, device_eui, device_addr, device_name, frame, opened):
+        self.device = device
+        self.device_eui = device_eui
+        self.device_addr = device_addr
+        self.device_name = device_name
+        # (size, freq, datr) of the transmission
+        self.frame = frame
+        self.opened = opened
+        self.receptions = []
+
+    def gateways(self):
+        return [r.gateway for r in self.receptions]
+
+    def has_gateway(self, gateway):
+        return any(r.gateway == gateway for r in self.receptions)
+
+
+class UplinkGrouper:
+    def __init__(self, window=1.0, max_open=10000):
+        # receptions of one uplink arrive within window seconds of the first one
+        self.window = window
+        self.max_open = max_open
+        # open uplinks in the order they were opened, so the oldest is always first
+        self.open = OrderedDict()
+        self.nr_of_uplinks = 0
+        self.nr_of_evicted = 0
+
+    def add(self, msg, now=None):
+        """"
+            Adds one packet, returns the uplinks that were closed because of it (usually none)
+        """
+        if now is None:
+            now = time.time()
+        closed = self.expire(now)
+        expired = len(closed)
+
+        packet = as_packet(msg)
+        device = packet.device_key()
+        if device is None:
+            return closed
+        gateway = packet.gateway
+        key = (device, packet.size, packet.freq, packet.datr)
+
+        uplink = self.open.get(key)
+        if uplink is not None and uplink.has_gateway(gateway):
+            # the same gateway twice means this is the next transmission
+            closed.append(self.open.pop(key))
+            uplink = None
+
+        if uplink is None:
+            uplink = Uplink(device, packet.device_eui, packet.device_addr, packet.device_name, key[1:], now)
+            self.open[key] = uplink
+            if len(self.open) > self.max_open:
+                # too many open uplinks, close the oldest one early
+                closed.append(self.open.popitem(last=False)[1])
+                self.nr_of_evicted += 1
+
+        uplink.receptions.append(Reception(gateway, packet.rssi, packet.snr, packet.time))
+        self.nr_of_uplinks += len(closed) - expired
+        return closed
+
+    def expire(self, now=None):
+        # closes all uplinks whose window has passed
+        if now is None:
+            now = time.time()
+        closed = []
+        while self.open:
+            key, uplink = next(iter(self.open.items()))
+            if uplink.opened + self.window > now:
+                break
+            closed.append(self.open.pop(key))
+        self.nr_of_uplinks += len(closed)
+        return closed
+
+    def close_all(self):
+        closed = list(self.open.values())
+        self.open.clear()
+        self.nr_of_uplinks += len(closed)
+        return closed
+
+
+def localize_uplinks(uplinks, registry, min_gateways=3, cache=geometry_cache, max_outside=1000.0):
+    """"
+        Position of every uplink that was received by at least min_gateways known gateways.
+        Uplinks with the same gateways are solved together. Positions more than max_outside meters outside the
+        box around their gateways are dropped, those come from bad distances. Returns a list of (uplink, lat, lon)
+    """
+    start = time.perf_counter()
+    todo = []
+    signal_lists = []
+    for uplink in uplinks:
+        # one reception per gateway, only gateways we know the position of
+        # frame is (size, freq, datr), all receptions of an uplink have the same spreading factor
+        sf = spreading_factor(uplink.frame[2])
+        signals = [GatewayDistance(r.gateway, record.lat, record.lon, path_loss_models.distance(r.rssi, r.gateway, sf))
+                   for r in uplink.receptions
+                   for record in (registry.lookup_gateway(r.gateway),) if record is not None]
+        if len(signals) >= min_gateways:
+            todo.append(uplink)
+            signal_lists.append(signals)
+    if not todo:
+        return []
+
+    results = []
+    lats, lons = solve_grouped(signal_lists, cache)
+    margin_lat = math.degrees(max_outside / R)
+    for uplink, signals, lat, lon in zip(todo, signal_lists, lats.tolist(), lons.tolist()):
+        if np.isnan(lat) or np.isnan(lon):
+            continue
+        margin_lon = margin_lat / math.cos(math.radians(lat))
+        if (min(s.lat for s in signals) - margin_lat <= lat <= max(s.lat for s in signals) + margin_lat
+                and min(s.lon for s in signals) - margin_lon <= lon <= max(s.lon for s in signals) + margin_lon):
+            results.append((uplink, lat, lon))
+    uplink_seconds.observe(time.perf_counter() - start)
+    localized_uplinks.inc(len(results))
+    return results
@@ -0,0 +1,45 @@
+# web worker
+# Serves the map without doing any ingest: the snapshots come from the state file of an ingest process
+# (python main.py --mode ingest), see sharedstate.py. Start as many workers as there are viewers to serve:
+#     LORA_STATE_FILE=/dev/shm/lora_state gunicorn -w 4 -k gthread --threads 32 -b 0.0.0.0:8050 web:server
+# Every open map keeps one event stream (/map/events) open, so use a threaded worker class with enough threads.
+# Without gunicorn, python web.py runs one worker with the flask server (for testing).
+
+import argparse
+
+from mapper import Mapper
+from sharedstate import SharedStateReader, default_state_file
+import logs
+
+
+def create_mapper(path=None):
+    # one reader per worker process, it polls the state file in a background thread
+    store = SharedStateReader(path)
+    store.start()
+    return Mapper(store)
+
+
+def __getattr__(name):
+    # gunicorn asks for web:server, only then the mapper is made (after the worker process is forked)
+    if name == "server":
+        logs.setup()
+        server = globals()["server"] = create_mapper().app.server
+        return server
+    raise AttributeError(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the map from the state file of an ingest process")
+    parser.add_argument("--state-file", default=default_state_file())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--log", default=None, help="log levels, see logs.py")
+    args = parser.parse_args()
+
+    logs.setup(args.log)
+    mapper = create_mapper(args.state_file)
+    mapper.app.run(host=args.host, port=args.port, debug=False, threaded=True)
+
+
+if __name__ == "__main__":
+    main()